@@ -6,6 +6,9 @@ import numpy as np
 from hmmlearn import hmm
 from sklearn.preprocessing import StandardScaler
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Step_3_Brain_States"))
+from hmm_features import temporal_features
+
 # Argument parser for subject_id
 parser = argparse.ArgumentParser(description="HMM Fitting for a Single Participant")
 parser.add_argument("--subject_id", type=str, required=True, help="Participant ID")
@@ -63,13 +66,12 @@ def process_hmm(subject, mode, input_dir, output_dir):
             state_sequence = model.predict(features)
 
             # Compute temporal features
-            fractional_occupancy = np.array([np.sum(state_sequence == i) / len(state_sequence) for i in range(median_optimal_state)])
-            transition_counts = np.zeros((median_optimal_state, median_optimal_state))
-            for (i, j) in zip(state_sequence[:-1], state_sequence[1:]):
-                transition_counts[i, j] += 1
-            transition_probabilities = transition_counts / np.sum(transition_counts, axis=1, keepdims=True)
-            mean_lifetime = np.array([np.mean(np.diff(np.where(state_sequence == i)[0])) if np.where(state_sequence == i)[0].size > 1 else 0 for i in range(median_optimal_state)])
-            mean_interval_length = np.array([np.mean(np.diff(np.where(state_sequence == k)[0])) if np.where(state_sequence == k)[0].size > 1 else 0 for k in range(median_optimal_state)])
+            temporal = temporal_features([state_sequence], median_optimal_state)
+            fractional_occupancy = temporal["fractional_occupancy"][0]
+            transition_probabilities = temporal["transition_probabilities"][0]
+            # Here both are the mean spacing between consecutive occurrences of the state
+            mean_lifetime = temporal["occurrence_spacing"][0]
+            mean_interval_length = temporal["occurrence_spacing"][0]
 
             # Compute spatial features
             correlation_matrices = {}
@@ -1,6 +1,7 @@
 import mne
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 # --- USER INPUTS ---
 subject_prefix = "NU"
@@ -10,19 +11,47 @@ base_dir = "/projects/illinois/ahs/kch/nakhan2/NURISH_Cohort1/Source_Localised_D
 n_epochs = 200  # Set to your maximum possible number of epochs
 subject_fsaverage = 'fsaverage'
 output_group_stc_stem = os.path.join(base_dir, "group_average_inversesolution")
+n_workers = 4  # Subjects read in parallel; memory stays at roughly 2 STCs per worker
+compute_variance = False  # Also save the across-subject standard deviation STC
 
-# Collect per-subject means in this list
-subject_mean_stcs = []
 
-for subj_num in range(subject_start, subject_end + 1):
-    subject_id = f"{subject_prefix}{subj_num}"
+class RunningMean:
+    """Welford running mean (and optional variance) of equally shaped arrays."""
+
+    def __init__(self, compute_variance=False):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.compute_variance = compute_variance
+
+    def update(self, data):
+        self.count += 1
+        if self.mean is None:
+            self.mean = np.array(data, dtype=np.float64)
+            if self.compute_variance:
+                self.m2 = np.zeros_like(self.mean)
+            return
+        delta = data - self.mean
+        self.mean += delta / self.count
+        if self.compute_variance:
+            self.m2 += delta * (data - self.mean)
+
+    def variance(self):
+        if self.m2 is None or self.count < 2:
+            return None
+        return self.m2 / (self.count - 1)
+
+
+def average_subject(subject_id):
+    """Streams a subject's epoch STCs into a running mean and saves the subject average."""
     subject_dir = os.path.join(base_dir, subject_id)
     print(subject_dir)
     if not os.path.exists(subject_dir):
         print(f"Subject directory missing for {subject_id}, skipping.")
-        continue
+        return None
 
-    stcs = []
+    running = RunningMean()
+    first_stc = None
     for idx in range(n_epochs):
         fname_stem = os.path.join(subject_dir, f"{subject_id}_inversesolution_epoch{idx}.fif")
         lh_file = fname_stem + "-lh.stc"
@@ -31,57 +60,96 @@ for subj_num in range(subject_start, subject_end + 1):
             continue  # skip missing epochs
         try:
             stc = mne.read_source_estimate(fname_stem, subject=subject_fsaverage)
-            stcs.append(stc)
         except Exception as e:
             print(f"Error loading {fname_stem}: {e}")
+            continue
+        if first_stc is None:
+            first_stc = stc
+        elif stc.data.shape != first_stc.data.shape:
+            print(f"Skipping {fname_stem}: shape {stc.data.shape} does not match {first_stc.data.shape}")
+            continue
+        running.update(stc.data)
+        del stc
 
-    if len(stcs) == 0:
+    if running.count == 0:
         print(f"No valid STCs found for {subject_id}, skipping.")
-        continue
+        return None
 
     # Average across epochs for this subject
-    data = np.stack([stc.data for stc in stcs], axis=0)
-    mean_data = np.mean(data, axis=0)
     mean_stc = mne.SourceEstimate(
-        mean_data,
-        vertices=stcs[0].vertices,
-        tmin=stcs[0].tmin,
-        tstep=stcs[0].tstep,
-        subject=stcs[0].subject
+        running.mean,
+        vertices=first_stc.vertices,
+        tmin=first_stc.tmin,
+        tstep=first_stc.tstep,
+        subject=first_stc.subject
     )
     # Save the per-subject averaged STC
     avg_stc_stem = os.path.join(subject_dir, f"{subject_id}_inversesolution_average")
     mean_stc.save(avg_stc_stem, overwrite=True)
     print(f"Saved average STC for {subject_id} to {avg_stc_stem}-lh.stc and -rh.stc")
     print(f"{subject_id} average STC data shape: {mean_stc.data.shape}")
-    subject_mean_stcs.append(mean_stc)
-    print(f"Added average for {subject_id} ({len(stcs)} epochs) to group list.")
+    print(f"Added average for {subject_id} ({running.count} epochs) to group average.")
+    return mean_stc
+
+
+# Running group averages, one per distinct subject-average shape
+group_means = {}
+group_templates = {}
+
+def add_to_group(mean_stc):
+    shape = mean_stc.data.shape
+    if shape not in group_means:
+        group_means[shape] = RunningMean(compute_variance=compute_variance)
+        # Keep only the metadata so no subject's data is held after it is folded in
+        group_templates[shape] = dict(vertices=mean_stc.vertices, tmin=mean_stc.tmin,
+                                      tstep=mean_stc.tstep, subject=mean_stc.subject)
+    group_means[shape].update(mean_stc.data)
+
+subject_ids = [f"{subject_prefix}{subj_num}" for subj_num in range(subject_start, subject_end + 1)]
+
+# Keep at most n_workers subjects in flight so memory does not grow with cohort size
+with ThreadPoolExecutor(max_workers=n_workers) as executor:
+    pending = set()
+    for subject_id in subject_ids:
+        pending.add(executor.submit(average_subject, subject_id))
+        if len(pending) >= n_workers:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                mean_stc = future.result()
+                if mean_stc is not None:
+                    add_to_group(mean_stc)
+    for future in pending:
+        mean_stc = future.result()
+        if mean_stc is not None:
+            add_to_group(mean_stc)
 
 # --- GROUP AVERAGE ACROSS ALL SUBJECTS ---
-if len(subject_mean_stcs) == 0:
+if len(group_means) == 0:
     raise RuntimeError("No subject averages found. Check your file paths.")
 
 # Print all shapes for debugging
 print("Shapes of all subject mean STCs:")
-for stc in subject_mean_stcs:
-    print(stc.data.shape)
+for shape, running in group_means.items():
+    print(f"{shape}: {running.count} subjects")
 
-# Proceed only if all shapes match
-shapes = [stc.data.shape for stc in subject_mean_stcs]
-from collections import Counter
-most_common_shape = Counter(shapes).most_common(1)[0][0]
-subject_mean_stcs_filtered = [stc for stc in subject_mean_stcs if stc.data.shape == most_common_shape]
-print(f"Using {len(subject_mean_stcs_filtered)} subjects with shape {most_common_shape}")
-
-group_data = np.stack([stc.data for stc in subject_mean_stcs_filtered], axis=0)
-group_mean_data = np.mean(group_data, axis=0)
+# Proceed only with the most common shape
+most_common_shape = max(group_means, key=lambda shape: group_means[shape].count)
+group_running = group_means[most_common_shape]
+template = group_templates[most_common_shape]
+print(f"Using {group_running.count} subjects with shape {most_common_shape}")
 
 group_mean_stc = mne.SourceEstimate(
-    group_mean_data,
-    vertices=subject_mean_stcs_filtered[0].vertices,
-    tmin=subject_mean_stcs_filtered[0].tmin,
-    tstep=subject_mean_stcs_filtered[0].tstep,
-    subject=subject_mean_stcs_filtered[0].subject
+    group_running.mean,
+    **template
 )
 group_mean_stc.save(output_group_stc_stem, overwrite=True)
 print(f"Saved group-averaged STC to {output_group_stc_stem}-lh.stc and -rh.stc")
+
+group_variance = group_running.variance()
+if group_variance is not None:
+    group_std_stc = mne.SourceEstimate(
+        np.sqrt(group_variance),
+        **template
+    )
+    group_std_stc.save(output_group_stc_stem + "_std", overwrite=True)
+    print(f"Saved group standard deviation STC to {output_group_stc_stem}_std-lh.stc and -rh.stc")
@@ -3,7 +3,7 @@
 #SBATCH --output=/projects/illinois/ahs/kch/nakhan2/ACE_XZ/Source_Localisation/Output/output_%x_%j.log  # Output log
 #SBATCH --error=/projects/illinois/ahs/kch/nakhan2/ACE_XZ/Source_Localisation/Errors/error_%x_%j.log   # Error log
 #SBATCH --time=24:00:00                # Max runtime (hh:mm:ss)
-#SBATCH --cpus-per-task=1              # Number of CPUs
+#SBATCH --cpus-per-task=8              # Number of CPUs
 #SBATCH --mem=64G                      # Memory
 #SBATCH --account=nakhan2-ic            # Group account
 #SBATCH --partition=IllinoisComputes    # Compute partition
@@ -31,6 +31,6 @@ source /projects/illinois/ahs/kch/nakhan2/Shreya/bin/activate
 #python /projects/illinois/ahs/kch/nakhan2/scripts/Step_2_Source_Localisation/SR_Incongruent.py --subject_id "$subject_id"
 #python /projects/illinois/ahs/kch/nakhan2/scripts/Step_2_Source_Localisation/Source_Parcel.py --subject_id "$subject_id"
 #python /projects/illinois/ahs/kch/nakhan2/scripts/Step_3_Brain_States/Orthogonalization.py --subject_id "$subject_id"
-python /projects/illinois/ahs/kch/nakhan2/scripts/Step_3_Brain_States/Optimal_States.py --subject_id "$subject_id"
+python /projects/illinois/ahs/kch/nakhan2/scripts/Step_3_Brain_States/Optimal_States.py --subject_id "$subject_id" --n_jobs "${SLURM_CPUS_PER_TASK:-1}"
 # Deactivate virtual environment
 deactivate
\ No newline at end of file
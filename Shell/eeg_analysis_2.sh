@@ -17,6 +17,8 @@ source /projects/illinois/ahs/kch/nakhan2/Shreya/bin/activate
 
 # Run the Python script with subject_id as an argument
 #for participants all in one
+#set --cpus-per-task above to the number of parallel HMM fits
+#python /projects/illinois/ahs/kch/nakhan2/scripts/Step_3_Brain_States/HMM_fitting-new.py --n_jobs "${SLURM_CPUS_PER_TASK:-1}"
 #python /projects/illinois/ahs/kch/nakhan2/scripts/Step_3_Brain_States/Bootstrapping.py
 python /projects/illinois/ahs/kch/nakhan2/scripts/Step_3_Brain_States/Thresholding.py
 
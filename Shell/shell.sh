@@ -3,7 +3,7 @@
 #SBATCH --output=/projects/illinois/ahs/kch/nakhan2/NURISH_Cohort1/LogFiles/output_%x_%j.log  # Output log
 #SBATCH --error=/projects/illinois/ahs/kch/nakhan2/NURISH_Cohort1/LogFiles/error_%x_%j.log   # Error log
 #SBATCH --time=6:00:00                # Max runtime (hh:mm:ss)
-#SBATCH --cpus-per-task=1              # Number of CPUs
+#SBATCH --cpus-per-task=8              # Number of CPUs
 #SBATCH --mem=64G                      # Memory
 #SBATCH --account=nakhan2-ic            # Group account
 #SBATCH --partition=IllinoisComputes    # Compute partition
@@ -25,7 +25,7 @@ source /projects/illinois/ahs/kch/nakhan2/venv/bin/activate
 
 # Run the Python script with subject_id as an argument
 # keep changing the path of the python scripts that you want to run
-python /projects/illinois/ahs/kch/nakhan2/scripts/Step_3_Brain_States/Orthogonalization.py --subject_id "$subject_id"
+python /projects/illinois/ahs/kch/nakhan2/scripts/Step_3_Brain_States/Orthogonalization.py --subject_id "$subject_id" --n_jobs "${SLURM_CPUS_PER_TASK:-1}"
 
 # Deactivate virtual environment
 deactivate
@@ -1,5 +1,7 @@
 import os
 import gc
+import time
+import json
 import argparse
 import numpy as np
 import mne
@@ -10,10 +12,20 @@ from sklearn.decomposition import PCA
 from mne.minimum_norm import apply_inverse_epochs, make_inverse_operator
 from mne.datasets import fetch_fsaverage
 import matplotlib.pyplot as plt
+from noise_covariance import load_or_compute_noise_cov, compare_to_cross_validated, save_cov_report, save_cov_plots
+from source_modes import SPACINGS, ORIENTATIONS, source_tag, get_source_space_file
 
 # Parse command-line argument for subject_id
 parser = argparse.ArgumentParser(description="EEG Source Reconstruction")
 parser.add_argument("--subject_id", type=str, required=True, help="Participant ID")
+parser.add_argument("--cov_method", type=str, default="cv", choices=["cv", "oas", "ledoit_wolf"],
+                    help="Noise covariance estimator: cross-validated shrunk/empirical (cv) or closed-form oas/ledoit_wolf")
+parser.add_argument("--cov_report", action="store_true", help="Compare the fast covariance against the cross-validated estimate")
+parser.add_argument("--plot_cov", action="store_true", help="Save noise covariance plots")
+parser.add_argument("--spacing", type=str, default="ico5", choices=list(SPACINGS),
+                    help="Source space resolution (ico4/oct6 are faster, reduced-resolution modes)")
+parser.add_argument("--orientation", type=str, default="loose", choices=list(ORIENTATIONS),
+                    help="Source orientation: loose (0.2, three orientations per vertex) or fixed normal orientation")
 args = parser.parse_args()
 subject_id = args.subject_id
 
@@ -29,7 +41,7 @@ subjects_dir = custom_subjects_dir
 subject = "fsaverage"
 trans = "fsaverage"
 fs_dir = f'{custom_subjects_dir}/{subject}'
-src = op.join(fs_dir, "bem", "fsaverage-ico-5-src.fif")
+src = get_source_space_file(fs_dir, args.spacing, subjects_dir)
 bem = op.join(fs_dir, "bem", "fsaverage-5120-5120-5120-bem-sol.fif")
 
 # Define input and output directories
@@ -37,6 +49,13 @@ input_path = "/projects/illinois/ahs/kch/nakhan2/ACE_XW/Epochs/"
 files_out = "/projects/illinois/ahs/kch/nakhan2/ACE_XW/Source_Localised_Data/"
 os.makedirs(files_out, exist_ok=True)
 
+# Reduced-resolution / fixed-orientation modes are written to their own sub-folder
+mode_tag = source_tag(args.spacing, args.orientation)
+
+# Noise covariance cache shared by the congruent and incongruent scripts
+cov_dir = os.path.join(files_out, "Noise_Covariance")
+condition_events = {m: [f"{m}_left", f"{m}_right"] for m in ["congruent", "incongruent"]}
+
 # Processing modes
 modes = ['incongruent']
 
@@ -48,7 +67,7 @@ if not os.path.exists(input_file):
 
 # Process EEG data for each mode
 for mode in modes:
-    output_path = os.path.join(files_out, mode)
+    output_path = os.path.join(files_out, mode_tag, mode)
     os.makedirs(output_path, exist_ok=True)
 
     # Load epochs
@@ -66,6 +85,7 @@ for mode in modes:
     montage_path = "/projects/illinois/ahs/kch/nakhan2/scripts/montage/montageblack.sfp"
     montage = mne.channels.read_custom_montage(montage_path)
     epochs.set_montage(montage)
+    epochs_all = epochs
 
     # Split epochs by mode
     epochs_left = epochs[f"{mode}_left"]
@@ -77,20 +97,39 @@ for mode in modes:
     epochs.apply_proj()
 
     # Compute forward solution
+    fwd_start_time = time.time()
     fwd = mne.make_forward_solution(
         epochs.info, trans=trans, src=src, bem=bem, eeg=True, mindist=5.0, n_jobs=None
     )
 
+    fwd_elapsed_time = time.time() - fwd_start_time
+
     # Adjust EEG channel selection
     picks = mne.pick_types(epochs.info, meg=False, eeg=True, eog=True, stim=False)
 
     # Compute noise covariance
-    noise_cov = mne.compute_covariance(
-        epochs, tmax=0.0, method=["shrunk", "empirical"], rank=None, verbose=True
-    )
+    if args.cov_method == "cv":
+        noise_cov = mne.compute_covariance(
+            epochs, tmax=0.0, method=["shrunk", "empirical"], rank=None, verbose=True
+        )
+    else:
+        # Closed-form estimate on the baseline, computed once for all conditions and cached
+        cov_start_time = time.time()
+        noise_cov = load_or_compute_noise_cov(
+            epochs_all, subject_id, mode, condition_events, cov_dir, input_file, method=args.cov_method, tmax=0.0
+        )
+        cov_elapsed_time = time.time() - cov_start_time
+
+        if args.cov_report:
+            report = compare_to_cross_validated(noise_cov, epochs, tmax=0.0)
+            save_cov_report(os.path.join(cov_dir, f"{subject_id}_{mode}_{args.cov_method}_cov_report.txt"),
+                            args.cov_method, cov_elapsed_time, report)
+    del epochs_all
 
     # Visualize covariance
-    fig_cov, fig_spectra = mne.viz.plot_cov(noise_cov, epochs.info)
+    if args.plot_cov:
+        os.makedirs(cov_dir, exist_ok=True)
+        save_cov_plots(noise_cov, epochs.info, os.path.join(cov_dir, f"{subject_id}_{mode}"))
 
     # Convert forward solution
     mne.convert_forward_solution(fwd, surf_ori=True, copy=False)
@@ -118,8 +157,9 @@ for mode in modes:
     )
 
     # Compute inverse operator
+    inverse_start_time = time.time()
     inv = make_inverse_operator(
-        epochs.info, fwd, noise_cov, fixed=False, loose=0.2, depth=0.8, verbose=True
+        epochs.info, fwd, noise_cov, depth=0.8, verbose=True, **ORIENTATIONS[args.orientation]
     )
 
     # Compute eLORETA inverse solution
@@ -129,12 +169,25 @@ for mode in modes:
         epochs, inv, lambda2, "eLORETA", verbose=True, pick_ori=None
     )
 
+    inverse_elapsed_time = time.time() - inverse_start_time
+
     # Save inverse solutions
     print("Saving inverse solutions...")
 
     subject_dir = os.path.join(output_path, subject_id)
     os.makedirs(subject_dir, exist_ok=True)
 
+    # Record timings so reduced-resolution modes can be compared with the full path
+    with open(f"{subject_dir}/{subject_id}_source_timing.json", "w") as f:
+        json.dump({
+            "spacing": args.spacing,
+            "orientation": args.orientation,
+            "n_sources": int(fwd["nsource"]),
+            "n_epochs": len(stcs),
+            "forward_seconds": fwd_elapsed_time,
+            "inverse_seconds": inverse_elapsed_time,
+        }, f)
+
     for idx, stc in enumerate(stcs):
         inverse_solution_file = f"{subject_dir}/{subject_id}_inversesolution_epoch{idx}.fif"
         stc.save(inverse_solution_file, overwrite=True)
@@ -5,10 +5,15 @@ import numpy as np
 import argparse
 from nilearn import datasets
 import os.path as op
+from source_modes import SPACINGS, ORIENTATIONS, source_tag, get_source_space_file
 
 # Parse command-line argument for subject_id
 parser = argparse.ArgumentParser(description="EEG Source Reconstruction")
 parser.add_argument("--subject_id", type=str, required=True, help="Participant ID")
+parser.add_argument("--spacing", type=str, default="ico5", choices=list(SPACINGS),
+                    help="Source space resolution the STCs were reconstructed on")
+parser.add_argument("--orientation", type=str, default="loose", choices=list(ORIENTATIONS),
+                    help="Source orientation the STCs were reconstructed with")
 args = parser.parse_args()
 subject_id = args.subject_id
 
@@ -24,7 +29,7 @@ fs_dir = mne.datasets.fetch_fsaverage(verbose=True)
 subjects_dir = op.dirname(fs_dir)
 
 # Set paths to the source space and BEM model
-src_file = op.join(fs_dir, "bem", "fsaverage-ico-5-src.fif")
+src_file = get_source_space_file(fs_dir, args.spacing, subjects_dir)
 src = mne.read_source_spaces(src_file)
 
 # Define input and output directories
@@ -33,6 +38,9 @@ files_out = '/projects/illinois/ahs/kch/nakhan2/ACE_RZ/TimeCourses'
 
 os.makedirs(files_out, exist_ok=True)
 
+# Reduced-resolution / fixed-orientation modes live in their own sub-folder
+mode_tag = source_tag(args.spacing, args.orientation)
+
 # Modes to process
 modes = ['congruent', 'incongruent']
 
@@ -44,7 +52,7 @@ for mode in modes:
     print(f"Processing: {subject_id}, {mode}")
 
     # Define directory paths for the current subject and mode
-    directory = op.join(files_in, mode, subject_id)
+    directory = op.join(files_in, mode_tag, mode, subject_id)
     stc_files_lh = glob.glob(op.join(directory, '*lh.stc'))
     stc_files_rh = glob.glob(op.join(directory, '*rh.stc'))
 
@@ -75,7 +83,7 @@ for mode in modes:
     if label_time_courses:
         # Combine all label time courses and save
         label_time_courses_np = np.array(label_time_courses)
-        label_time_courses_file = op.join(files_out, mode, f"{subject_id}_label_time_courses.npy")
+        label_time_courses_file = op.join(files_out, mode_tag, mode, f"{subject_id}_label_time_courses.npy")
         os.makedirs(op.dirname(label_time_courses_file), exist_ok=True)
         np.save(label_time_courses_file, label_time_courses)
 
@@ -0,0 +1,123 @@
+import os
+import json
+import argparse
+import numpy as np
+import os.path as op
+from scipy.signal import hilbert
+from mne_connectivity import symmetric_orth
+from sklearn.preprocessing import StandardScaler
+from sklearn.metrics import adjusted_rand_score
+from hmmlearn import hmm
+from source_modes import SPACINGS, ORIENTATIONS, source_tag
+
+# Compares a reduced-resolution / fixed-orientation source mode against the full ico5/loose path
+# for one subject: Schaefer-100 label time courses, orthogonalized envelopes and HMM features.
+
+parser = argparse.ArgumentParser(description="Source mode speed/accuracy benchmark")
+parser.add_argument("--subject_id", type=str, required=True, help="Participant ID")
+parser.add_argument("--spacing", type=str, default="ico4", choices=list(SPACINGS), help="Fast mode source spacing")
+parser.add_argument("--orientation", type=str, default="fixed", choices=list(ORIENTATIONS), help="Fast mode orientation")
+parser.add_argument("--n_states", type=int, default=16, help="Number of HMM states for the downstream comparison")
+parser.add_argument("--seed", type=int, default=0, help="Random seed for the HMM fits")
+args = parser.parse_args()
+subject_id = args.subject_id
+
+# Define input and output directories (same trees as 2.1-2.3)
+source_dir = '/projects/illinois/ahs/kch/nakhan2/ACE_RZ/Source_Localised_Data'
+timecourses_dir = '/projects/illinois/ahs/kch/nakhan2/ACE_RZ/TimeCourses'
+
+modes = ['congruent', 'incongruent']
+fast_tag = source_tag(args.spacing, args.orientation)
+
+# -------------------- Helper Functions --------------------
+
+def load_timing(mode, tag):
+    """Loads the forward/inverse timings written by the source reconstruction scripts."""
+    timing_file = op.join(source_dir, tag, mode, subject_id, f"{subject_id}_source_timing.json")
+    if not op.exists(timing_file):
+        return None
+    with open(timing_file, "r") as f:
+        return json.load(f)
+
+def per_label_correlation(a, b):
+    """Pearson correlation of each label across all remaining axes, ignoring sign flips."""
+    a = np.moveaxis(a, 1, 0).reshape(a.shape[1], -1)
+    b = np.moveaxis(b, 1, 0).reshape(b.shape[1], -1)
+    a = a - a.mean(axis=1, keepdims=True)
+    b = b - b.mean(axis=1, keepdims=True)
+    denom = np.sqrt(np.sum(a ** 2, axis=1) * np.sum(b ** 2, axis=1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.abs(np.sum(a * b, axis=1) / denom)
+
+def hmm_features(label_time_courses):
+    """Orthogonalized envelope and standardized per-epoch features as used by Step 3."""
+    envelope = np.abs(hilbert(label_time_courses, axis=2))
+    orthogonalized = symmetric_orth(envelope).reshape(envelope.shape)
+    features = StandardScaler().fit_transform(np.mean(orthogonalized, axis=2))
+    return envelope, orthogonalized, features
+
+def fit_states(features):
+    """Fits the Step 3 GaussianHMM and returns the state sequence and fractional occupancy."""
+    model = hmm.GaussianHMM(n_components=args.n_states, n_iter=50, covariance_type='full', tol=1e-7,
+                            params='st', init_params='stmc', random_state=args.seed)
+    model.fit(features)
+    state_sequence = model.predict(features)
+    occupancy = np.bincount(state_sequence, minlength=args.n_states) / len(state_sequence)
+    return state_sequence, occupancy
+
+def summary(values):
+    """Formats median and range of a per-label metric."""
+    return f"median {np.nanmedian(values):.3f} (min {np.nanmin(values):.3f}, max {np.nanmax(values):.3f})"
+
+# -------------------- Benchmark --------------------
+
+report_lines = [f"Subject: {subject_id}", f"Fast mode: {fast_tag} vs full ico5_loose", ""]
+
+for mode in modes:
+    full_file = op.join(timecourses_dir, mode, f"{subject_id}_label_time_courses.npy")
+    fast_file = op.join(timecourses_dir, fast_tag, mode, f"{subject_id}_label_time_courses.npy")
+    if not op.exists(full_file) or not op.exists(fast_file):
+        print(f"Skipping {subject_id} - {mode}: missing {full_file if not op.exists(full_file) else fast_file}")
+        continue
+
+    full_tc = np.load(full_file)
+    fast_tc = np.load(fast_file)
+    if full_tc.shape != fast_tc.shape:
+        print(f"Skipping {subject_id} - {mode}: shape mismatch {full_tc.shape} vs {fast_tc.shape}")
+        continue
+
+    report_lines.append(f"[{mode}]")
+
+    full_timing = load_timing(mode, "")
+    fast_timing = load_timing(mode, fast_tag)
+    if full_timing and fast_timing:
+        full_seconds = full_timing["forward_seconds"] + full_timing["inverse_seconds"]
+        fast_seconds = fast_timing["forward_seconds"] + fast_timing["inverse_seconds"]
+        report_lines.append(f"Sources: {full_timing['n_sources']} -> {fast_timing['n_sources']}")
+        report_lines.append(f"Forward + inverse time (s): {full_seconds:.1f} -> {fast_seconds:.1f} "
+                            f"(speed-up x{full_seconds / max(fast_seconds, 1e-9):.2f})")
+
+    report_lines.append(f"Label time course |r|: {summary(per_label_correlation(full_tc, fast_tc))}")
+
+    full_env, full_orth, full_features = hmm_features(full_tc)
+    fast_env, fast_orth, fast_features = hmm_features(fast_tc)
+    report_lines.append(f"Envelope |r|: {summary(per_label_correlation(full_env, fast_env))}")
+    report_lines.append(f"Orthogonalized envelope |r|: {summary(per_label_correlation(full_orth, fast_orth))}")
+    report_lines.append(f"HMM feature |r|: {summary(per_label_correlation(full_features[:, :, None], fast_features[:, :, None]))}")
+
+    full_states, full_occupancy = fit_states(full_features)
+    fast_states, fast_occupancy = fit_states(fast_features)
+    report_lines.append(f"State sequence adjusted Rand index: {adjusted_rand_score(full_states, fast_states):.3f}")
+    report_lines.append(f"Sorted fractional occupancy max abs diff: "
+                        f"{np.max(np.abs(np.sort(full_occupancy) - np.sort(fast_occupancy))):.3f}")
+    report_lines.append("")
+
+report = "\n".join(report_lines)
+print(report)
+
+report_dir = op.join(timecourses_dir, fast_tag)
+os.makedirs(report_dir, exist_ok=True)
+report_file = op.join(report_dir, f"{subject_id}_benchmark_vs_full.txt")
+with open(report_file, "w") as f:
+    f.write(report + "\n")
+print(f"Benchmark report saved to {report_file}")
@@ -0,0 +1,117 @@
+import os
+import time
+import json
+import numpy as np
+import mne
+import mne.cov
+
+# -------------------- Fast Noise Covariance --------------------
+
+def compute_baseline_covariances(epochs, conditions, method="oas", tmax=0.0):
+    """Computes closed-form (Ledoit-Wolf/OAS) noise covariances per condition from a single baseline crop."""
+    # Crop and reference the baseline window once for every condition in the file
+    baseline = epochs.copy().crop(tmax=tmax)
+    baseline.set_eeg_reference(projection=True)
+    baseline.apply_proj()
+
+    covs = {}
+    for condition, event_names in conditions.items():
+        try:
+            condition_baseline = baseline[event_names]
+        except KeyError as e:
+            print(f"Warning: No baseline epochs for condition {condition}: {e}")
+            continue
+        # A single closed-form method skips the shrinkage grid search and cross-validation
+        covs[condition] = mne.compute_covariance(condition_baseline, method=method, rank=None, verbose=True)
+
+    return covs
+
+def load_or_compute_noise_cov(epochs, subject_id, mode, conditions, cov_dir, source_file, method="oas", tmax=0.0):
+    """Loads the cached fast noise covariance for a mode, computing all conditions once per subject.
+
+    The cache is only used if source_file (the epochs file) has not changed since it was written.
+    """
+    def cov_file(condition):
+        return os.path.join(cov_dir, f"{subject_id}_{condition}_{method}-cov.fif")
+
+    # mtime of the epochs file the cached covariances were computed from
+    source_record = os.path.join(cov_dir, f"{subject_id}_{method}-cov_source.json")
+    source_mtime = os.path.getmtime(source_file)
+
+    if os.path.exists(cov_file(mode)):
+        try:
+            with open(source_record, "r") as f:
+                cached_mtime = json.load(f).get("source_mtime")
+        except (OSError, ValueError):
+            cached_mtime = None
+        if cached_mtime == source_mtime:
+            print(f"Loading cached noise covariance: {cov_file(mode)}")
+            return mne.read_cov(cov_file(mode))
+        print(f"Cached noise covariance {cov_file(mode)} is older than {source_file}, recomputing")
+
+    os.makedirs(cov_dir, exist_ok=True)
+    start_time = time.time()
+    covs = compute_baseline_covariances(epochs, conditions, method=method, tmax=tmax)
+    print(f"Computed {method} noise covariances for {list(covs)} in {time.time() - start_time:.2f} s")
+
+    for condition, cov in covs.items():
+        cov.save(cov_file(condition), overwrite=True)
+    # Recorded after the covariances, so an interrupted save is recomputed next time
+    with open(source_record, "w") as f:
+        json.dump({"source_file": source_file, "source_mtime": source_mtime}, f)
+
+    if mode not in covs:
+        raise ValueError(f"No baseline epochs found for mode {mode}.")
+    return covs[mode]
+
+# -------------------- Accuracy Report --------------------
+
+def compare_to_cross_validated(fast_cov, epochs, tmax=0.0):
+    """Compares a fast noise covariance with the cross-validated shrunk/empirical estimate."""
+    start_time = time.time()
+    cv_cov = mne.compute_covariance(
+        epochs, tmax=tmax, method=["shrunk", "empirical"], rank=None, verbose=False
+    )
+    cv_seconds = time.time() - start_time
+
+    # Whiten the cross-validated estimate with the fast one: eigenvalues close to 1 mean
+    # both estimates whiten the baseline equally well
+    whitener, ch_names, rank = mne.cov.compute_whitener(fast_cov, epochs.info, return_rank=True)
+    cv_picks = [cv_cov.ch_names.index(name) for name in ch_names]
+    fast_picks = [fast_cov.ch_names.index(name) for name in ch_names]
+    cv_data = cv_cov.data[np.ix_(cv_picks, cv_picks)]
+    fast_data = fast_cov.data[np.ix_(fast_picks, fast_picks)]
+
+    whitened = whitener @ cv_data @ whitener.T
+    eigenvalues = np.sort(np.linalg.eigvalsh(whitened))[::-1][:rank]
+
+    return {
+        "cv_seconds": cv_seconds,
+        "relative_frobenius_error": float(np.linalg.norm(fast_data - cv_data) / np.linalg.norm(cv_data)),
+        "whitened_eigenvalue_mean": float(np.mean(eigenvalues)),
+        "whitened_eigenvalue_min": float(np.min(eigenvalues)),
+        "whitened_eigenvalue_max": float(np.max(eigenvalues)),
+        "rank": int(rank),
+    }
+
+def save_cov_report(report_file, method, fast_seconds, report):
+    """Writes the fast vs cross-validated covariance comparison to a text file."""
+    with open(report_file, "w") as f:
+        f.write(f"Fast method: {method}\n")
+        f.write(f"Fast time (s): {fast_seconds:.2f}\n")
+        f.write(f"Cross-validated time (s): {report['cv_seconds']:.2f}\n")
+        f.write(f"Relative Frobenius error: {report['relative_frobenius_error']:.4f}\n")
+        f.write(f"Whitened eigenvalue mean (ideal 1): {report['whitened_eigenvalue_mean']:.4f}\n")
+        f.write(f"Whitened eigenvalue range: {report['whitened_eigenvalue_min']:.4f} - {report['whitened_eigenvalue_max']:.4f}\n")
+        f.write(f"Rank: {report['rank']}\n")
+    print(f"Covariance report saved to {report_file}")
+
+def save_cov_plots(noise_cov, info, plot_stem):
+    """Plots the noise covariance and its spectra and saves both figures."""
+    import matplotlib.pyplot as plt
+
+    fig_cov, fig_spectra = mne.viz.plot_cov(noise_cov, info, show=False)
+    fig_cov.savefig(f"{plot_stem}_cov.png", dpi=150, bbox_inches="tight")
+    fig_spectra.savefig(f"{plot_stem}_cov_spectra.png", dpi=150, bbox_inches="tight")
+    plt.close(fig_cov)
+    plt.close(fig_spectra)
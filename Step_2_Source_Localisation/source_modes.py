@@ -0,0 +1,35 @@
+import os
+import mne
+
+# -------------------- Source Space Resolution & Orientation --------------------
+
+# Source space spacings and the file names they are cached under in fsaverage/bem
+SPACINGS = {
+    "ico5": "ico-5",
+    "ico4": "ico-4",
+    "oct6": "oct-6",
+}
+
+# Inverse operator orientation settings
+ORIENTATIONS = {
+    "loose": {"fixed": False, "loose": 0.2},
+    "fixed": {"fixed": True, "loose": 0.0},
+}
+
+def source_tag(spacing, orientation):
+    """Returns the output sub-folder for a source mode (empty for the full-resolution ico5/loose path)."""
+    if spacing == "ico5" and orientation == "loose":
+        return ""
+    return f"{spacing}_{orientation}"
+
+def get_source_space_file(fs_dir, spacing, subjects_dir):
+    """Returns the fsaverage source space file for a spacing, creating and caching it if missing."""
+    src_file = os.path.join(fs_dir, "bem", f"fsaverage-{SPACINGS[spacing]}-src.fif")
+    if not os.path.exists(src_file):
+        print(f"Setting up {spacing} source space: {src_file}")
+        src = mne.setup_source_space("fsaverage", spacing=spacing, subjects_dir=subjects_dir, add_dist=False)
+        # Write under a per-process name first so concurrent subject jobs never read a partial file
+        tmp_file = src_file.replace("-src.fif", f"-tmp{os.getpid()}-src.fif")
+        mne.write_source_spaces(tmp_file, src, overwrite=True)
+        os.replace(tmp_file, src_file)
+    return src_file
@@ -2,97 +2,214 @@ import os
 import sys
 import time
 import json
+import argparse
 import numpy as np
-import networkx as nx
+from concurrent.futures import ProcessPoolExecutor
 from numba import njit
 from scipy import stats
+from connectivity_store import load_block_correlations, block_keys, unpack_matrices, store_fingerprint
+from edge_summaries import (empty_summary, merge_summaries, summarize_triangles, summary_percentile,
+                            summary_bootstrap_median, summary_objective, save_summary, load_summary)
 
 # -------------------- Load Correlation Matrices --------------------
 
-def load_all_correlation_matrices(base_dir, participants, modes):
-    """Loads all correlation matrices with checks for out-of-bounds values."""
-    all_matrices = []
+def load_all_correlation_triangles(base_dir, participants, modes):
+    """Loads all correlation matrices, as one stacked (N x n_pairs) array of upper triangles, with checks for out-of-bounds values."""
+    all_triangles = []
     total_participants = len(participants)
     out_of_bounds_count = 0
 
     for idx, participant in enumerate(participants):
         participant_dir = os.path.join(base_dir, participant)
         for mode in modes:
-            mode_dir = os.path.join(participant_dir, "Correlation_matrices")
-            
-            filepath = os.path.join(mode_dir, f"{participant}_{mode}_correlation_matrices.npy.npz")
-            
-            if os.path.exists(filepath):
-                try:
-                    data = np.load(filepath, allow_pickle=True)
-                    for key in data.files:
-                        matrix = data[key]
-                        if matrix.ndim == 2:
-                            if np.any(matrix < -1) or np.any(matrix > 1):
-                                out_of_bounds_count += 1
-                                print(f"Out-of-bounds values found in {filepath}, key {key}. "
-                                      f"Min: {np.min(matrix)}, Max: {np.max(matrix)}")
-                            all_matrices.append(matrix)
-                        else:
-                            print(f"Skipping non-2D matrix in {filepath}, key {key}.")
-                except Exception as e:
-                    print(f"Error loading {filepath}: {e}")
+            try:
+                loaded = load_block_correlations(participant_dir, participant, mode)
+                if loaded is not None:
+                    block_index, triangles = loaded
+                    out_of_bounds = np.any((triangles < -1) | (triangles > 1), axis=1)
+                    for (state, block), triangle in zip(block_keys(block_index[out_of_bounds]), triangles[out_of_bounds]):
+                        print(f"Out-of-bounds values found for {participant}, mode {mode}, key {state}_{block}. "
+                              f"Min: {np.min(triangle)}, Max: {np.max(triangle)}")
+                    out_of_bounds_count += int(np.sum(out_of_bounds))
+                    all_triangles.append(np.asarray(triangles))
+            except Exception as e:
+                print(f"Error loading correlation matrices for {participant}, mode {mode}: {e}")
 
         sys.stdout.write(f"\rProcessed {idx + 1}/{total_participants} participants "
                          f"({(idx + 1) / total_participants * 100:.2f}%)")
         sys.stdout.flush()
 
-    print(f"\nTotal matrices loaded: {len(all_matrices)}")
-    print(f"Number of out-of-bounds matrices: {out_of_bounds_count / max(1, len(all_matrices)) * 100:.2f}%")
-    return all_matrices
+    all_triangles = np.concatenate(all_triangles) if all_triangles else np.empty((0, 0), dtype=np.float32)
+    print(f"\nTotal matrices loaded: {len(all_triangles)}")
+    print(f"Number of out-of-bounds matrices: {out_of_bounds_count / max(1, len(all_triangles)) * 100:.2f}%")
+    return all_triangles
+
+def participant_edge_summary(base_dir, participant, mode, state_dir=None, reuse=False, chunk_matrices=500):
+    """Edge summary of one participant and mode, one chunk of matrices at a time, or None if none are stored.
+
+    With a state_dir the summary is saved there with its source fingerprint; with reuse, a saved
+    summary whose fingerprint still matches is returned instead of reading the matrices. Returns
+    (summary, reused).
+    """
+    participant_dir = os.path.join(base_dir, participant)
+    fingerprint = store_fingerprint(participant_dir, participant, mode)
+    if fingerprint is None:
+        return None, False
+    summary_file = os.path.join(state_dir, f"{participant}_{mode}_edge_summary.npz") if state_dir else None
+    if reuse and summary_file is not None and os.path.exists(summary_file):
+        saved, saved_fingerprint = load_summary(summary_file)
+        if saved is not None and saved_fingerprint == fingerprint:
+            return saved, True
+
+    _, triangles = load_block_correlations(participant_dir, participant, mode)
+    summary = empty_summary()
+    for start in range(0, len(triangles), chunk_matrices):
+        summary = merge_summaries(summary, summarize_triangles(triangles[start:start + chunk_matrices]))
+    if summary_file is not None:
+        save_summary(summary_file, summary, fingerprint)
+    return summary, False
+
+def stream_edge_summary(base_dir, participants, modes, state_dir=None, reuse=False):
+    """Cohort edge-weight summary (edge_summaries.py), reading one participant and mode at a time.
+
+    Per-participant summaries are kept in state_dir if given, and with reuse only new or changed
+    participants are read again (see participant_edge_summary).
+    """
+    summary = empty_summary()
+    total_participants = len(participants)
+    reused_count = 0
+    summarized_count = 0
 
-# -------------------- Optimal Alpha Calculation --------------------
+    for idx, participant in enumerate(participants):
+        for mode in modes:
+            try:
+                participant_summary, reused = participant_edge_summary(base_dir, participant, mode, state_dir, reuse)
+                if participant_summary is not None:
+                    summary = merge_summaries(summary, participant_summary)
+                    reused_count += reused
+                    summarized_count += not reused
+            except Exception as e:
+                print(f"Error loading correlation matrices for {participant}, mode {mode}: {e}")
 
-def determine_optimal_alpha(all_matrices):
-    print("Converting correlation matrices to NetworkX graphs...")
-    windowed_graphs = []
-    total_matrices = len(all_matrices)
-    for i, matrix in enumerate(all_matrices):
-        try:
-            windowed_graphs.append(nx.from_numpy_array(matrix))
-            # Update progress every 10%
-            print(f"Converting matrix {i + 1}/{total_matrices} to graph ({(i + 1) / total_matrices * 100:.2f}%)", end='\r')
-        except Exception as e:
-            print(f"Skipping matrix {i + 1}/{total_matrices} due to error: {e}")
-    print(f"\nGraph conversion completed. Total graphs converted: {len(windowed_graphs)}")
-    return aggregated_bootstrapping_and_alpha_threshold(windowed_graphs)
+        sys.stdout.write(f"\rProcessed {idx + 1}/{total_participants} participants "
+                         f"({(idx + 1) / total_participants * 100:.2f}%)")
+        sys.stdout.flush()
 
-@njit
-def test_alpha_numba(threshold_array, alpha):
-    """Checks the proportion of edges that exceed the alpha threshold."""
-    row_indices, col_indices = np.where(threshold_array >= alpha)
-    valid_connections = np.extract(threshold_array >= alpha, threshold_array)
-    return np.sum(valid_connections) / valid_connections.size if valid_connections.size > 0 else 0
+    print(f"\nTotal matrices summarized: {summary['n_matrices']} "
+          f"({summarized_count} participant modes read, {reused_count} reused from saved state)")
+    print(f"Number of out-of-bounds matrices: {summary['n_out_of_bounds'] / max(1, summary['n_matrices']) * 100:.2f}%")
+    return summary
+
+# -------------------- Edge Weights --------------------
+
+# The alpha search used to build a NetworkX graph per matrix (nx.from_numpy_array), read its edge
+# weights back with G.edges(data=True) and convert it back again with nx.to_numpy_array. The same
+# quantities come straight from the stacked upper triangles:
+# * a graph's edges are the non-zero entries of the upper triangle *including* the diagonal (the
+#   unit self-loops), in row-major order, so the aggregated weights below are identical, in order;
+# * the graph's adjacency matrix is the symmetric matrix itself, so a per-matrix mean over the full
+#   matrix is a weighted mean of its off-diagonal pairs (counted twice) and its diagonal.
+
+def edge_weights(all_triangles, diagonal=1.0):
+    """Edge weights of every matrix's graph, concatenated in the order NetworkX enumerated them."""
+    n_matrices, n_pairs = all_triangles.shape
+    n_parcels = int(round((1 + np.sqrt(1 + 8 * n_pairs)) / 2))
+    # Positions of the diagonal within each row-major upper triangle that includes it
+    diagonal_positions = np.cumsum(np.concatenate([[0], np.arange(n_parcels, 1, -1)]))
+    off_diagonal = np.ones(n_pairs + n_parcels, dtype=bool)
+    off_diagonal[diagonal_positions] = False
+
+    weights = np.empty((n_matrices, n_pairs + n_parcels))
+    weights[:, diagonal_positions] = diagonal
+    weights[:, off_diagonal] = all_triangles
+    return weights[weights != 0]
+
+# Golden-section steps only ever ask "which squared weights are >= alpha", so each matrix's squared
+# normalized weights are sorted once, with suffix sums alongside. Any objective evaluation is then a
+# binary search per matrix (O(N log n_pairs)) instead of a scan over every edge of every matrix.
+
+def sorted_threshold_index(squared_triangles):
+    """Row-sorted squared weights (NaNs last), their suffix sums (N x n_pairs + 1) and per-row non-NaN counts."""
+    sorted_weights = np.sort(squared_triangles, axis=1)
+    n_valid = np.sum(~np.isnan(sorted_weights), axis=1)
+    suffix_sums = np.zeros((sorted_weights.shape[0], sorted_weights.shape[1] + 1))
+    suffix_sums[:, :-1] = np.cumsum(np.nan_to_num(sorted_weights)[:, ::-1], axis=1)[:, ::-1]
+    return sorted_weights, suffix_sums, n_valid
+
+@njit(cache=True)
+def threshold_objective(sorted_weights, suffix_sums, n_valid, squared_diagonal, n_parcels, alpha):
+    """Mean over matrices of the mean full-matrix squared normalized weight at or above alpha (0 if none).
+
+    Off-diagonal pairs count twice (both triangles of the symmetric matrix), the diagonal once.
+    """
+    diagonal_count = n_parcels if squared_diagonal >= alpha else 0
+    total = 0.0
+    for m in range(sorted_weights.shape[0]):
+        # First position in the row with a weight >= alpha
+        low, high = 0, n_valid[m]
+        while low < high:
+            middle = (low + high) // 2
+            if sorted_weights[m, middle] < alpha:
+                low = middle + 1
+            else:
+                high = middle
+        count = 2 * (n_valid[m] - low) + diagonal_count
+        if count > 0:
+            total += (2 * suffix_sums[m, low] + diagonal_count * squared_diagonal) / count
+    return total / sorted_weights.shape[0]
 
-def test_alpha_numba_wrapper(threshold_array, alpha): 
-    result = test_alpha_numba(threshold_array, alpha)
-    return result
+# -------------------- Optimal Alpha Calculation --------------------
 
-def aggregated_bootstrapping_and_alpha_threshold(windowed_graphs, num_iterations=10000, num_alphas=100):
-    if not windowed_graphs:
-        raise ValueError("No valid graphs found for processing.")
-    
-    print("Starting aggregation of edge weights from all windowed graphs...")
-    all_edge_weights = []
-    total_graphs = len(windowed_graphs)
-    edge_count = 0
-
-    for i, G in enumerate(windowed_graphs):
-        graph_edge_weights = [data['weight'] for _, _, data in G.edges(data=True)]
-        all_edge_weights.extend(graph_edge_weights)
-        edge_count += len(graph_edge_weights)
-        print(f"Aggregating edge weights progress: {i + 1}/{total_graphs} ({(i + 1) / total_graphs * 100:.2f}%)", end='\r')
-        sys.stdout.flush()
+def determine_optimal_alpha(all_triangles, num_iterations=10000, bootstrap="loop", n_jobs=1, seed=None, bootstrap_positions=None):
+    if len(all_triangles) == 0:
+        raise ValueError("No valid correlation matrices found for processing.")
 
-    all_edge_weights = np.array(all_edge_weights)
-    print(f"\nTotal number of edge weights aggregated: {edge_count}")
+    print("Starting aggregation of edge weights from all correlation matrices...")
+    all_edge_weights = edge_weights(all_triangles)
+    print(f"Total number of edge weights aggregated: {len(all_edge_weights)}")
     print("Aggregation of edge weights completed.")
 
+    if bootstrap == "batched":
+        bootstrap_median = batched_bootstrap_median(all_edge_weights, num_iterations, n_jobs, seed, bootstrap_positions)
+    elif bootstrap == "analytic":
+        bootstrap_median = analytic_bootstrap_median(all_edge_weights, num_iterations)
+    else:
+        bootstrap_median = bootstrap_edge_median(all_edge_weights, num_iterations)
+
+    alpha_start = np.percentile(all_edge_weights, 5) / bootstrap_median
+    alpha_end = np.percentile(all_edge_weights, 95) / bootstrap_median
+
+    # Squared normalized weights of the stacked triangles (and the shared diagonal) for the objective
+    print("Pre-calculating threshold arrays...")
+    n_parcels = int(round((1 + np.sqrt(1 + 8 * all_triangles.shape[1])) / 2))
+    sorted_weights, suffix_sums, n_valid = sorted_threshold_index((all_triangles.astype(np.float64) / bootstrap_median) ** 2)
+    squared_diagonal = (1.0 / bootstrap_median) ** 2
+
+    optimal_alpha = golden_section_alpha(
+        lambda alpha: threshold_objective(sorted_weights, suffix_sums, n_valid, squared_diagonal, n_parcels, alpha),
+        alpha_start, alpha_end)
+    return optimal_alpha, bootstrap_median
+
+def determine_optimal_alpha_from_summary(summary, num_iterations=10000):
+    """determine_optimal_alpha on a streamed cohort summary, with the analytic bootstrap median."""
+    if summary["n_matrices"] == 0:
+        raise ValueError("No valid correlation matrices found for processing.")
+    print(f"Total number of edge weights summarized: {summary['count']}")
+
+    bootstrap_median = summary_bootstrap_median(summary, num_iterations)
+    print(f"Analytic bootstrap median: {bootstrap_median:.6f}")
+
+    alpha_start = summary_percentile(summary, 5) / bootstrap_median
+    alpha_end = summary_percentile(summary, 95) / bootstrap_median
+
+    optimal_alpha = golden_section_alpha(lambda alpha: summary_objective(summary, bootstrap_median, alpha), alpha_start, alpha_end)
+    return optimal_alpha, bootstrap_median
+
+def bootstrap_edge_median(all_edge_weights, num_iterations=10000):
+    """Median over edges of the mean of num_iterations bootstrap resamples of the aggregated edge weights."""
+    if len(all_edge_weights) == 0:
+        raise ValueError("No edge weights found for bootstrapping.")
+
     print("Starting bootstrapping on aggregated edge weights...")
     bootstrap_weights = np.zeros_like(all_edge_weights)
     for i in range(num_iterations):
@@ -103,20 +220,85 @@ def aggregated_bootstrapping_and_alpha_threshold(windowed_graphs, num_iterations
             print(f"Bootstrapping progress: {i + 1}/{num_iterations} ({(i + 1) / num_iterations * 100:.2f}%)", end='\r')
     bootstrap_median = np.median(bootstrap_weights / num_iterations)
     print("\nBootstrapping completed.")
+    return bootstrap_median
+
+# The loop above gives every edge position the mean of num_iterations independent draws from the
+# aggregated weights, and takes the median over positions. The same statistic is computed faster by:
+# * "batched": positions are split into chunks that draw all their iterations in (iterations x
+#   positions) batches, run in parallel, each chunk with its own SeedSequence stream, so results
+#   are reproducible for a seed whatever the number of workers. Simulating every edge position
+#   costs as much as the loop (iterations x edges draws), so only DEFAULT_BOOTSTRAP_POSITIONS
+#   positions are simulated unless bootstrap_positions asks for more; the median of a million means
+#   already estimates the median of their distribution far below the precision the threshold needs.
+# * "analytic": the positions' means are i.i.d. with mean mu, standard deviation sigma / sqrt(B) and
+#   skewness gamma / sqrt(B), so with hundreds of millions of positions their median is the median
+#   of that distribution, mu - gamma * sigma / (6 * B) to second order (Cornish-Fisher), computed
+#   from three moments of the weights in one pass.
+
+DEFAULT_BOOTSTRAP_POSITIONS = 1_000_000
+
+_bootstrap_weights = None
+
+def init_bootstrap_worker(all_edge_weights):
+    """Shares the aggregated edge weights with a bootstrap worker process."""
+    global _bootstrap_weights
+    _bootstrap_weights = all_edge_weights
+
+def bootstrap_chunk(n_positions, num_iterations, seed_sequence, batch_elements=10_000_000):
+    """Means of num_iterations resampled weights for n_positions positions, drawn from one RNG stream."""
+    rng = np.random.default_rng(seed_sequence)
+    n_weights = len(_bootstrap_weights)
+    sums = np.zeros(n_positions)
+    iterations_per_batch = max(1, batch_elements // n_positions)
+    for start in range(0, num_iterations, iterations_per_batch):
+        size = min(iterations_per_batch, num_iterations - start)
+        sums += _bootstrap_weights[rng.integers(0, n_weights, size=(size, n_positions))].sum(axis=0)
+    return sums / num_iterations
+
+def batched_bootstrap_median(all_edge_weights, num_iterations=10000, n_jobs=1, seed=None, n_positions=None,
+                             chunk_positions=100_000):
+    """The bootstrap median with chunked, batched draws over parallel workers and per-chunk RNG streams."""
+    if len(all_edge_weights) == 0:
+        raise ValueError("No edge weights found for bootstrapping.")
+    n_positions = min(DEFAULT_BOOTSTRAP_POSITIONS if n_positions is None else n_positions, len(all_edge_weights))
+    seed_sequence = np.random.SeedSequence(seed)
+    print(f"Starting batched bootstrapping of {n_positions} positions on {n_jobs} workers (seed entropy {seed_sequence.entropy})...")
+
+    chunk_sizes = [min(chunk_positions, n_positions - start) for start in range(0, n_positions, chunk_positions)]
+    streams = seed_sequence.spawn(len(chunk_sizes))
+    means = []
+    if n_jobs == 1:
+        init_bootstrap_worker(all_edge_weights)
+        chunk_results = map(bootstrap_chunk, chunk_sizes, [num_iterations] * len(chunk_sizes), streams)
+        for i, chunk_means in enumerate(chunk_results):
+            means.append(chunk_means)
+            print(f"Bootstrapping progress: {i + 1}/{len(chunk_sizes)} chunks ({(i + 1) / len(chunk_sizes) * 100:.2f}%)", end='\r')
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_bootstrap_worker, initargs=(all_edge_weights,)) as executor:
+            chunk_results = executor.map(bootstrap_chunk, chunk_sizes, [num_iterations] * len(chunk_sizes), streams)
+            for i, chunk_means in enumerate(chunk_results):
+                means.append(chunk_means)
+                print(f"Bootstrapping progress: {i + 1}/{len(chunk_sizes)} chunks ({(i + 1) / len(chunk_sizes) * 100:.2f}%)", end='\r')
+    bootstrap_median = np.median(np.concatenate(means))
+    print("\nBootstrapping completed.")
+    return bootstrap_median
 
+def analytic_bootstrap_median(all_edge_weights, num_iterations=10000):
+    """Second-order (Cornish-Fisher) median of the mean of num_iterations resampled weights."""
     if len(all_edge_weights) == 0:
         raise ValueError("No edge weights found for bootstrapping.")
-    
-    alpha_start = np.percentile(all_edge_weights, 5) / bootstrap_median
-    alpha_end = np.percentile(all_edge_weights, 95) / bootstrap_median
-    
-    # Pre-calculate threshold arrays here (after bootstrap_median is calculated)
-    print("Pre-calculating threshold arrays...")
-    threshold_arrays = []
-    for G in windowed_graphs:
-        connectivity_array = np.asarray(nx.to_numpy_array(G))
-        threshold_arrays.append((connectivity_array / bootstrap_median) ** 2)
-    
+    mean = np.mean(all_edge_weights)
+    centred = all_edge_weights - mean
+    variance = np.mean(centred ** 2)
+    if variance == 0:
+        return mean
+    skewness = np.mean(centred ** 3) / variance ** 1.5
+    bootstrap_median = mean - skewness * np.sqrt(variance) / (6 * num_iterations)
+    print(f"Analytic bootstrap median: mean {mean:.6f}, sd {np.sqrt(variance):.6f}, skewness {skewness:.4f}")
+    return bootstrap_median
+
+def golden_section_alpha(objective, alpha_start, alpha_end):
+    """Golden-section search for alpha, stopping once the bracket has collapsed and f(c), f(d) no longer differ."""
     print("Starting golden-section search for optimal alpha...")
     gr = (np.sqrt(5) + 1) / 2
     c = alpha_end - (alpha_end - alpha_start) / gr
@@ -128,9 +310,8 @@ def aggregated_bootstrapping_and_alpha_threshold(windowed_graphs, num_iterations
     fd_values = []
     while True:
         iteration_count += 1
-        # Calculation using pre-calculated arrays
-        fc = np.mean([test_alpha_numba_wrapper(arr, c) for arr in threshold_arrays])
-        fd = np.mean([test_alpha_numba_wrapper(arr, d) for arr in threshold_arrays])
+        fc = objective(c)
+        fd = objective(d)
         alpha_values.append((c + d) / 2)
         fc_values.append(fc)
         fd_values.append(fd)
@@ -156,8 +337,59 @@ def aggregated_bootstrapping_and_alpha_threshold(windowed_graphs, num_iterations
     optimal_alpha = np.median(alpha_values)
     print(f"\nOptimal alpha determined: {optimal_alpha:.4f}")
     print("\nTesting completed")
+    return optimal_alpha
+
+# -------------------- NetworkX Reference (--benchmark) --------------------
+
+@njit
+def test_alpha_numba(threshold_array, alpha):
+    """Checks the proportion of edges that exceed the alpha threshold."""
+    row_indices, col_indices = np.where(threshold_array >= alpha)
+    valid_connections = np.extract(threshold_array >= alpha, threshold_array)
+    return np.sum(valid_connections) / valid_connections.size if valid_connections.size > 0 else 0
+
+def networkx_optimal_alpha(all_matrices, num_iterations=10000):
+    """The original NetworkX round-trip, kept to benchmark and check determine_optimal_alpha against."""
+    import networkx as nx
+
+    windowed_graphs = [nx.from_numpy_array(matrix) for matrix in all_matrices]
+    all_edge_weights = []
+    for G in windowed_graphs:
+        all_edge_weights.extend([data['weight'] for _, _, data in G.edges(data=True)])
+    all_edge_weights = np.array(all_edge_weights)
+
+    bootstrap_median = bootstrap_edge_median(all_edge_weights, num_iterations)
+
+    alpha_start = np.percentile(all_edge_weights, 5) / bootstrap_median
+    alpha_end = np.percentile(all_edge_weights, 95) / bootstrap_median
+    threshold_arrays = [(np.asarray(nx.to_numpy_array(G)) / bootstrap_median) ** 2 for G in windowed_graphs]
+
+    optimal_alpha = golden_section_alpha(
+        lambda alpha: np.mean([test_alpha_numba(arr, alpha) for arr in threshold_arrays]), alpha_start, alpha_end)
     return optimal_alpha, bootstrap_median
 
+def benchmark(all_triangles, n_matrices, num_iterations, seed=0):
+    """Times the NetworkX round-trip against the stacked-array alpha search on the first n_matrices matrices."""
+    triangles = all_triangles[:n_matrices]
+    matrices = unpack_matrices(triangles)
+
+    np.random.seed(seed)
+    start = time.time()
+    networkx_alpha, networkx_median = networkx_optimal_alpha(matrices, num_iterations)
+    networkx_seconds = time.time() - start
+
+    np.random.seed(seed)
+    start = time.time()
+    array_alpha, array_median = determine_optimal_alpha(triangles, num_iterations)
+    array_seconds = time.time() - start
+
+    print(f"\nBenchmark on {len(triangles)} matrices, {num_iterations} bootstrap iterations:")
+    print(f"  NetworkX:      {networkx_seconds:.2f} s  alpha {networkx_alpha:.6f}  median {networkx_median:.6f}")
+    print(f"  Stacked array: {array_seconds:.2f} s  alpha {array_alpha:.6f}  median {array_median:.6f}")
+    print(f"  Speed-up: {networkx_seconds / array_seconds:.1f}x  "
+          f"Identical median: {networkx_median == array_median}  "
+          f"Alpha difference: {abs(networkx_alpha - array_alpha):.2e}")
+
 # -------------------- Save Alpha & Median --------------------
 
 def save_alpha_and_median(base_dir, optimal_alpha, bootstrap_median):
@@ -173,26 +405,60 @@ def save_alpha_and_median(base_dir, optimal_alpha, bootstrap_median):
 
 # -------------------- Main Execution --------------------
 
-start_time = time.time()
-
-# Base directory and participant list
-base_dir = "/projects/illinois/ahs/kch/nakhan2/ACE/HMM_Output"
-modes = ["congruent", "incongruent"]
-participants = [p for p in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, p))]
-
-print(f"Processing {len(participants)} participants...")
-
-
-
-print("Loading correlation matrices...")
-all_matrices = load_all_correlation_matrices(base_dir, participants, modes)
-
+def main():
+    parser = argparse.ArgumentParser(description="Optimal alpha and bootstrap median over all state-block correlation matrices")
+    parser.add_argument("--bootstrap", choices=["loop", "batched", "analytic"], default="loop",
+                        help="Bootstrap median engine: the original per-iteration loop, chunked parallel draws over a subsample "
+                             "of positions, or the analytic median")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Worker processes for --bootstrap batched")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for --bootstrap batched (reproducible for any --n_jobs)")
+    parser.add_argument("--bootstrap_positions", type=int, default=None,
+                        help="Positions simulated by --bootstrap batched (default: 1,000,000; a value of at least the number of "
+                             "edge weights simulates one per edge as the loop does, at the loop's cost)")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Read participants one at a time into mergeable summaries (flat memory; implies the analytic bootstrap median)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="As --streaming, but reuse the saved summaries of participants whose matrices have not changed")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Compare the original NetworkX round-trip with the stacked-array search instead of saving results")
+    parser.add_argument("--benchmark_matrices", type=int, default=500, help="Number of matrices to benchmark on")
+    parser.add_argument("--benchmark_iterations", type=int, default=100, help="Bootstrap iterations for the benchmark")
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    # Base directory and participant list
+    base_dir = "/projects/illinois/ahs/kch/nakhan2/ACE/HMM_Output"
+    modes = ["congruent", "incongruent"]
+    # Per-participant edge summaries of --streaming / --incremental runs, kept next to alpha_and_median.json
+    state_dir = os.path.join(base_dir, "alpha_and_median_state")
+    participants = [p for p in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, p)) and not p.startswith("alpha")]
+
+    print(f"Processing {len(participants)} participants...")
+
+    if args.streaming or args.incremental:
+        print("Streaming correlation matrices into cohort summaries...")
+        summary = stream_edge_summary(base_dir, participants, modes, state_dir, reuse=args.incremental)
+
+        print("Determining optimal alpha value...")
+        optimal_alpha, bootstrap_median = determine_optimal_alpha_from_summary(summary)
+        save_alpha_and_median(base_dir, optimal_alpha, bootstrap_median)
+    else:
+        print("Loading correlation matrices...")
+        all_triangles = load_all_correlation_triangles(base_dir, participants, modes)
+
+        if args.benchmark:
+            benchmark(all_triangles, args.benchmark_matrices, args.benchmark_iterations)
+        else:
+            print("Determining optimal alpha value...")
+            optimal_alpha, bootstrap_median = determine_optimal_alpha(all_triangles, bootstrap=args.bootstrap, n_jobs=args.n_jobs,
+                                                                      seed=args.seed, bootstrap_positions=args.bootstrap_positions)
 
-print("Determining optimal alpha value...")
-optimal_alpha, bootstrap_median = determine_optimal_alpha(all_matrices)
+            # Save results for each participant
+            save_alpha_and_median(base_dir, optimal_alpha, bootstrap_median)
 
-    # Save results for each participant
-save_alpha_and_median(base_dir, optimal_alpha, bootstrap_median)
+    elapsed_time_minutes = (time.time() - start_time) / 60
+    print(f"\nTotal processing time: {elapsed_time_minutes:.2f} minutes.")
 
-elapsed_time_minutes = (time.time() - start_time) / 60
-print(f"\nTotal processing time: {elapsed_time_minutes:.2f} minutes.")
+if __name__ == "__main__":
+    main()
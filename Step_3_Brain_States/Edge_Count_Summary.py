@@ -2,15 +2,18 @@ import os
 import numpy as np
 import time
 import sys
+from connectivity_store import (has_block_correlations, load_block_correlations, block_keys, has_thresholded_edges,
+                                load_thresholded_edges, edge_counts)
 # -------------------- Load Processed Data --------------------
 
 def load_thresholded_data(base_dir, participants):
-    """Loads thresholded and correlation matrices for each participant."""
+    """Loads per-block edge counts of the correlation and thresholded matrices for each participant."""
     participants_data = {}
 
     for participant in participants:
-        participant_dir = os.path.join(base_dir, participant, "Thresholded_matrices")
-        correlation_dir = os.path.join(base_dir, participant, "Correlation_matrices")
+        participant_path = os.path.join(base_dir, participant)
+        participant_dir = os.path.join(participant_path, "Thresholded_matrices")
+        correlation_dir = os.path.join(participant_path, "Correlation_matrices")
 
         if not os.path.exists(participant_dir):
             print(f" Skipping {participant}: No 'Thresholded_matrices' folder found.")
@@ -22,33 +25,25 @@ def load_thresholded_data(base_dir, participants):
         results = {}
 
         for mode in ["congruent", "incongruent"]:
-            mode_thresholded = os.path.join(participant_dir, mode)
-            mode_correlation = os.path.join(correlation_dir, f"{participant}_{mode}_correlation_matrices.npy.npz")  # ✅ Updated to match your format
-
-            if not os.path.exists(mode_correlation):
-                print(f"⚠️  Missing correlation file: {mode_correlation}")
-                continue
-            if not os.path.exists(mode_thresholded):
-                print(f"⚠️  Missing thresholded folder: {mode_thresholded}")
+            if not has_block_correlations(participant_path, participant, mode):
+                print(f"⚠️  Missing correlation matrices: {participant} - {mode}")
                 continue
-
-            thresholded_file = os.path.join(mode_thresholded, f"{participant}_{mode}_thresholded_matrices.npz")
-            if not os.path.exists(thresholded_file):
-                print(f"⚠️  Missing thresholded file: {thresholded_file}")
+            if not has_thresholded_edges(participant_path, participant, mode):
+                print(f"⚠️  Missing thresholded matrices: {participant} - {mode}")
                 continue
 
             try:
-                # ✅ Load correlation matrices (from .npy.npz)
-                correlation_data = np.load(mode_correlation)
-                correlation_matrices = {tuple(map(int, key.split('_'))): correlation_data[key] for key in correlation_data.files}
+                # ✅ Non-zero upper-triangle entries of the correlation matrices (from the block correlation store)
+                block_index, triangles = load_block_correlations(participant_path, participant, mode)
+                correlation_edge_counts = dict(zip(block_keys(block_index), np.count_nonzero(triangles, axis=1).tolist()))
 
-                # ✅ Load thresholded matrices (from .npz)
-                thresholded_data = np.load(thresholded_file)
-                thresholded_matrices = {tuple(map(int, key.split('_'))): thresholded_data[key] for key in thresholded_data.files}
+                # ✅ Surviving edges of the thresholded matrices, read straight from the sparse index
+                edges = load_thresholded_edges(participant_path, participant, mode)
+                thresholded_edge_counts = dict(zip(block_keys(edges["block_index"]), edge_counts(edges).tolist()))
 
                 results[mode] = {
-                    "correlation_matrices": correlation_matrices,
-                    "thresholded_matrices": thresholded_matrices
+                    "correlation_edge_counts": correlation_edge_counts,
+                    "thresholded_edge_counts": thresholded_edge_counts
                 }
             except Exception as e:
                 print(f"🚨 Error loading data for {participant} - {mode}: {e}")
@@ -74,19 +69,6 @@ if not participants_data:
 
 # -------------------- EDGE COUNT SUMMARY --------------------
 
-from numba import njit
-
-@njit
-def count_edges(matrix):
-    """Counts the non-zero entries in the matrix that represent edges."""
-    count = 0
-    size = matrix.shape[0]
-    for i in range(size):
-        for j in range(i + 1, size):  # Only count each edge once in an undirected graph
-            if matrix[i, j] != 0:
-                count += 1
-    return count
-
 # Initialize counters
 total_unthresholded_edges = 0
 total_thresholded_edges = 0
@@ -99,7 +81,7 @@ print("\nProcessing edge count summary...\n")
 
 for idx, participant in enumerate(sorted(participants_data.keys())):
     data = participants_data[participant]
-    processed_modes = [mode for mode, results in data.items() if 'correlation_matrices' in results and 'thresholded_matrices' in results]
+    processed_modes = [mode for mode, results in data.items() if 'correlation_edge_counts' in results and 'thresholded_edge_counts' in results]
 
     if not processed_modes:
         no_modes_processed.append(participant)
@@ -112,9 +94,9 @@ for idx, participant in enumerate(sorted(participants_data.keys())):
             results = data[mode]
             unthresholded_graph_edges = 0
             thresholded_graph_edges = 0
-            for key, corr_matrix in results['correlation_matrices'].items():
-                unthresholded_graph_edges += count_edges(corr_matrix)
-                thresholded_graph_edges += count_edges(results['thresholded_matrices'][key])
+            for key, edge_count in results['correlation_edge_counts'].items():
+                unthresholded_graph_edges += edge_count
+                thresholded_graph_edges += results['thresholded_edge_counts'][key]
 
             # Update total counts for the participant in each mode
             total_unthresholded_edges += unthresholded_graph_edges
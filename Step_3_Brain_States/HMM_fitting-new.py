@@ -7,26 +7,36 @@ import scipy.stats as stats
 import time
 import sys
 import json
-import time
+import argparse
 import networkx as nx
 from numba import njit
 from scipy import stats
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from threadpoolctl import threadpool_limits
+from hmm_models import save_hmm_model, load_hmm_model, standardize
+from fast_hmm import gaussian_hmm
+from hmm_features import temporal_features
+from state_connectivity import state_blocks, block_correlations
+from connectivity_store import save_block_correlations, has_block_correlations
 
 base_dir = "/projects/illinois/ahs/kch/nakhan2/ACE_XZ/Orthogonalized_data"
-
-participants = [p for p in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, p))]
+base_output_dir = '/projects/illinois/ahs/kch/nakhan2/ACE_XZ/HMM_Output'
+group_output_dir = base_output_dir + "_Group"
 
 modes = ['congruent', 'incongruent']
 
-total_participants = len(participants) * len(modes)
-current_count = 0
-start_time = time.time()
 #change the number of optimal median states based on dataset (depends on pervious script-see notes)
 #NURISH
 #median_optimal_state = 13
 #ACE_XZ
 median_optimal_state = 16
 
+# HMM engine for the fits: "hmmlearn" or "fast" (fast_hmm.FastGaussianHMM), set from --engine
+engine = "hmmlearn"
+# Restarts per participant fit and their base seed, set from --n_restarts / --seed
+n_restarts = 1
+seed = 0
+
 def check_correlation_range(corr_matrix):
     """Check if the correlation matrix values are within the range [-1, 1]."""
     if np.any(corr_matrix < -1) or np.any(corr_matrix > 1):
@@ -43,180 +53,438 @@ def validate_data(data, context):
         raise ValueError(f"Infinite values encountered in {context}.")
     return data
 
-# Uncomment if troubleshooting is needed
-# Initialize counters for empty data cases
-# total_initial_empty_cases = 0
-# total_replaced_empty_cases = 0
-# total_remaining_empty_cases = 0
-
-for participant in participants:
-    participant_start_time = time.time()  # Record start time for the participant
-    for mode in modes:
-        input_file = f"/projects/illinois/ahs/kch/nakhan2/ACE_XZ/Orthogonalized_data/{participant}/{mode}/orth.npy"
-
-        base_output_dir = '/projects/illinois/ahs/kch/nakhan2/ACE_XZ/HMM_Output'
-        output_dir = os.path.join(base_output_dir, participant)
+def input_path(participant, mode):
+    """Orthogonalized data for one participant and mode."""
+    return os.path.join(base_dir, participant, mode, "orth.npy")
+
+def model_path(participant, mode):
+    """Saved participant-level HMM for one participant and mode."""
+    return os.path.join(base_output_dir, participant, "HMM_models", f"{participant}_{mode}_hmm.npz")
+
+def group_model_path(mode):
+    """Saved group-level HMM for one mode."""
+    return os.path.join(group_output_dir, "HMM_models", f"group_{mode}_hmm.npz")
+
+def marker_path(participant, mode):
+    """Completion marker for one (participant, mode) task, kept next to its outputs."""
+    return os.path.join(base_output_dir, participant, f".{participant}_{mode}.done")
+
+def output_paths(participant, mode):
+    """Files a finished participant-level task leaves behind (besides its block correlation store)."""
+    output_dir = os.path.join(base_output_dir, participant)
+    return [model_path(participant, mode),
+            os.path.join(output_dir, "State_sequences", f"{participant}_{mode}_state_sequence.npy"),
+            os.path.join(output_dir, "State_probabilities", f"{participant}_{mode}_state_probs.npy"),
+            os.path.join(output_dir, "Correlation_matrices", f"{participant}_{mode}_temporal_features.npz")]
+
+def fit_settings():
+    """The settings a participant's outputs depend on, recorded in its completion marker.
+
+    A single fit is unseeded, so the seed only counts when there are restarts.
+    """
+    return {"n_states": int(median_optimal_state), "n_restarts": n_restarts,
+            "seed": seed if n_restarts > 1 else None, "engine": engine}
+
+def is_up_to_date(participant, mode):
+    """True if the task finished before with the current fit settings, its orth.npy has not changed
+    since and none of its outputs have been removed."""
+    marker_file = marker_path(participant, mode)
+    if not os.path.exists(marker_file):
+        return False
+    try:
+        with open(marker_file, "r") as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if marker.get("input_mtime") != os.path.getmtime(input_path(participant, mode)):
+        return False
+    if any(marker.get(key) != value for key, value in fit_settings().items()):
+        return False
+    return (all(os.path.exists(path) for path in output_paths(participant, mode))
+            and has_block_correlations(os.path.join(base_output_dir, participant), participant, mode))
+
+def calculate_temporal_features(state_sequence, median_optimal_state):
+    """Fractional occupancy, transition probabilities, mean lifetime and mean interval length per state."""
+    features = temporal_features([state_sequence], int(median_optimal_state))
+    return (features["fractional_occupancy"][0], features["transition_probabilities"][0],
+            features["mean_lifetime"][0], features["mean_interval_length"][0])
+
+def recompute_temporal_features(output_root, participants):
+    """Recomputes the temporal features of every saved state sequence in one batch and rewrites their files."""
+    saved = []
+    for participant in participants:
+        for mode in modes:
+            sequence_file = os.path.join(output_root, participant, "State_sequences", f"{participant}_{mode}_state_sequence.npy")
+            if os.path.exists(sequence_file):
+                saved.append((participant, mode, np.load(sequence_file)))
+    if not saved:
+        print(f"No saved state sequences found in {output_root}")
+        return
+
+    features = temporal_features([sequence for _, _, sequence in saved], int(median_optimal_state))
+    for n, (participant, mode, _) in enumerate(saved):
+        np.savez(os.path.join(output_root, participant, "Correlation_matrices", f"{participant}_{mode}_temporal_features.npz"),
+                 fractional_occupancy=features["fractional_occupancy"][n],
+                 transition_probabilities=features["transition_probabilities"][n],
+                 mean_lifetime=features["mean_lifetime"][n],
+                 mean_interval_length=features["mean_interval_length"][n])
+    print(f"Recomputed temporal features for {len(saved)} (participant, mode) state sequences in {output_root}")
+
+# CALCULATE SPATIAL FEATURES (FUNCTIONAL CONNECTIVITY)
+
+def calculate_functional_connectivity(orthogonalized_data, state_sequence, median_optimal_state, participant, mode):
+    """Parcel x parcel correlation matrix of every contiguous state block.
+
+    The state-sequence block bounds index the time axis of the orthogonalized data; all blocks are
+    computed in one batched pass by state_connectivity.block_correlations. The data were already
+    validated on load, so blocks need no per-block NaN / inf checks. Returns the (n_blocks x 2)
+    (state, block) index alongside the (n_blocks x L x L) matrices.
+    """
+    states, block_indices, starts, ends = state_blocks(state_sequence, int(median_optimal_state))
+    block_matrices, empty = block_correlations(orthogonalized_data, starts, ends)
+    if not check_correlation_range(block_matrices):
+        raise ValueError(f"Correlation values out of range for participant {participant}, mode {mode}. Check data preprocessing.")
+    block_index = np.column_stack([states, block_indices])
+
+    # Empty blocks (bounds past the end of the time axis) are replaced by the epoch-mean correlation
+    initial_empty_case_count = replaced_empty_case_count = int(np.sum(empty))
+    remaining_empty_case_count = 0
+
+    return block_index, block_matrices, initial_empty_case_count, replaced_empty_case_count, remaining_empty_case_count
+
+def init_worker(blas_threads=None, hmm_engine="hmmlearn", restarts=1, base_seed=0):
+    """Sets the HMM engine and restart settings and limits the BLAS threads of a worker process so parallel
+    fits do not oversubscribe the node."""
+    global engine, n_restarts, seed
+    engine = hmm_engine
+    n_restarts = restarts
+    seed = base_seed
+    if blas_threads is not None:
+        threadpool_limits(limits=blas_threads)
+
+def load_participant_data(participant, mode, scaler=None):
+    """Loads a participant's orthogonalized data and its standardized per-epoch mean features.
+
+    Features are standardized with a newly fitted StandardScaler, or with saved (mean, scale)
+    parameters if given; the scaler used is returned alongside.
+    """
+    # Load orthogonalized data
+    orthogonalized_data = np.load(input_path(participant, mode))
+    orthogonalized_data = validate_data(orthogonalized_data, f"orthogonalized data for participant {participant}, mode {mode}")
+
+    features = np.mean(orthogonalized_data, axis=2)
+    features = validate_data(features, f"mean features for participant {participant}, mode {mode}")
+    features = np.ma.masked_invalid(features).filled(np.mean(features, axis=0))
+    if scaler is None:
+        scaler = StandardScaler()
+        features = scaler.fit_transform(features)
+    else:
+        features = standardize(features, scaler)
+    return orthogonalized_data, features, scaler
+
+def save_participant_outputs(output_dir, participant, mode, orthogonalized_data, state_sequence, state_probs):
+    """Saves the state sequence and probabilities, temporal features and state-block correlation matrices."""
+    output_state_sequences = os.path.join(output_dir, "State_sequences")
+    output_state_probs = os.path.join(output_dir, "State_probabilities")
+    output_correlation_matrices = os.path.join(output_dir, "Correlation_matrices")
+
+    # Ensure subdirectories exist
+    os.makedirs(output_state_sequences, exist_ok=True)
+    os.makedirs(output_state_probs, exist_ok=True)
+    os.makedirs(output_correlation_matrices, exist_ok=True)
+
+    np.save(os.path.join(output_state_sequences, f"{participant}_{mode}_state_sequence.npy"), state_sequence)
+    np.save(os.path.join(output_state_probs, f"{participant}_{mode}_state_probs.npy"), state_probs)
+
+    # CALCULATE TEMPORAL FEATURES
+    fractional_occupancy, transition_probabilities, mean_lifetime, mean_interval_length = calculate_temporal_features(
+        state_sequence, median_optimal_state)
+
+    np.savez(os.path.join(output_correlation_matrices, f"{participant}_{mode}_temporal_features.npz"),
+            fractional_occupancy=fractional_occupancy,
+            transition_probabilities=transition_probabilities,
+            mean_lifetime=mean_lifetime,
+            mean_interval_length=mean_interval_length)
+
+    # CALCULATE SPATIAL FEATURES (FUNCTIONAL CONNECTIVITY)
+
+    block_index, block_matrices, initial_empty_case_count, replaced_empty_case_count, remaining_empty_case_count = calculate_functional_connectivity(
+        orthogonalized_data, state_sequence, median_optimal_state, participant, mode)
+
+    # Positive / negative views are derived on demand (connectivity_store.load_sign_views), not saved
+    save_block_correlations(output_dir, participant, mode, block_index, block_matrices)
+
+def new_model(random_state=None):
+    """The participant- and group-level HMM configuration."""
+    #median_optimal_state = np.median(optimal_states[mode])
+    return gaussian_hmm(engine, n_components=int(median_optimal_state), n_iter=50,
+                        covariance_type='full', tol=1e-7, verbose=False,
+                        params='st', init_params='stmc', random_state=random_state)
+
+def save_fitted_participant(participant, mode, model, orthogonalized_data, features, scaler, input_mtime,
+                            task_start_time, restart_scores=None):
+    """Decodes with a fitted model, saves the model and all outputs, and writes the completion marker."""
+    state_sequence = model.predict(features)
+    state_probs = model.predict_proba(features)
+
+    save_hmm_model(model_path(participant, mode), model, scaler)
+    save_participant_outputs(os.path.join(base_output_dir, participant), participant, mode,
+                             orthogonalized_data, state_sequence, state_probs)
+
+    marker = {"input_mtime": input_mtime, **fit_settings()}
+    if restart_scores is not None:
+        marker["restart_log_likelihoods"] = [float(score) for score in restart_scores]
+        with open(model_path(participant, mode)[:-len(".npz")] + "_restarts.json", "w") as f:
+            json.dump({"min": float(np.min(restart_scores)), "median": float(np.median(restart_scores)),
+                       "max": float(np.max(restart_scores)), "log_likelihoods": marker["restart_log_likelihoods"]}, f)
+
+    # The marker is written last, so a task that dies part-way through is simply run again
+    elapsed_time = time.time() - task_start_time
+    marker["minutes"] = elapsed_time / 60
+    with open(marker_path(participant, mode), "w") as f:
+        json.dump(marker, f)
+    return elapsed_time
+
+def process_participant_mode(participant, mode):
+    """Fits the HMM for one participant and mode, saves its outputs and writes the completion marker."""
+    task_start_time = time.time()
+    input_mtime = os.path.getmtime(input_path(participant, mode))
+
+    orthogonalized_data, features, scaler = load_participant_data(participant, mode)
+    model = new_model()
+    model.fit(features)
+
+    return save_fitted_participant(participant, mode, model, orthogonalized_data, features, scaler,
+                                   input_mtime, task_start_time), None
+
+# MULTI-RESTART FITTING
+
+def fit_restart(seed, participant, mode):
+    """One seeded fit for a participant and mode, returning its training log-likelihood and the model."""
+    task_start_time = time.time()
+    _, features, _ = load_participant_data(participant, mode)
+    model = new_model(random_state=seed)
+    model.fit(features)
+    return time.time() - task_start_time, (model.score(features), model)
+
+def finish_participant_mode(model, restart_scores, participant, mode):
+    """Saves the outputs of the best of a participant's restarts."""
+    task_start_time = time.time()
+    input_mtime = os.path.getmtime(input_path(participant, mode))
+    orthogonalized_data, features, scaler = load_participant_data(participant, mode)
+    return save_fitted_participant(participant, mode, model, orthogonalized_data, features, scaler,
+                                   input_mtime, task_start_time, restart_scores), None
+
+def run_restarts(executor, tasks, n_restarts, seed, max_retries):
+    """Runs every (participant, mode, restart) fit on the pool, then saves each participant's best-likelihood fit."""
+    fit_tasks = [(seed + restart, participant, mode) for participant, mode in tasks for restart in range(n_restarts)]
+    print(f"{len(fit_tasks)} (participant, mode, restart) fits to run")
+    fits, failed = run_with_retries(executor, fit_restart, fit_tasks, max_retries)
+
+    finish_tasks = []
+    for participant, mode in tasks:
+        restarts = [fits[(seed + restart, participant, mode)] for restart in range(n_restarts)
+                    if (seed + restart, participant, mode) in fits]
+        if not restarts:
+            continue
+        scores = tuple(score for score, _ in restarts)
+        best_model = max(restarts, key=lambda restart: restart[0])[1]
+        print(f"\n{participant} ({mode}) log-likelihood over {len(scores)} restarts: min {np.min(scores):.2f}, "
+              f"median {np.median(scores):.2f}, max {np.max(scores):.2f}")
+        finish_tasks.append((best_model, scores, participant, mode))
+
+    _, finish_failed = run_with_retries(executor, finish_participant_mode, finish_tasks, max_retries)
+    return failed + finish_failed
+
+# GROUP-LEVEL HMM
+
+def load_participant_features(participant, mode):
+    """Standardized per-epoch mean features only, for the group fit."""
+    return load_participant_data(participant, mode)[1]
+
+def fit_features(features, lengths, seed):
+    """One seeded group fit on concatenated features, returning its log-likelihood and the model."""
+    model = new_model(random_state=seed)
+    model.fit(features, lengths)
+    return model.score(features, lengths), model
+
+def fit_group_model(executor, participants, mode, n_fit=None, seed=0, n_restarts=1):
+    """Fits one HMM on the concatenated features of all (or a random subsample of) participants.
+
+    With several restarts the seeded fits run concurrently on the pool and the best log-likelihood is kept.
+    """
+    fit_participants = list(participants)
+    if n_fit is not None and n_fit < len(fit_participants):
+        rng = np.random.default_rng(seed)
+        fit_participants = sorted(rng.choice(fit_participants, size=n_fit, replace=False))
+
+    futures = {participant: executor.submit(load_participant_features, participant, mode) for participant in fit_participants}
+    features = []
+    for participant, future in futures.items():
         try:
-            if not os.path.exists(input_file):
-                print(f"Error: File not found for participant {participant}, mode {mode}: {input_file}")
-                continue  # Skip to the next iteration if the file does not exist
-
-            # Load orthogonalized data
-            orthogonalized_data = np.load(input_file)
-            orthogonalized_data = validate_data(orthogonalized_data, f"orthogonalized data for participant {participant}, mode {mode}")
-            
-            features = np.mean(orthogonalized_data, axis=2)
-            features = validate_data(features, f"mean features for participant {participant}, mode {mode}")
-            features = np.ma.masked_invalid(features).filled(np.mean(features, axis=0))
-            scaler = StandardScaler()
-            features = scaler.fit_transform(features)
-
-            #median_optimal_state = np.median(optimal_states[mode])
-            
-            model = hmm.GaussianHMM(n_components=int(median_optimal_state), n_iter=50, 
-                                    covariance_type='full', tol=1e-7, verbose=False, 
-                                    params='st', init_params='stmc')
-            model.fit(features)
-            state_sequence = model.predict(features)
-            state_probs = model.predict_proba(features)
-
-            #output_dir = os.path.join(output_dir, participant, mode)
-
-            output_state_sequences = os.path.join(output_dir, "State_sequences")
-            output_state_probs = os.path.join(output_dir, "State_probabilities")
-            output_correlation_matrices = os.path.join(output_dir, "Correlation_matrices")
-
-            # Ensure subdirectories exist
-            os.makedirs(output_state_sequences, exist_ok=True)
-            os.makedirs(output_state_probs, exist_ok=True)
-            os.makedirs(output_correlation_matrices, exist_ok=True)
-
-            np.save(os.path.join(output_state_sequences, f"{participant}_{mode}_state_sequence.npy"), state_sequence)
-            np.save(os.path.join(output_state_probs, f"{participant}_{mode}_state_probs.npy"), state_probs)
-
-
-            # CALCULATE TEMPORAL FEATURES
-            
-            # Compute fractional occupancy: fraction of time spent in each state
-            fractional_occupancy = np.array([np.sum(state_sequence == i) / len(state_sequence) for i in range(int(median_optimal_state))])
-
-            # Compute transition probabilities
-            transition_counts = np.zeros((int(median_optimal_state), int(median_optimal_state)))
-            for (i, j) in zip(state_sequence[:-1], state_sequence[1:]):
-                transition_counts[i, j] += 1
-            transition_probabilities = transition_counts / np.sum(transition_counts, axis=1, keepdims=True)
-
-            # Compute mean lifetime (dwell time) in each state: average time spent in each state before transitioning
-            mean_lifetime = np.zeros(int(median_optimal_state))
-            for i in range(int(median_optimal_state)):
-                # Identify the indices where state changes
-                change_indices = np.where(np.diff(state_sequence == i, prepend=False, append=False))[0]
-                # Calculate segment lengths by differencing indices of changes; add 1 because diff loses 1
-                segment_lengths = np.diff(change_indices) + 1
-                # Compute mean segment length for state i
-                mean_lifetime[i] = np.mean(segment_lengths) if len(segment_lengths) > 0 else 0
-
-            # Mean Interval Length: average time between consecutive occurrences of each state
-            mean_interval_length = np.zeros(int(median_optimal_state))
-            for k in range(int(median_optimal_state)):
-                # Boolean array where True is the state 'k'
-                is_state_k = state_sequence == k
-                # Time points where state is 'k'
-                time_points_k = np.where(is_state_k)[0]
-                # Compute time differences between consecutive occurrences of state 'k'
-                intervals_k = np.diff(time_points_k) - 1
-                # Compute the mean of these intervals, accounting for the case where state 'k' does not repeat
-                mean_interval_length[k] = np.mean(intervals_k) if len(intervals_k) > 0 else 0
-                
-            np.savez(os.path.join(output_correlation_matrices, f"{participant}_{mode}_temporal_features.npz"), 
-                    fractional_occupancy=fractional_occupancy, 
-                    transition_probabilities=transition_probabilities,
-                    mean_lifetime=mean_lifetime, 
-                    mean_interval_length=mean_interval_length)
-
-                    
-            # CALCULATE SPATIAL FEATURES (FUNCTIONAL CONNECTIVITY)
-            
-            def calculate_functional_connectivity(orthogonalized_data, state_sequence, median_optimal_state):
-                correlation_matrices = {}
-                positive_correlations = {}
-                negative_correlations = {}
-
-                initial_empty_case_count = 0  # Counter for initial empty data cases
-                replaced_empty_case_count = 0  # Counter for replaced empty data cases
-
-                for state in range(int(median_optimal_state)):
-                    state_indices = np.where(state_sequence == state)[0]
-
-                    block_starts = np.where(np.diff(state_indices) > 1)[0] + 1
-                    block_starts = np.insert(block_starts, 0, 0)
-                    block_ends = np.append(block_starts[1:] - 1, len(state_indices) - 1)
-                    state_blocks = zip(state_indices[block_starts], state_indices[block_ends] + 1)
-
-                    for i, (start_index, end_index) in enumerate(state_blocks):
-                        state_data = orthogonalized_data[:, :, start_index:end_index]
-
-                        if state_data.size == 0:
-                            initial_empty_case_count += 1  # Increment initial empty case count
-                            # Replace empty data with the mean of the input data
-                            state_data = np.mean(orthogonalized_data, axis=2, keepdims=True) 
-                            replaced_empty_case_count += 1
-
-                        state_data = validate_data(state_data, f"state data for state {state}, block {i}, participant {participant}, mode {mode}")
-
-                        # Select the time and sample dimensions for correlation
-                        reshaped_data = state_data.swapaxes(1, 2).reshape(102, -1)
-
-                        # Impute NaNs if necessary
-                        if np.isnan(state_data).any():
-                            reshaped_data = np.nan_to_num(reshaped_data)
-
-                        corr_matrix = np.corrcoef(reshaped_data)
-                        if not check_correlation_range(corr_matrix):
-                            raise ValueError(f"Correlation values out of range in state {state}, block {i} for participant {participant}, mode {mode}. Check data preprocessing.")
-
-                        correlation_matrices[(state, i)] = corr_matrix
-
-                        upper_tri_indices = np.triu_indices_from(corr_matrix, k=1)
-                        positive_correlations[(state, i)] = corr_matrix[upper_tri_indices][corr_matrix[upper_tri_indices] > 0]
-                        negative_correlations[(state, i)] = corr_matrix[upper_tri_indices][corr_matrix[upper_tri_indices] < 0]
-
-                remaining_empty_case_count = sum(1 for key, value in correlation_matrices.items() if value.size == 0)
-
-                return correlation_matrices, positive_correlations, negative_correlations, initial_empty_case_count, replaced_empty_case_count, remaining_empty_case_count
-
-            # CALCULATE SPATIAL FEATURES (FUNCTIONAL CONNECTIVITY)
-            
-            correlation_matrices, positive_correlations, negative_correlations, initial_empty_case_count, replaced_empty_case_count, remaining_empty_case_count = calculate_functional_connectivity(
-                orthogonalized_data, state_sequence, median_optimal_state)
-
-            correlation_matrices_file = os.path.join(output_dir, f"Correlation_matrices/{participant}_{mode}_correlation_matrices.npy")
-            positive_correlations_file = os.path.join(output_dir, f"Correlation_matrices/{participant}_{mode}_positive_correlations.npy")
-            negative_correlations_file = os.path.join(output_dir, f"Correlation_matrices/{participant}_{mode}_negative_correlations.npy")
-            # Convert tuple keys to strings
-            arrays_to_save = {}
-            for key, value in correlation_matrices.items():
-                key_str = "_".join(map(str, key))
-                arrays_to_save[key_str] = value
-            np.savez(correlation_matrices_file, **arrays_to_save)
-            np.savez(positive_correlations_file, positive_correlations)
-            np.savez(negative_correlations_file, negative_correlations)
-
+            features.append(future.result())
         except Exception as e:
-            print(f"Error processing participant {participant}, mode {mode}: {e}")
-        
-        current_count += 1
-        participant_elapsed_time = (time.time() - participant_start_time) / 60
-        total_elapsed_time = (time.time() - start_time) / 60
-        avg_time_per_participant = total_elapsed_time / current_count
-        #progress_percent = (current_count / total_participants) * 100  # Uncomment if the need to keep track of participant's processing progress arises
-        sys.stdout.write(f"\rProcessing {participant} | Mode: {mode} | "
-                         f"Participant Progress: {participant_elapsed_time:.2f} min | "
-                         #f"Overall Progress: {progress_percent:.2f}% | " # Uncomment if the need to keep track of participant's processing progress arises
-                         f"Avg Time/Participant: {avg_time_per_participant:.2f} min")
-        sys.stdout.flush()
-
-print("\nAll HMM fittings completed.")
-total_time_taken = (time.time() - start_time) / 60
-print(f"Total processing time: {total_time_taken:.2f} minutes. Average time per participant: {avg_time_per_participant:.2f} minutes.")
-
+            print(f"Error loading participant {participant}, mode {mode} for the group fit, leaving it out: {e}")
+    # lengths keeps each participant a separate sequence, so no transition is counted across the joins
+    lengths = [len(f) for f in features]
+    print(f"Fitting group HMM for mode {mode} on {len(features)} participants ({sum(lengths)} epochs)")
+
+    features = np.concatenate(features)
+    if n_restarts == 1:
+        return fit_features(features, lengths, seed)[1]
+
+    futures = [executor.submit(fit_features, features, lengths, seed + restart) for restart in range(n_restarts)]
+    restarts = [future.result() for future in futures]
+    scores = [score for score, _ in restarts]
+    print(f"Group HMM for mode {mode} log-likelihood over {n_restarts} restarts: min {np.min(scores):.2f}, "
+          f"median {np.median(scores):.2f}, max {np.max(scores):.2f}")
+    return max(restarts, key=lambda restart: restart[0])[1]
+
+def decode_participant_mode(model, output_root, participant, mode):
+    """Decodes one participant and mode against the shared group model and saves its outputs."""
+    task_start_time = time.time()
+    orthogonalized_data, features, _ = load_participant_data(participant, mode)
+    state_sequence = model.predict(features)
+    state_probs = model.predict_proba(features)
+    save_participant_outputs(os.path.join(output_root, participant), participant, mode,
+                             orthogonalized_data, state_sequence, state_probs)
+    return time.time() - task_start_time, None
+
+# INFERENCE-ONLY DECODING
+
+def redecode_participant_mode(participant, mode):
+    """Re-decodes one participant and mode with its saved HMM and scaler, without refitting."""
+    task_start_time = time.time()
+    model, scaler = load_hmm_model(model_path(participant, mode))
+    orthogonalized_data, features, _ = load_participant_data(participant, mode, scaler)
+    state_sequence = model.predict(features)
+    state_probs = model.predict_proba(features)
+    save_participant_outputs(os.path.join(base_output_dir, participant), participant, mode,
+                             orthogonalized_data, state_sequence, state_probs)
+    return time.time() - task_start_time, None
+
+def run_with_retries(executor, task_function, tasks, max_retries):
+    """Runs task_function(*task) for every task on the pool, resubmitting failures up to max_retries times.
+
+    Task functions take the participant and mode as their last two arguments and return
+    (seconds, result); the results of the successful tasks are returned with the failed tasks.
+    """
+    total_tasks = len(tasks)
+    start_time = time.time()
+    completed = 0
+    results = {}
+    failed = []
+    attempts = {task: 0 for task in tasks}
+
+    pending = {executor.submit(task_function, *task): task for task in tasks}
+    while pending:
+        for future in as_completed(list(pending)):
+            task = pending.pop(future)
+            participant, mode = task[-2:]
+            attempts[task] += 1
+            try:
+                task_elapsed_time, results[task] = future.result()
+            except Exception as e:
+                print(f"\nError processing participant {participant}, mode {mode} (attempt {attempts[task]}): {e}")
+                if attempts[task] <= max_retries:
+                    pending[executor.submit(task_function, *task)] = task
+                else:
+                    failed.append(task)
+                continue
+
+            completed += 1
+            total_elapsed_time = (time.time() - start_time) / 60
+            sys.stdout.write(f"\rProcessing {participant} | Mode: {mode} | "
+                             f"Participant Progress: {task_elapsed_time / 60:.2f} min | "
+                             f"Completed: {completed}/{total_tasks} | "
+                             f"Avg Time/Participant: {total_elapsed_time / completed:.2f} min")
+            sys.stdout.flush()
+    return results, failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit participant-level HMMs for every participant and condition")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Worker processes running (participant, mode) fits")
+    parser.add_argument("--max_retries", type=int, default=1, help="Times a failed (participant, mode) fit is retried")
+    parser.add_argument("--force", action="store_true", help="Refit tasks whose outputs are already up to date")
+    parser.add_argument("--group", action="store_true",
+                        help="Fit one HMM per mode on all participants and decode each participant against it")
+    parser.add_argument("--group_subsample", type=int, default=None,
+                        help="Number of randomly chosen participants the group HMM is fitted on (default: all)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the group subsample and the restarts")
+    parser.add_argument("--n_restarts", type=int, default=1,
+                        help="Independently seeded fits per model, run concurrently; the best log-likelihood is kept")
+    parser.add_argument("--decode", action="store_true",
+                        help="Only decode with the saved models (group model with --group), without fitting")
+    parser.add_argument("--engine", type=str, default="hmmlearn", choices=["hmmlearn", "fast"],
+                        help="hmmlearn's GaussianHMM or the compiled full-covariance engine in fast_hmm.py")
+    parser.add_argument("--temporal_only", action="store_true",
+                        help="Only recompute the temporal features from the saved state sequences (in one batch)")
+    args = parser.parse_args()
+    # The group model is fitted in this process, the participant models in the workers
+    init_worker(hmm_engine=args.engine, restarts=args.n_restarts, base_seed=args.seed)
+
+    participants = sorted(p for p in os.listdir(base_dir) if os.path.isdir(os.path.join(base_dir, p)))
+    if args.temporal_only:
+        recompute_temporal_features(group_output_dir if args.group else base_output_dir, participants)
+        return
+    start_time = time.time()
+    failed = []
+
+    with ProcessPoolExecutor(max_workers=args.n_jobs, initializer=init_worker,
+                             initargs=(1 if args.n_jobs > 1 else None, args.engine, args.n_restarts, args.seed)) as executor:
+        if args.group:
+            for mode in modes:
+                mode_participants = [p for p in participants if os.path.exists(input_path(p, mode))]
+                if not mode_participants:
+                    print(f"Error: No orthogonalized data found for mode {mode}")
+                    continue
+                if args.decode:
+                    if not os.path.exists(group_model_path(mode)):
+                        print(f"Error: No saved group HMM for mode {mode} at {group_model_path(mode)}")
+                        continue
+                    # Participants are standardized individually, so the group model carries no scaler
+                    model, _ = load_hmm_model(group_model_path(mode))
+                else:
+                    model = fit_group_model(executor, mode_participants, mode, args.group_subsample, args.seed,
+                                            args.n_restarts)
+                    save_hmm_model(group_model_path(mode), model)
+                print(f"Decoding {len(mode_participants)} participants for mode {mode} against the group HMM")
+                tasks = [(model, group_output_dir, participant, mode) for participant in mode_participants]
+                failed += run_with_retries(executor, decode_participant_mode, tasks, args.max_retries)[1]
+        elif args.decode:
+            tasks = []
+            for participant in participants:
+                for mode in modes:
+                    if os.path.exists(input_path(participant, mode)) and os.path.exists(model_path(participant, mode)):
+                        tasks.append((participant, mode))
+                    else:
+                        print(f"Skipping participant {participant}, mode {mode}: no data or no saved HMM")
+
+            print(f"{len(tasks)} (participant, mode) decodes to run on {args.n_jobs} workers")
+            failed = run_with_retries(executor, redecode_participant_mode, tasks, args.max_retries)[1]
+        else:
+            tasks = []
+            for participant in participants:
+                for mode in modes:
+                    if not os.path.exists(input_path(participant, mode)):
+                        print(f"Error: File not found for participant {participant}, mode {mode}: {input_path(participant, mode)}")
+                    elif not args.force and is_up_to_date(participant, mode):
+                        print(f"Skipping participant {participant}, mode {mode}: outputs are up to date")
+                    else:
+                        tasks.append((participant, mode))
+
+            print(f"{len(tasks)} (participant, mode) fits to run on {args.n_jobs} workers")
+            if args.n_restarts > 1:
+                failed = run_restarts(executor, tasks, args.n_restarts, args.seed, args.max_retries)
+            else:
+                failed = run_with_retries(executor, process_participant_mode, tasks, args.max_retries)[1]
+
+    print("\nAll HMM fittings completed.")
+    total_time_taken = (time.time() - start_time) / 60
+    print(f"Total processing time: {total_time_taken:.2f} minutes.")
+    if failed:
+        print(f"{len(failed)} tasks failed after {args.max_retries} retries: "
+              + ", ".join(f"{task[-2]} ({task[-1]})" for task in failed))
+
+if __name__ == "__main__":
+    main()
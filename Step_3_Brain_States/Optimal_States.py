@@ -10,6 +10,10 @@ from hmmlearn import hmm
 import time
 import os.path as op
 import argparse
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from threadpoolctl import threadpool_limits
+from fast_hmm import gaussian_hmm
 
 def log_message(message):
     """Logs message immediately to stdout and flushes."""
@@ -32,10 +36,192 @@ def downsample_with_filtering(data, original_fs, target_fs):
     log_message("Downsampling completed.")
     return downsampled_data
 
-def determine_optimal_states(orthogonalized_data, subject, mode, files_out):
-    """Determines the optimal number of states using AIC and BIC criteria."""
-    log_message(f"Starting determine_optimal_states function for subject {subject}, mode {mode}")
+# Features shared with the worker processes, set once per worker by the pool initializer
+_worker_data = None
+# Fitted models by state count, kept only when warm starting from neighbouring state counts
+_warm_start_models = None
+# HMM engine used for the fits: "hmmlearn" or "fast" (fast_hmm.FastGaussianHMM)
+_engine = "hmmlearn"
+
+def init_worker(pca_data, blas_threads=None, warm_start=False, engine="hmmlearn"):
+    """Stores the features and HMM engine in a worker process and limits its BLAS threads."""
+    global _worker_data, _warm_start_models, _engine
+    _worker_data = pca_data
+    _warm_start_models = {} if warm_start else None
+    _engine = engine
+    if blas_threads is not None:
+        threadpool_limits(limits=blas_threads)
+
+def split_state(startprob, transmat, means, covars):
+    """Returns startprob, transmat, means and covars with one more state, splitting the highest-variance state.
+
+    The state's mean is moved half a standard deviation either way along its principal axis and both
+    halves keep its covariance with that axis shrunk accordingly; its start and incoming transition
+    probabilities are shared equally between the two halves.
+    """
+    state = int(np.argmax(np.trace(covars, axis1=1, axis2=2)))
+    eigenvalues, eigenvectors = np.linalg.eigh(covars[state])
+    shift = 0.5 * np.sqrt(eigenvalues[-1]) * eigenvectors[:, -1]
+
+    means = np.vstack([means, means[state] + shift])
+    means[state] -= shift
+    split_covar = covars[state] - np.outer(shift, shift)
+    covars = np.concatenate([covars, split_covar[None]])
+    covars[state] = split_covar
+
+    startprob = np.append(startprob, startprob[state] / 2)
+    startprob[state] /= 2
+    transmat = np.vstack([transmat, transmat[state]])
+    transmat = np.hstack([transmat, transmat[:, [state]] / 2])
+    transmat[:, state] /= 2
+    return startprob, transmat, means, covars
+
+def fit_state_count(n_states, random_state=None):
+    """Fits a GaussianHMM with n_states states and returns its AIC, BIC, fit time, EM iterations and log-likelihood."""
+    state_start_time = time.time()
+    pca_data = _worker_data
+
+    model = gaussian_hmm(_engine, n_components=n_states, n_iter=50, covariance_type='full', tol=1e-7, verbose=False,
+                         random_state=random_state)
+    warm_from = None
+    if _warm_start_models is not None:
+        smaller = [k for k in _warm_start_models if k < n_states]
+        warm_from = max(smaller) if smaller else None
+    if warm_from is not None:
+        # Grow the nearest smaller fitted model one split at a time instead of a fresh k-means initialisation
+        seed_model = _warm_start_models[warm_from]
+        params = (seed_model.startprob_, seed_model.transmat_, seed_model.means_, seed_model.covars_)
+        for _ in range(n_states - warm_from):
+            params = split_state(*params)
+        model.init_params = ''
+        model.startprob_, model.transmat_, model.means_, model.covars_ = params
+    model.fit(pca_data)
+    if _warm_start_models is not None:
+        _warm_start_models[n_states] = model
+    log_likelihood = model.score(pca_data)
+    n_params = n_states * (2 * pca_data.shape[1] - 1)
+    aic = 2 * n_params - 2 * log_likelihood
+    bic = np.log(pca_data.shape[0]) * n_params - 2 * log_likelihood
+
+    return n_states, aic, bic, time.time() - state_start_time, model.monitor_.iter, log_likelihood
+
+def fit_state_counts(state_numbers, executor, subject, mode, on_result, seeds=(None,)):
+    """Fits a batch of state counts inline (no executor) or on the worker pool, passing each result to on_result.
+
+    Every state count is fitted once per seed; on_result receives the AIC, BIC and EM iterations of the
+    best-likelihood fit, the summed fit time and the log-likelihoods of all the restarts.
+    """
+    restarts = {}
+
+    def collect(result):
+        n_states = result[0]
+        restarts.setdefault(n_states, []).append(result)
+        if len(restarts[n_states]) == len(seeds):
+            fits = restarts.pop(n_states)
+            _, aic, bic, _, n_iter, _ = max(fits, key=lambda fit: fit[5])
+            on_result((n_states, aic, bic, sum(fit[3] for fit in fits), n_iter, [fit[5] for fit in fits]))
+
+    if executor is None:
+        for n_states in sorted(state_numbers):
+            log_message(f"Processing state: {n_states} | Subject: {subject} | Mode: {mode}")
+            for seed in seeds:
+                collect(fit_state_count(n_states, seed))
+    else:
+        log_message(f"Fitting states {sorted(state_numbers)} x {len(seeds)} restarts on the worker pool | Subject: {subject} | Mode: {mode}")
+        # Largest models first so the slowest fits do not end up last in the queue
+        futures = [executor.submit(fit_state_count, n_states, seed)
+                   for n_states in sorted(state_numbers, reverse=True) for seed in seeds]
+        for future in as_completed(futures):
+            collect(future.result())
+
+def log_state_result(result, subject, mode, restart_file=None):
+    """Logs the fit time, EM iterations and restart score spread of one state count and returns its (AIC, BIC)."""
+    n_states, aic, bic, elapsed_time, n_iter, scores = result
+    log_message(f"Time taken for state {n_states}: {elapsed_time / 60:.2f} minutes, {n_iter} EM iterations | Subject: {subject} | Mode: {mode}")
+    if len(scores) > 1:
+        log_message(f"State {n_states} log-likelihood over {len(scores)} restarts: min {np.min(scores):.2f}, "
+                    f"median {np.median(scores):.2f}, max {np.max(scores):.2f} | Subject: {subject} | Mode: {mode}")
+        if restart_file is not None:
+            with open(restart_file, "a") as f:
+                f.write(f"{n_states}\t{np.min(scores)}\t{np.median(scores)}\t{np.max(scores)}\n")
+    return aic, bic
+
+def sweep_state_counts(state_numbers, executor, aic_bic_file, subject, mode, seeds=(None,), restart_file=None):
+    """Fits every state count and appends AIC/BIC to the file in state order."""
+    state_numbers = sorted(state_numbers)
+    results = {}
+    next_index = 0
+
+    def record(result):
+        nonlocal next_index
+        results[result[0]] = log_state_result(result, subject, mode, restart_file)
+        # Write the finished prefix in state order, whichever worker completed first
+        with open(aic_bic_file, "a") as f:
+            while next_index < len(state_numbers) and state_numbers[next_index] in results:
+                k = state_numbers[next_index]
+                f.write(f"{k}\t{results[k][0]}\t{results[k][1]}\n")
+                next_index += 1
+
+    fit_state_counts(state_numbers, executor, subject, mode, record, seeds)
+    return results
+
+def adaptive_state_search(evaluate, state_numbers, coarse_step=3):
+    """Coarse-to-fine search for the AIC and BIC minima over a contiguous range of state counts.
+
+    evaluate takes a list of state counts not scored yet and returns {n_states: (aic, bic)}.
+    A coarse grid is scored first, then the gaps around the current AIC and BIC minima are
+    filled in until every state count within coarse_step - 1 of both minima has been scored.
+    """
+    low, high = min(state_numbers), max(state_numbers)
+    coarse = list(range(low, high + 1, coarse_step))
+    if coarse[-1] != high:
+        coarse.append(high)
+
+    scores = dict(evaluate(coarse))
+    while True:
+        needed = set()
+        for criterion in (0, 1):
+            best = min(scores, key=lambda k: scores[k][criterion])
+            for k in range(max(low, best - coarse_step + 1), min(high, best + coarse_step - 1) + 1):
+                if k not in scores:
+                    needed.add(k)
+        if not needed:
+            return scores
+        scores.update(evaluate(sorted(needed)))
+
+def optimal_from_scores(scores):
+    """Returns the AIC, BIC and averaged optimal state counts from {n_states: (aic, bic)}."""
+    optimal_state_aic = min(scores, key=lambda k: scores[k][0])
+    optimal_state_bic = min(scores, key=lambda k: scores[k][1])
+    return optimal_state_aic, optimal_state_bic, int((optimal_state_aic + optimal_state_bic) / 2)
+
+def validate_adaptive_search(scores, state_numbers, coarse_step, validation_file, subject, mode):
+    """Replays the adaptive search against exhaustive sweep scores and reports whether the optima agree."""
+    evaluated = []
+
+    def lookup(batch):
+        evaluated.extend(batch)
+        return {k: scores[k] for k in batch}
+
+    adaptive_scores = adaptive_state_search(lookup, state_numbers, coarse_step)
+    exhaustive_optimum = optimal_from_scores(scores)
+    adaptive_optimum = optimal_from_scores(adaptive_scores)
+    agrees = exhaustive_optimum == adaptive_optimum
+
+    with open(validation_file, "w") as f:
+        f.write(f"Subject: {subject}\nMode: {mode}\nCoarse step: {coarse_step}\n")
+        f.write(f"Adaptive evaluated states: {sorted(evaluated)}\n")
+        f.write(f"Fits: {len(evaluated)} adaptive vs {len(scores)} exhaustive\n")
+        f.write(f"Exhaustive optimum (AIC, BIC, Average): {exhaustive_optimum}\n")
+        f.write(f"Adaptive optimum (AIC, BIC, Average): {adaptive_optimum}\n")
+        f.write(f"Agreement: {agrees}\n")
 
+    log_message(f"Adaptive search validation for {subject} ({mode}): {len(evaluated)}/{len(scores)} fits, "
+                f"exhaustive {exhaustive_optimum}, adaptive {adaptive_optimum}, agreement {agrees}")
+    return agrees
+
+def reduce_in_memory(orthogonalized_data):
+    """Steps 1-4: PCA (99% of variance) and standardization of the whole array in memory."""
     log_message("Step 1 - Computing mean features")
     features = np.mean(orthogonalized_data, axis=2)
     features = np.ma.masked_invalid(features).filled(0)
@@ -50,30 +236,129 @@ def determine_optimal_states(orthogonalized_data, subject, mode, files_out):
     log_message("Step 4 - Standardizing PCA data")
     scaler = StandardScaler()
     pca_data = scaler.fit_transform(pca_data)
+    return pca_data
+
+def streaming_pca_features(orthogonalized_data, chunk_size=100000, variance=0.99):
+    """PCA (keeping the given fraction of variance) and standardization of orth.reshape(epochs, -1).T over row chunks.
+
+    The epochs x epochs covariance is accumulated chunk by chunk, so a memory-mapped orth.npy is never
+    loaded whole; the components match PCA(n_components=variance) up to their sign.
+    """
+    rows = orthogonalized_data.reshape(orthogonalized_data.shape[0], -1)
+    n_features, n_samples = rows.shape
+    chunks = [slice(start, min(start + chunk_size, n_samples)) for start in range(0, n_samples, chunk_size)]
+
+    mean = np.zeros(n_features)
+    for chunk in chunks:
+        mean += np.sum(rows[:, chunk], axis=1)
+    mean /= n_samples
+
+    covariance = np.zeros((n_features, n_features))
+    for chunk in chunks:
+        centered = rows[:, chunk].T - mean
+        covariance += centered.T @ centered
+    covariance /= n_samples - 1
+
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    eigenvalues, eigenvectors = eigenvalues[::-1], eigenvectors[:, ::-1]
+    explained_variance_ratio = np.clip(eigenvalues, 0, None) / np.sum(np.clip(eigenvalues, 0, None))
+    n_components = int(np.searchsorted(np.cumsum(explained_variance_ratio), variance, side="right") + 1)
+    n_components = min(n_components, n_features)
+    components = eigenvectors[:, :n_components]
+
+    pca_data = np.empty((n_samples, n_components))
+    for chunk in chunks:
+        pca_data[chunk] = (rows[:, chunk].T - mean) @ components
+    pca_data = StandardScaler().fit_transform(pca_data)
+    return pca_data, explained_variance_ratio[:n_components]
+
+def load_or_compute_pca_features(input_file, cache_file, chunk_size=100000, refresh=False):
+    """Loads the cached standardized PCA features for an orth.npy, recomputing them if orth.npy has changed."""
+    source_mtime = os.path.getmtime(input_file)
+    if not refresh and op.exists(cache_file):
+        cached = np.load(cache_file)
+        if float(cached["source_mtime"]) == source_mtime:
+            log_message(f"Loaded cached PCA features from {cache_file}")
+            return cached["pca_data"]
+        log_message(f"Cached PCA features in {cache_file} are older than {input_file}, recomputing")
+
+    orthogonalized_data = np.load(input_file, mmap_mode="r")
+    start_time = time.time()
+    pca_data, explained_variance_ratio = streaming_pca_features(orthogonalized_data, chunk_size)
+    log_message(f"Streaming PCA kept {pca_data.shape[1]} components ({np.sum(explained_variance_ratio):.4f} of variance) "
+                f"in {(time.time() - start_time) / 60:.2f} minutes")
+
+    os.makedirs(op.dirname(cache_file), exist_ok=True)
+    # Write under a temporary name so an interrupted job never leaves a truncated cache behind
+    partial_file = cache_file[:-len(".npz")] + ".partial.npz"
+    np.savez(partial_file, pca_data=pca_data, explained_variance_ratio=explained_variance_ratio,
+             source_mtime=source_mtime)
+    os.replace(partial_file, cache_file)
+    return pca_data
+
+def determine_optimal_states(orthogonalized_data, subject, mode, files_out, n_jobs=1, search="exhaustive", coarse_step=3,
+                             warm_start=False, pca_data=None, n_restarts=1, seed=None, engine="hmmlearn"):
+    """Determines the optimal number of states using AIC and BIC criteria.
+
+    If pca_data is given (standardized PCA features from streaming_pca_features), steps 1-4 are skipped.
+    """
+    log_message(f"Starting determine_optimal_states function for subject {subject}, mode {mode}")
+
+    if pca_data is None:
+        pca_data = reduce_in_memory(orthogonalized_data)
 
     log_message("Step 5 - Initializing state range")
     state_numbers = range(3, 17)
 
     os.makedirs(files_out, exist_ok=True)
     aic_bic_file = op.join(files_out, f"aic_bic_{subject}_{mode}.txt")
-    
+    # Step 7 reads the whole file back, so start it afresh rather than mixing in an earlier run's rows
+    open(aic_bic_file, "w").close()
+
     log_message("Step 6 - Iterating through different numbers of states")
-    for n_states in state_numbers:
-        state_start_time = time.time()
-        log_message(f"Processing state: {n_states} | Subject: {subject} | Mode: {mode}")
-        
-        model = hmm.GaussianHMM(n_components=n_states, n_iter=50, covariance_type='full', tol=1e-7, verbose=False)
-        model.fit(pca_data)
-        log_likelihood = model.score(pca_data)
-        n_params = n_states * (2 * pca_data.shape[1] - 1)
-        aic = 2 * n_params - 2 * log_likelihood
-        bic = np.log(pca_data.shape[0]) * n_params - 2 * log_likelihood
-
-        state_elapsed_time = (time.time() - state_start_time) / 60
-        log_message(f"Time taken for state {n_states}: {state_elapsed_time:.2f} minutes")
+    if warm_start and n_restarts > 1:
+        log_message("Warm-started fits do not depend on the random seed, so restarts are not used with --warm_start")
+        n_restarts = 1
+    # A single fit keeps the original unseeded behaviour unless a seed is given
+    if n_restarts == 1:
+        seeds = (seed,)
+    else:
+        seeds = tuple((seed or 0) + restart for restart in range(n_restarts))
+    restart_file = op.join(files_out, f"restart_scores_{subject}_{mode}.txt")
 
-        with open(aic_bic_file, "a") as f:
-            f.write(f"{n_states}\t{aic}\t{bic}\n")
+    sweep_start_time = time.time()
+    if warm_start and n_jobs != 1:
+        log_message("Warm start grows each model from the previous state count, so the sweep runs sequentially")
+    if n_jobs == 1 or warm_start:
+        init_worker(pca_data, warm_start=warm_start, engine=engine)
+        pool = nullcontext()
+    else:
+        pool = ProcessPoolExecutor(max_workers=n_jobs, initializer=init_worker, initargs=(pca_data, 1, False, engine))
+
+    with pool as executor:
+        if search == "adaptive":
+            def evaluate(batch):
+                results = {}
+
+                def record(result):
+                    results[result[0]] = log_state_result(result, subject, mode, restart_file)
+
+                fit_state_counts(batch, executor, subject, mode, record, seeds)
+                return results
+
+            scores = adaptive_state_search(evaluate, state_numbers, coarse_step)
+            log_message(f"Adaptive search evaluated states {sorted(scores)} ({len(scores)} of {len(state_numbers)}) | Subject: {subject} | Mode: {mode}")
+            with open(aic_bic_file, "a") as f:
+                for k in sorted(scores):
+                    f.write(f"{k}\t{scores[k][0]}\t{scores[k][1]}\n")
+        else:
+            scores = sweep_state_counts(state_numbers, executor, aic_bic_file, subject, mode, seeds, restart_file)
+
+    log_message(f"State-count sweep took {(time.time() - sweep_start_time) / 60:.2f} minutes | Subject: {subject} | Mode: {mode}")
+
+    if search == "validate":
+        validation_file = op.join(files_out, f"search_validation_{subject}_{mode}.txt")
+        validate_adaptive_search(scores, state_numbers, coarse_step, validation_file, subject, mode)
 
     log_message("Step 7 - Finding optimal number of states")
     with open(aic_bic_file, "r") as f:
@@ -104,24 +389,50 @@ def determine_optimal_states(orthogonalized_data, subject, mode, files_out):
 
 def main():
     parser = argparse.ArgumentParser(description="Process EEG data for a given subject.")
-    parser.add_argument("--subject_id", type=str, required=True, help="Participant ID")
+    parser.add_argument("--subject_id", type=str, nargs="+", required=True,
+                        help="Participant ID (several IDs validate the adaptive search on a sample of subjects)")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Worker processes for the state-count sweep")
+    parser.add_argument("--search", type=str, default="exhaustive", choices=["exhaustive", "adaptive", "validate"],
+                        help="Fit every state count, only those a coarse-to-fine search needs, "
+                             "or every state count plus a check of the adaptive search against them")
+    parser.add_argument("--warm_start", action="store_true",
+                        help="Seed each state count from the fitted model with fewer states (runs the sweep sequentially)")
+    parser.add_argument("--pca", type=str, default="full", choices=["full", "streaming"],
+                        help="PCA over the whole array in memory, or over chunks of a memory-mapped orth.npy "
+                             "with the features cached for re-runs")
+    parser.add_argument("--pca_chunk", type=int, default=100000, help="Rows per chunk for the streaming PCA")
+    parser.add_argument("--refresh_features", action="store_true", help="Recompute cached streaming PCA features")
+    parser.add_argument("--n_restarts", type=int, default=1,
+                        help="Independently seeded fits per state count, run concurrently; the best log-likelihood is kept")
+    parser.add_argument("--seed", type=int, default=None, help="Base random seed for the HMM fits")
+    parser.add_argument("--engine", type=str, default="hmmlearn", choices=["hmmlearn", "fast"],
+                        help="hmmlearn's GaussianHMM or the compiled full-covariance engine in fast_hmm.py")
+    parser.add_argument("--coarse_step", type=int, default=3, help="Spacing of the adaptive search's coarse grid")
     args = parser.parse_args()
-    subject = args.subject_id
 
     files_out = '/projects/illinois/ahs/kch/nakhan2/ACE/Optimal_States'
     files_in = '/projects/illinois/ahs/kch/nakhan2/ACE/Orthogonalized_data'
 
     modes = ['congruent', 'incongruent']
 
-    for mode in modes:
-        input_file = os.path.join(files_in, subject, mode, f"orth.npy")
-        
-        if os.path.exists(input_file):
-            log_message(f"Loading previously generated orthogonalized data for {subject}, mode {mode}")
-            orthogonalized_data = np.load(input_file)
-            determine_optimal_states(orthogonalized_data, subject, mode, files_out)
-        else:
-            log_message(f"Error: Orthogonalized data not found for {subject}, mode {mode} at {input_file}")
+    for subject in args.subject_id:
+        for mode in modes:
+            input_file = os.path.join(files_in, subject, mode, f"orth.npy")
+
+            if os.path.exists(input_file):
+                options = dict(n_jobs=args.n_jobs, search=args.search, coarse_step=args.coarse_step,
+                               warm_start=args.warm_start, n_restarts=args.n_restarts, seed=args.seed,
+                               engine=args.engine)
+                if args.pca == "streaming":
+                    cache_file = op.join(files_out, "PCA_features", f"{subject}_{mode}_pca_features.npz")
+                    pca_data = load_or_compute_pca_features(input_file, cache_file, args.pca_chunk, args.refresh_features)
+                    determine_optimal_states(None, subject, mode, files_out, pca_data=pca_data, **options)
+                else:
+                    log_message(f"Loading previously generated orthogonalized data for {subject}, mode {mode}")
+                    orthogonalized_data = np.load(input_file)
+                    determine_optimal_states(orthogonalized_data, subject, mode, files_out, **options)
+            else:
+                log_message(f"Error: Orthogonalized data not found for {subject}, mode {mode} at {input_file}")
 
 if __name__ == "__main__":
     log_message("Starting EEG processing script...")
@@ -1,61 +1,213 @@
 import os
+import time
+import tracemalloc
 import numpy as np
 import mne
 import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import nullcontext
+from threadpoolctl import threadpool_limits
 from mne_connectivity import symmetric_orth
 from scipy.signal import hilbert
+from scipy import fft as sp_fft
 
 
-# Parse command-line argument for subject_id
-parser = argparse.ArgumentParser(description="EEG Source Reconstruction")
-parser.add_argument("--subject_id", type=str, required=True, help="Participant ID")
-args = parser.parse_args()
-
-subject_id = args.subject_id
-
-print(f"Processing subject: {subject_id}")
-
 # Define input and output directories
 files_in = '/projects/illinois/ahs/kch/nakhan2/ACE_XZ/TimeCourses'
 files_out = '/projects/illinois/ahs/kch/nakhan2/ACE_XZ/Orthogonalized_data'
 
 modes = ["congruent", "incongruent"]
 
-def apply_orthogonalization(data):
-    """Applies orthogonalization to the given data."""
+def hilbert_envelope(data):
+    """Amplitude envelope from a single full-array scipy.signal.hilbert call."""
     analytic_signal = hilbert(data, axis=2)
-    amplitude_envelope = np.abs(analytic_signal)
+    return np.abs(analytic_signal)
+
+def chunked_envelope(data, chunk_size=16, dtype=np.float64, workers=1, pad=False):
+    """Amplitude envelope computed over epoch chunks, optionally with FFTs padded to a fast length."""
+    n_epochs, n_labels, n_times = data.shape
+    n_fft = sp_fft.next_fast_len(n_times) if pad else n_times
+
+    # Analytic signal weights on the one-sided spectrum: keep DC (and Nyquist), double positive frequencies
+    weights = np.zeros(n_fft // 2 + 1, dtype=dtype)
+    weights[0] = 1
+    if n_fft % 2 == 0:
+        weights[1:n_fft // 2] = 2
+        weights[n_fft // 2] = 1
+    else:
+        weights[1:] = 2
+
+    envelope = np.empty(data.shape, dtype=dtype)
+    for start in range(0, n_epochs, chunk_size):
+        chunk = np.asarray(data[start:start + chunk_size], dtype=dtype)
+        spectrum = sp_fft.rfft(chunk, n=n_fft, axis=2, workers=workers)
+        spectrum *= weights
+        # Only the chunk's complex analytic signal is ever held in memory
+        analytic_signal = sp_fft.ifft(spectrum, n=n_fft, axis=2, workers=workers)
+        envelope[start:start + chunk_size] = np.abs(analytic_signal[:, :, :n_times])
+        del spectrum, analytic_signal
+    return envelope
+
+def compute_envelope(data, envelope_options):
+    """Computes the amplitude envelope with the selected engine."""
+    if envelope_options["engine"] == "hilbert":
+        return hilbert_envelope(data)
+    return chunked_envelope(data, chunk_size=envelope_options["chunk_size"], dtype=envelope_options["dtype"],
+                            workers=envelope_options["fft_workers"], pad=envelope_options["pad"])
+
+def benchmark_envelope(data, subject, mode, envelope_options):
+    """Reports time and peak memory of the full hilbert call against the chunked engine."""
+    chunk_size = envelope_options["chunk_size"]
+    fft_workers = envelope_options["fft_workers"]
+    engines = [("hilbert", hilbert_envelope)]
+    for dtype in [np.float64, np.float32]:
+        for pad in [False, True]:
+            name = f"chunked {np.dtype(dtype).name}{' padded' if pad else ''}"
+            engines.append((name, lambda x, dtype=dtype, pad=pad: chunked_envelope(x, chunk_size, dtype, fft_workers, pad)))
+
+    results = {}
+    for name, engine in engines:
+        tracemalloc.start()
+        start_time = time.time()
+        envelope = engine(data)
+        elapsed_time = time.time() - start_time
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = envelope
+        print(f"[{subject} {mode}] {name}: {elapsed_time:.2f} s, peak memory {peak_memory / 1024 ** 2:.1f} MB")
+
+    # Zero padding to the fast FFT length only changes the envelope near the epoch edges,
+    # so report the difference both over the whole epoch and over its central 90%
+    reference = results["hilbert"]
+    scale = np.max(np.abs(reference))
+    edge = int(0.05 * reference.shape[2])
+    interior = slice(edge, reference.shape[2] - edge)
+    for name, envelope in results.items():
+        if name != "hilbert":
+            diff = np.abs(envelope - reference)
+            print(f"[{subject} {mode}] {name} vs hilbert: max abs diff {np.max(diff):.3e} "
+                  f"(relative {np.max(diff) / scale:.3e}), central 90% max abs diff {np.max(diff[:, :, interior]):.3e} "
+                  f"(relative {np.max(diff[:, :, interior]) / scale:.3e})")
+
+def apply_orthogonalization(data, envelope_options):
+    """Applies orthogonalization to the given data."""
+    amplitude_envelope = compute_envelope(data, envelope_options)
     orthogonalized_data = symmetric_orth(amplitude_envelope)
     orthogonalized_data = orthogonalized_data.reshape(amplitude_envelope.shape)
     return orthogonalized_data
 
-def process_participant(subject, mode, dir_in, dir_out):
-    label_time_courses_file = os.path.join(dir_in, f"{subject}_label_time_courses.npy")
-    
-    if os.path.exists(label_time_courses_file):
+def init_worker(blas_threads=None):
+    """Limits the BLAS threads of a worker process so parallel chunks do not oversubscribe the node."""
+    if blas_threads is not None:
+        threadpool_limits(limits=blas_threads)
+
+def available_cpus():
+    """CPUs this process may run on (the Slurm allocation rather than the whole node, where supported)."""
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+def orthogonalize_chunk(input_file, output_file, start, stop, envelope_options):
+    """Orthogonalizes one chunk of epochs and writes it into the memory-mapped output file."""
+    # symmetric_orth works epoch by epoch, so chunks along the epoch axis are independent
+    label_time_courses = np.load(input_file, mmap_mode="r")
+    orthogonalized_data = apply_orthogonalization(label_time_courses[start:stop], envelope_options)
+
+    output = np.load(output_file, mmap_mode="r+")
+    output[start:stop] = orthogonalized_data
+    output.flush()
+    del output
+    return stop - start
+
+def process_participant(subject, dir_in, dir_out, executor, envelope_options):
+    """Runs both conditions of a participant through one worker pool, writing each orth.npy via a memmap."""
+    tasks = {}
+    for mode in modes:
+        label_time_courses_file = os.path.join(dir_in, mode, f"{subject}_label_time_courses.npy")
+        if not os.path.exists(label_time_courses_file):
+            print(f"File not found: {label_time_courses_file}")
+            continue
+
+        label_time_courses = np.load(label_time_courses_file, mmap_mode="r")
+        print(f"Loaded data for {subject} in mode {mode}")
+
+        output_dir = os.path.join(dir_out, subject, mode)
+        os.makedirs(output_dir, exist_ok=True)
+        output_file_path = os.path.join(output_dir, "orth.npy")
+
+        # Write into a partial file first so an interrupted run never leaves a truncated orth.npy behind
+        partial_file_path = output_file_path + ".partial"
+        output = np.lib.format.open_memmap(partial_file_path, mode="w+", dtype=np.float64,
+                                           shape=label_time_courses.shape)
+        del output
+
+        n_epochs = label_time_courses.shape[0]
+        chunk_size = envelope_options["chunk_size"]
+        futures = [executor.submit(orthogonalize_chunk, label_time_courses_file, partial_file_path,
+                                   start, min(start + chunk_size, n_epochs), envelope_options)
+                   for start in range(0, n_epochs, chunk_size)]
+        tasks[mode] = (futures, partial_file_path, output_file_path)
+
+    for mode, (futures, partial_file_path, output_file_path) in tasks.items():
         try:
-            label_time_courses = np.load(label_time_courses_file)
-            print(f"Loaded data for {subject} in mode {mode}")
-            
-            orthogonalized_data = apply_orthogonalization(label_time_courses)
-            
-            output_file_path = os.path.join(dir_out, "orth.npy")
-            np.save(output_file_path, orthogonalized_data)
+            for future in futures:
+                future.result()
+            os.replace(partial_file_path, output_file_path)
             print(f"File saved successfully for participant {subject}, mode {mode} at {output_file_path}")
-            
-            return orthogonalized_data
         except Exception as e:
             print(f"Error processing {subject} in {mode}: {e}")
+
+def main():
+    # Parse command-line argument for subject_id
+    parser = argparse.ArgumentParser(description="EEG Source Reconstruction")
+    parser.add_argument("--subject_id", type=str, required=True, help="Participant ID")
+    parser.add_argument("--envelope", type=str, default="chunked", choices=["chunked", "hilbert"],
+                        help="Envelope engine: chunked FFT (default) or the full-array scipy.signal.hilbert call")
+    parser.add_argument("--chunk_size", type=int, default=16, help="Epochs per envelope/orthogonalization chunk")
+    parser.add_argument("--float32", action="store_true", help="Compute the envelope in single precision")
+    parser.add_argument("--pad", action="store_true",
+                        help="Zero-pad each FFT to the next fast length (faster, but changes the envelope near epoch edges)")
+    parser.add_argument("--fft_workers", type=int, default=1, help="FFT threads (-1 uses all cores)")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Parallel workers for the orthogonalization chunks")
+    parser.add_argument("--backend", type=str, default="thread", choices=["thread", "process"],
+                        help="Run chunks in worker threads or worker processes")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Compare time and peak memory of the envelope engines instead of saving output")
+    args = parser.parse_args()
+
+    subject_id = args.subject_id
+    envelope_options = {
+        "engine": args.envelope,
+        "chunk_size": args.chunk_size,
+        "dtype": np.float32 if args.float32 else np.float64,
+        "fft_workers": args.fft_workers,
+        "pad": args.pad,
+    }
+
+    print(f"Processing subject: {subject_id}")
+
+    if args.benchmark:
+        for mode in modes:
+            label_time_courses_file = os.path.join(files_in, mode, f"{subject_id}_label_time_courses.npy")
+            if os.path.exists(label_time_courses_file):
+                benchmark_envelope(np.load(label_time_courses_file, mmap_mode="r"), subject_id, mode, envelope_options)
+            else:
+                print(f"File not found: {label_time_courses_file}")
+        return
+
+    # Process the given subject for both modes in one pass over a shared worker pool. Each chunk's
+    # symmetric_orth SVD and matmul get an equal share of the CPUs' BLAS threads
+    blas_threads = max(1, available_cpus() // args.n_jobs) if args.n_jobs > 1 else None
+    if args.backend == "process":
+        executor = ProcessPoolExecutor(max_workers=args.n_jobs, initializer=init_worker, initargs=(blas_threads,))
+        blas_limit = nullcontext()
     else:
-        print(f"File not found: {label_time_courses_file}")
-    
-    return None
-
-# Process the given subject for both modes
-for mode in modes:
-    input_dir = os.path.join(files_in, mode)
-    output_dir = os.path.join(files_out, subject_id, mode)
-    os.makedirs(output_dir, exist_ok=True)
-    process_participant(subject_id, mode, input_dir, output_dir)
-
-print(f"Processing complete for subject: {subject_id}")
+        executor = ThreadPoolExecutor(max_workers=args.n_jobs)
+        # BLAS thread limits are process-wide, so worker threads share one limit held for the whole pool
+        # (a per-chunk context would be undone by the first chunk to finish while others still run)
+        blas_limit = threadpool_limits(limits=blas_threads) if blas_threads is not None else nullcontext()
+    with blas_limit, executor:
+        process_participant(subject_id, files_in, files_out, executor, envelope_options)
+
+    print(f"Processing complete for subject: {subject_id}")
+
+if __name__ == "__main__":
+    main()
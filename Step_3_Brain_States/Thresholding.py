@@ -2,10 +2,12 @@ import os
 import sys
 import time
 import json
+import argparse
 import numpy as np
-import networkx as nx
-from numba import njit
-from scipy import stats
+import numba
+from numba import njit, prange
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from connectivity_store import load_block_correlations, save_thresholded_edges
 
 # -------------------- Load Optimal Alpha & Bootstrap Median --------------------
 
@@ -23,139 +25,135 @@ optimal_alpha, bootstrap_median = load_alpha_and_median(json_path)
 
 def process_participant(participant_dir, participant_id, optimal_alpha, bootstrap_median):
     """Processes each participant's data, applies thresholding, and saves results."""
-    results = {}
     success = True
-    thresholded_correlation_matrices = {}  # Initialize the dictionary to store thresholded matrices
+    processed_modes = []
 
     for mode in ["congruent", "incongruent"]:
-        mode_dir = os.path.join(participant_dir, "Correlation_matrices")
-        if not os.path.exists(mode_dir):
-            print(f"Skipping {participant_id} - {mode}: No correlation matrices found.")
+        print(f"Loading correlation matrices: {participant_id} - {mode}")  # Debugging print
+        try:
+            loaded = load_block_correlations(participant_dir, participant_id, mode)
+            if loaded is None:
+                print(f"Skipping {participant_id} - {mode}: No correlation matrices found.")
+                continue
+
+            block_index, triangles = loaded
+            if len(triangles) == 0:
+                print(f"Warning: No valid correlation matrices found for {participant_id} - {mode}. Skipping...")
+                continue
+
+            thresholded_triangles, thresholded_diagonal = threshold_functional_connectivity(
+                triangles, optimal_alpha, bootstrap_median
+            )
+            save_thresholded_data(participant_dir, mode, participant_id, block_index, thresholded_triangles, thresholded_diagonal)
+            processed_modes.append(mode)
+
+        except Exception as e:
+            print(f"Error processing {participant_id} - {mode}: {e}")
+            success = False
             continue
 
-        correlation_matrices = {}
-        results[mode] = {}
-
-        for filename in os.listdir(mode_dir):
-            if filename.startswith(f"{participant_id}_{mode}_correlation_matrices"):
-                filepath = os.path.join(mode_dir, filename)
-                
-                # Check if the file exists before loading
-                if not os.path.exists(filepath):
-                    print(f"Error: Missing file - {filepath}")
-                    continue
-                
-                print(f"Loading file: {filepath}")  # Debugging print
-                try:
-                    data = np.load(filepath)
-                    #print(f"Loaded keys: {data.files}")  # Debugging print
-
-                    for key in data.files:
-                        try:
-                            tuple_key = tuple(map(int, key.split('_')))
-                            matrix = data[key]  # Directly use the matrix without Fisher's r-to-Z transformation
-                            correlation_matrices[tuple_key] = matrix
-                        except ValueError:
-                            continue  # Skip keys that don't convert to integers
-
-                    if not correlation_matrices:
-                        print(f"Warning: No valid correlation matrices found in {filepath}. Skipping...")
-                        continue
-
-                    thresholded_matrices, pos_corrs, neg_corrs = threshold_functional_connectivity(
-                        correlation_matrices, optimal_alpha, bootstrap_median
-                    )
-                    results[mode]['correlation_matrices'] = correlation_matrices
-                    results[mode]['thresholded_matrices'] = thresholded_matrices
-                    thresholded_correlation_matrices.update(thresholded_matrices)  # Store thresholded matrices
-                    save_thresholded_data(participant_dir, mode, participant_id, thresholded_matrices, pos_corrs, neg_corrs)
-                
-                except Exception as e:
-                    print(f"Error processing {filepath}: {e}")
-                    success = False
-                    continue
+    return success, processed_modes
 
-    return results, success, thresholded_correlation_matrices  # Return the thresholded matrices along with other results
+def init_worker(numba_threads=None):
+    """Limits the numba threads of a worker process so concurrent participants do not oversubscribe the node."""
+    if numba_threads is not None:
+        numba.set_num_threads(numba_threads)
 
 # -------------------- Save Thresholded --------------------
 
-def save_thresholded_data(participant_dir, mode, participant_id, thresholded_matrices, pos_corrs, neg_corrs):
-    """Saves thresholded data in .npz format with properly formatted keys."""
-    
+def save_thresholded_data(participant_dir, mode, participant_id, block_index, thresholded_triangles, thresholded_diagonal):
+    """Saves thresholded data as sparse (CSR) surviving edges with their (state, block) index."""
+
     new_dir = os.path.join(participant_dir, "Thresholded_matrices", mode)
-    os.makedirs(new_dir, exist_ok=True)
-    
     print(f"Saving thresholded data to: {new_dir}")  # Debugging print
-    
-    # Convert tuple keys to string keys
-    thresholded_matrices_str_keys = { "_".join(map(str, key)): value for key, value in thresholded_matrices.items() }
-    pos_corrs_str_keys = { "_".join(map(str, key)): value for key, value in pos_corrs.items() }
-    neg_corrs_str_keys = { "_".join(map(str, key)): value for key, value in neg_corrs.items() }
-    
-    # Save with proper string keys
-    np.savez(os.path.join(new_dir, f"{participant_id}_{mode}_thresholded_matrices.npz"), **thresholded_matrices_str_keys)
-    np.savez(os.path.join(new_dir, f"{participant_id}_{mode}_thresholded_pos_corrs.npz"), **pos_corrs_str_keys)
-    np.savez(os.path.join(new_dir, f"{participant_id}_{mode}_thresholded_neg_corrs.npz"), **neg_corrs_str_keys)
+
+    # Only the non-zero upper-triangle entries are stored (connectivity_store.save_thresholded_edges);
+    # positive / negative thresholded values are not saved separately either, they are the signs of
+    # these values
+    save_thresholded_edges(participant_dir, participant_id, mode, block_index, thresholded_triangles, thresholded_diagonal)
 
 # -------------------- Apply Threshold --------------------
 
-@njit
-def apply_threshold(corr_matrix, optimal_alpha_squared, bootstrap_median):
-    """Applies the threshold to a single correlation matrix using numba for acceleration."""
-    size = corr_matrix.shape[0]
-    thresholded_matrix = np.zeros_like(corr_matrix)
-    
-    for i in range(size):
-        for j in range(size):
-            normalized_weight = corr_matrix[i, j] / bootstrap_median
+@njit(parallel=True, cache=True)
+def apply_threshold(triangles, optimal_alpha_squared, bootstrap_median):
+    """Applies the threshold to a stack of (N x n_pairs) upper triangles in one pass, in parallel over matrices."""
+    n_matrices, n_pairs = triangles.shape
+    thresholded_triangles = np.zeros_like(triangles)
+
+    for m in prange(n_matrices):
+        for k in range(n_pairs):
+            normalized_weight = triangles[m, k] / bootstrap_median
             if normalized_weight ** 2 >= optimal_alpha_squared:
-                thresholded_matrix[i, j] = corr_matrix[i, j]
-    
-    return thresholded_matrix
+                thresholded_triangles[m, k] = triangles[m, k]
+
+    return thresholded_triangles
 
 # -------------------- Threshold Functional Connectivity --------------------
 
-def threshold_functional_connectivity(correlation_matrices, optimal_alpha, bootstrap_median):
-    """Applies threshold based on alpha and bootstrap_median to filter correlation matrices."""
-    thresholded_correlation_matrices = {}
-    thresholded_positive_correlations = {}
-    thresholded_negative_correlations = {}
+def threshold_functional_connectivity(triangles, optimal_alpha, bootstrap_median):
+    """Applies threshold based on alpha and bootstrap_median to a participant's stacked correlation matrices.
+
+    Returns the thresholded upper triangles and the value of the (unit) diagonal after thresholding.
+    """
     optimal_alpha_squared = optimal_alpha ** 2
+    thresholded_triangles = apply_threshold(np.ascontiguousarray(triangles), optimal_alpha_squared, bootstrap_median)
+    thresholded_diagonal = 1.0 if (1.0 / bootstrap_median) ** 2 >= optimal_alpha_squared else 0.0
+    return thresholded_triangles, thresholded_diagonal
+
+# -------------------- Main Execution --------------------
 
-    for key, corr_matrix in correlation_matrices.items():
-        thresholded_matrix = apply_threshold(corr_matrix, optimal_alpha_squared, bootstrap_median)
-        thresholded_correlation_matrices[key] = thresholded_matrix
-        thresholded_positive_correlations[key] = thresholded_matrix[thresholded_matrix > 0]
-        thresholded_negative_correlations[key] = thresholded_matrix[thresholded_matrix < 0]
+def main():
+    parser = argparse.ArgumentParser(description="Threshold every participant's state-block correlation matrices")
+    parser.add_argument("--n_jobs", type=int, default=1, help="Participants thresholded concurrently")
+    args = parser.parse_args()
 
-    return thresholded_correlation_matrices, thresholded_positive_correlations, thresholded_negative_correlations
+    start_time = time.time()
+    base_dir = "/projects/illinois/ahs/kch/nakhan2/ACE/HMM_Output"
+    participants = sorted(p for p in os.listdir(base_dir) if not p.startswith("alpha"))  # Adjust if needed
 
-# -------------------- Main Execution --------------------
+    # Updated file path for the .json
 
-start_time = time.time()
-base_dir = "/projects/illinois/ahs/kch/nakhan2/ACE/HMM_Output"
-participants = [p for p in os.listdir(base_dir) if not p.startswith("alpha")]  # Adjust if needed
 
-# Updated file path for the .json
 
+    print(f"Processing {len(participants)} participants...")
+    failed_participants = []
 
+    if args.n_jobs == 1:
+        for idx, participant in enumerate(participants):
+            participant_dir = os.path.join(base_dir, participant)
+            success, _ = process_participant(participant_dir, participant, optimal_alpha, bootstrap_median)
+            if not success:
+                failed_participants.append(participant)
 
-print(f"Processing {len(participants)} participants...")
-all_thresholded_matrices = {}
+            sys.stdout.write(f"\rProcessed {idx + 1}/{len(participants)} participants ({(idx + 1) / len(participants) * 100:.2f}%)")
+            sys.stdout.flush()
+    else:
+        # Share the cores between concurrent participants and each one's parallel threshold kernel
+        numba_threads = max(1, numba.config.NUMBA_NUM_THREADS // args.n_jobs)
+        with ProcessPoolExecutor(max_workers=args.n_jobs, initializer=init_worker, initargs=(numba_threads,)) as executor:
+            futures = {executor.submit(process_participant, os.path.join(base_dir, participant), participant,
+                                       optimal_alpha, bootstrap_median): participant for participant in participants}
+            for idx, future in enumerate(as_completed(futures)):
+                participant = futures[future]
+                try:
+                    success, _ = future.result()
+                except Exception as e:
+                    print(f"Error processing {participant}: {e}")
+                    success = False
+                if not success:
+                    failed_participants.append(participant)
 
-for idx, participant in enumerate(sorted(participants)):
-    participant_dir = os.path.join(base_dir, participant)
-   
-    results, success, thresholded_matrices = process_participant(participant_dir, participant, optimal_alpha, bootstrap_median)
-    if success:
-        all_thresholded_matrices[participant] = thresholded_matrices
+                sys.stdout.write(f"\rProcessed {idx + 1}/{len(participants)} participants ({(idx + 1) / len(participants) * 100:.2f}%)")
+                sys.stdout.flush()
 
-    sys.stdout.write(f"\rProcessed {idx + 1}/{len(participants)} participants ({(idx + 1) / len(participants) * 100:.2f}%)")
-    sys.stdout.flush()
+    print("\nAll participants processed.")
+    if failed_participants:
+        print(f"Participants with errors: {', '.join(sorted(failed_participants))}")
 
-print("\nAll participants processed.")
+    # -------------------- Timing --------------------
 
-# -------------------- Timing --------------------
+    total_time_taken = (time.time() - start_time) / 60
+    print(f"Total processing time: {total_time_taken:.2f} minutes.")
 
-total_time_taken = (time.time() - start_time) / 60
-print(f"Total processing time: {total_time_taken:.2f} minutes.")
+if __name__ == "__main__":
+    main()
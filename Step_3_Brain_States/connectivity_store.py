@@ -0,0 +1,279 @@
+import os
+import numpy as np
+
+# -------------------- State-Block Correlation Matrix Store --------------------
+
+# Each participant and mode's state-block correlation matrices are stored as two .npy files in
+# <participant>/Correlation_matrices:
+#   {participant}_{mode}_block_correlations.npy        float32 (n_blocks x n_pairs) upper triangles (k=1)
+#   {participant}_{mode}_block_correlations_index.npy  int32 (n_blocks x 2) (state, block) rows
+# The correlation matrices are symmetric with a unit diagonal, so the strict upper triangle holds all
+# of their information (5151 values for 102 parcels). Triangles are loaded memory-mapped, so a
+# consumer only reads the rows it touches. Outputs written by earlier versions of
+# HMM_fitting-new.py ({participant}_{mode}_correlation_matrices.npy.npz, one member per "state_block"
+# key) are still read, through the same interface.
+
+def store_paths(participant_dir, participant, mode):
+    """The (triangles, index) files of one participant and mode."""
+    stem = os.path.join(participant_dir, "Correlation_matrices", f"{participant}_{mode}_block_correlations")
+    return stem + ".npy", stem + "_index.npy"
+
+def legacy_path(participant_dir, participant, mode):
+    """The per-key npz written by earlier versions of HMM_fitting-new.py."""
+    return os.path.join(participant_dir, "Correlation_matrices", f"{participant}_{mode}_correlation_matrices.npy.npz")
+
+def has_block_correlations(participant_dir, participant, mode):
+    """True if either the store or a legacy npz exists for this participant and mode."""
+    triangles_file, index_file = store_paths(participant_dir, participant, mode)
+    return (os.path.exists(triangles_file) and os.path.exists(index_file)) or \
+        os.path.exists(legacy_path(participant_dir, participant, mode))
+
+def store_fingerprint(participant_dir, participant, mode):
+    """(mtime_ns, size) of the stored files (or legacy npz), changing whenever they are rewritten; None if nothing is stored."""
+    triangles_file, index_file = store_paths(participant_dir, participant, mode)
+    if os.path.exists(triangles_file) and os.path.exists(index_file):
+        files = (triangles_file, index_file)
+    elif os.path.exists(legacy_path(participant_dir, participant, mode)):
+        files = (legacy_path(participant_dir, participant, mode),)
+    else:
+        return None
+    return tuple(value for stored_file in files for value in (os.stat(stored_file).st_mtime_ns, os.path.getsize(stored_file)))
+
+def n_parcels_from_pairs(n_pairs):
+    """Parcel count L with L * (L - 1) / 2 == n_pairs."""
+    n_parcels = int(round((1 + np.sqrt(1 + 8 * n_pairs)) / 2))
+    if n_parcels * (n_parcels - 1) // 2 != n_pairs:
+        raise ValueError(f"{n_pairs} is not the length of a strict upper triangle.")
+    return n_parcels
+
+def upper_triangles(matrices):
+    """Strict upper triangles (k=1) of a stack of square matrices, as float32 (N x n_pairs)."""
+    matrices = np.asarray(matrices)
+    rows, cols = np.triu_indices(matrices.shape[-1], k=1)
+    return matrices[..., rows, cols].astype(np.float32)
+
+def unpack_matrices(triangles, diagonal=1.0):
+    """Rebuilds symmetric float64 (N x L x L) matrices from upper triangles."""
+    triangles = np.asarray(triangles)
+    n_parcels = n_parcels_from_pairs(triangles.shape[-1])
+    rows, cols = np.triu_indices(n_parcels, k=1)
+    matrices = np.empty(triangles.shape[:-1] + (n_parcels, n_parcels))
+    matrices[..., rows, cols] = triangles
+    matrices[..., cols, rows] = triangles
+    diagonal_indices = np.arange(n_parcels)
+    matrices[..., diagonal_indices, diagonal_indices] = diagonal
+    return matrices
+
+def save_block_correlations(participant_dir, participant, mode, block_index, matrices):
+    """Stores one participant and mode's (state, block) index and (N x L x L) correlation matrices."""
+    triangles_file, index_file = store_paths(participant_dir, participant, mode)
+    os.makedirs(os.path.dirname(triangles_file), exist_ok=True)
+    # Write under temporary names so concurrent readers never see a partial file; the index goes
+    # last, since readers require it
+    for final_file, array in ((triangles_file, upper_triangles(matrices)),
+                              (index_file, np.asarray(block_index, dtype=np.int32).reshape(-1, 2))):
+        partial_file = final_file[:-len(".npy")] + ".partial.npy"
+        np.save(partial_file, array)
+        os.replace(partial_file, final_file)
+
+def load_legacy(legacy_file):
+    """Reads a legacy per-key npz into an (index, triangles) pair, skipping keys that are not "state_block"."""
+    block_index = []
+    triangles = []
+    with np.load(legacy_file) as data:
+        for key in data.files:
+            try:
+                state, block = map(int, key.split('_'))
+            except ValueError:
+                continue
+            matrix = data[key]
+            if matrix.ndim != 2:
+                continue
+            block_index.append((state, block))
+            triangles.append(upper_triangles(matrix))
+    if not triangles:
+        return np.empty((0, 2), dtype=np.int32), np.empty((0, 0), dtype=np.float32)
+    return np.array(block_index, dtype=np.int32), np.stack(triangles)
+
+def load_block_correlations(participant_dir, participant, mode, mmap=True):
+    """Loads one participant and mode's (index, triangles), or None if neither store nor legacy file exists.
+
+    index is (n_blocks x 2) (state, block) and triangles (n_blocks x n_pairs) float32, memory-mapped
+    unless mmap is False or the data come from a legacy npz.
+    """
+    triangles_file, index_file = store_paths(participant_dir, participant, mode)
+    if os.path.exists(triangles_file) and os.path.exists(index_file):
+        return np.load(index_file), np.load(triangles_file, mmap_mode='r' if mmap else None)
+    legacy_file = legacy_path(participant_dir, participant, mode)
+    if os.path.exists(legacy_file):
+        return load_legacy(legacy_file)
+    return None
+
+def block_keys(block_index):
+    """(state, block) tuples of an index, in row order."""
+    return [tuple(row) for row in np.asarray(block_index).tolist()]
+
+def load_correlation_matrices(participant_dir, participant, mode):
+    """Dict of (state, block) -> full correlation matrix, or an empty dict if none are stored."""
+    loaded = load_block_correlations(participant_dir, participant, mode)
+    if loaded is None:
+        return {}
+    block_index, triangles = loaded
+    return dict(zip(block_keys(block_index), unpack_matrices(triangles)))
+
+def load_block_matrix(participant_dir, participant, mode, state, block):
+    """The full correlation matrix of a single (state, block), reading only its row of the store."""
+    loaded = load_block_correlations(participant_dir, participant, mode)
+    if loaded is None:
+        raise FileNotFoundError(f"No correlation matrices stored for {participant}, mode {mode} in {participant_dir}.")
+    block_index, triangles = loaded
+    rows = np.flatnonzero((block_index[:, 0] == state) & (block_index[:, 1] == block))
+    if len(rows) == 0:
+        available_keys = [f"{s}_{b}" for s, b in block_keys(block_index)]
+        raise KeyError(f"Key {state}_{block} not found. Available keys: {available_keys[:10]}{'...' if len(available_keys)>10 else ''}")
+    return unpack_matrices(triangles[rows[0]])
+
+# -------------------- Positive / Negative Views --------------------
+
+# The positive and negative upper-triangle values of each block are derived from the triangles on
+# demand instead of being saved as separate (pickled) files. The optional sign index caches, per
+# block, packbits bitmasks of the positive and negative entries next to the store, so the split and
+# the per-sign edge counts can be had without comparing every value again.
+
+def signs_path(participant_dir, participant, mode):
+    """The cached sign index of one participant and mode."""
+    return store_paths(participant_dir, participant, mode)[0][:-len(".npy")] + "_signs.npy"
+
+def sign_index(triangles):
+    """Packed (n_blocks x 2 x n_bytes) uint8 bitmasks of the positive ([:, 0]) and negative ([:, 1]) entries."""
+    triangles = np.asarray(triangles)
+    return np.stack([np.packbits(triangles > 0, axis=-1), np.packbits(triangles < 0, axis=-1)], axis=1)
+
+def load_sign_index(participant_dir, participant, mode, triangles=None):
+    """The cached sign index, rebuilt (and re-cached) when missing or older than the stored triangles.
+
+    Legacy npz data have no store to cache next to, so their index is built but not saved.
+    """
+    triangles_file = store_paths(participant_dir, participant, mode)[0]
+    signs_file = signs_path(participant_dir, participant, mode)
+    if os.path.exists(signs_file) and os.path.exists(triangles_file) and \
+            os.path.getmtime(signs_file) >= os.path.getmtime(triangles_file):
+        return np.load(signs_file)
+
+    if triangles is None:
+        loaded = load_block_correlations(participant_dir, participant, mode)
+        if loaded is None:
+            raise FileNotFoundError(f"No correlation matrices stored for {participant}, mode {mode} in {participant_dir}.")
+        triangles = loaded[1]
+    signs = sign_index(triangles)
+    if os.path.exists(triangles_file):
+        partial_file = signs_file[:-len(".npy")] + ".partial.npy"
+        np.save(partial_file, signs)
+        os.replace(partial_file, signs_file)
+    return signs
+
+def sign_values(triangles, row, positive=True, signs=None):
+    """Positive (or negative) upper-triangle values of one block, using the sign index if given."""
+    triangle = np.asarray(triangles[row])
+    if signs is None:
+        mask = triangle > 0 if positive else triangle < 0
+    else:
+        mask = np.unpackbits(signs[row, 0 if positive else 1], count=triangle.shape[-1]).astype(bool)
+    return triangle[mask]
+
+def sign_counts(signs):
+    """(n_blocks x 2) numbers of positive and negative entries per block, from a sign index."""
+    return np.unpackbits(signs, axis=-1).sum(axis=-1)
+
+def load_sign_views(participant_dir, participant, mode, use_index=False):
+    """(positive, negative) dicts of (state, block) -> upper-triangle values, or two empty dicts if none are stored.
+
+    These are the views HMM_fitting-new.py used to save as _positive_correlations / _negative_correlations.
+    """
+    loaded = load_block_correlations(participant_dir, participant, mode)
+    if loaded is None:
+        return {}, {}
+    block_index, triangles = loaded
+    signs = load_sign_index(participant_dir, participant, mode, triangles) if use_index else None
+    positive_correlations = {}
+    negative_correlations = {}
+    for row, key in enumerate(block_keys(block_index)):
+        positive_correlations[key] = sign_values(triangles, row, True, signs)
+        negative_correlations[key] = sign_values(triangles, row, False, signs)
+    return positive_correlations, negative_correlations
+
+# -------------------- Thresholded Edges --------------------
+
+# After the alpha cut most upper-triangle entries are exact zeros, so each participant and mode's
+# thresholded matrices are stored sparse, as one CSR array over (block x upper-triangle pair), in
+# Thresholded_matrices/{mode}/{participant}_{mode}_thresholded_edges.npz:
+#   block_index (n_blocks x 2) (state, block) rows, indptr (n_blocks + 1), pairs (one index per
+#   surviving edge into the row-major k=1 upper triangle, np.triu_indices(n_parcels, k=1) order;
+#   uint16 when the triangle has at most 65535 pairs, uint32 otherwise), values (float32),
+#   n_parcels, and diagonal (the value of the unit diagonal after thresholding).
+# Each block's edge count is a difference of indptr, and its surviving edges a slice, so consumers
+# never scan the zeros. Dense "state_block" npz files written by earlier versions of Thresholding.py
+# are still read, through the same interface.
+
+def thresholded_paths(participant_dir, participant, mode):
+    """The (sparse, legacy dense) thresholded files of one participant and mode."""
+    mode_dir = os.path.join(participant_dir, "Thresholded_matrices", mode)
+    return (os.path.join(mode_dir, f"{participant}_{mode}_thresholded_edges.npz"),
+            os.path.join(mode_dir, f"{participant}_{mode}_thresholded_matrices.npz"))
+
+def has_thresholded_edges(participant_dir, participant, mode):
+    """True if either sparse or legacy dense thresholded matrices exist for this participant and mode."""
+    return any(os.path.exists(path) for path in thresholded_paths(participant_dir, participant, mode))
+
+def sparse_edges(block_index, thresholded_triangles, diagonal=1.0):
+    """CSR edges (see above) of a stack of thresholded upper triangles."""
+    thresholded_triangles = np.asarray(thresholded_triangles)
+    n_pairs = thresholded_triangles.shape[1]
+    rows, pairs = np.nonzero(thresholded_triangles)
+    indptr = np.zeros(len(thresholded_triangles) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=len(thresholded_triangles)))
+    return {
+        "block_index": np.asarray(block_index, dtype=np.int32).reshape(-1, 2),
+        "indptr": indptr,
+        "pairs": pairs.astype(np.uint16 if n_pairs <= np.iinfo(np.uint16).max else np.uint32),
+        "values": thresholded_triangles[rows, pairs].astype(np.float32),
+        "n_parcels": np.int64(n_parcels_from_pairs(n_pairs)),
+        "diagonal": np.float64(diagonal),
+    }
+
+def save_thresholded_edges(participant_dir, participant, mode, block_index, thresholded_triangles, diagonal=1.0):
+    """Stores one participant and mode's thresholded upper triangles as CSR edges."""
+    edges_file = thresholded_paths(participant_dir, participant, mode)[0]
+    os.makedirs(os.path.dirname(edges_file), exist_ok=True)
+    # Write under a temporary name so concurrent readers never see a partial file
+    partial_file = edges_file[:-len(".npz")] + ".partial.npz"
+    np.savez(partial_file, **sparse_edges(block_index, thresholded_triangles, diagonal))
+    os.replace(partial_file, edges_file)
+
+def load_thresholded_edges(participant_dir, participant, mode):
+    """Loads one participant and mode's CSR edges as a dict of arrays, or None if nothing is stored."""
+    edges_file, legacy_file = thresholded_paths(participant_dir, participant, mode)
+    if os.path.exists(edges_file):
+        with np.load(edges_file) as saved:
+            return {key: saved[key] for key in saved.files}
+    if os.path.exists(legacy_file):
+        block_index, triangles = load_legacy(legacy_file)
+        diagonal = 1.0
+        with np.load(legacy_file) as data:
+            if data.files:
+                diagonal = float(data[data.files[0]][0, 0])
+        if len(triangles) == 0:
+            return None
+        return sparse_edges(block_index, triangles, diagonal)
+    return None
+
+def edge_counts(edges):
+    """Number of surviving (upper-triangle) edges of every block."""
+    return np.diff(edges["indptr"])
+
+def block_edges(edges, row):
+    """(i, j, value) arrays of the surviving edges, i < j, of one block (row of the index)."""
+    start, end = edges["indptr"][row], edges["indptr"][row + 1]
+    rows, cols = np.triu_indices(int(edges["n_parcels"]), k=1)
+    pairs = edges["pairs"][start:end]
+    return rows[pairs], cols[pairs], edges["values"][start:end]
@@ -0,0 +1,165 @@
+import os
+import numpy as np
+from numba import njit
+
+# -------------------- Mergeable Cohort Edge-Weight Summaries --------------------
+
+# Bootstrapping.py needs four things from the cohort's edge weights: their 5th / 95th percentiles,
+# the bootstrap median, and the alpha objective (the cohort mean of each matrix's mean squared
+# normalized weight at or above alpha). A summary holds enough to compute all of them, takes
+# memory independent of the number of matrices, and two summaries merge exactly, so a cohort can be
+# streamed one participant at a time:
+# * "histogram": edge-weight counts on HISTOGRAM_BINS fixed bins over [-1, 1] (the weights are
+#   correlations), from which quantiles are read to within one bin width (3e-5);
+# * "count", "mean", "m2", "m3": running moments (merged with the pairwise update of Chan et al. /
+#   Pebay), which give the analytic bootstrap median;
+# * "threshold_sums": for every |w| threshold t on THRESHOLD_GRID, the sum over matrices of the mean
+#   w^2 over the full matrix's entries with |w| >= t. A squared normalized weight (w / median)^2 is
+#   >= alpha exactly when |w| >= |median| * sqrt(alpha), so the objective at any alpha is
+#   threshold_sums at that t (interpolated on the grid) / (n_matrices * median^2), whatever the
+#   median turns out to be.
+# Summaries also count their out-of-bounds matrices, and are saved per participant and mode with a
+# fingerprint of the files they were computed from, so a cohort update only summarizes new or
+# changed participants before merging.
+# Edge weights follow Bootstrapping.edge_weights: the non-zero upper-triangle entries plus the unit
+# diagonal of every matrix. NaN weights are left out.
+
+HISTOGRAM_BINS = 2 ** 16
+THRESHOLD_GRID = np.linspace(0.0, 1.0, 10001)
+
+def empty_summary():
+    """The summary of no matrices."""
+    return {
+        "n_matrices": np.int64(0),
+        "n_out_of_bounds": np.int64(0),
+        "histogram": np.zeros(HISTOGRAM_BINS, dtype=np.int64),
+        "count": np.int64(0),
+        "mean": np.float64(0.0),
+        "m2": np.float64(0.0),
+        "m3": np.float64(0.0),
+        "threshold_sums": np.zeros(len(THRESHOLD_GRID)),
+    }
+
+def merge_moments(a, b):
+    """Merged (count, mean, m2, m3) of two sets of values, each given as a (count, mean, m2, m3) tuple."""
+    count_a, mean_a, m2_a, m3_a = a
+    count_b, mean_b, m2_b, m3_b = b
+    count = count_a + count_b
+    if count_a == 0 or count_b == 0:
+        return b if count_a == 0 else a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+    m3 = (m3_a + m3_b + delta ** 3 * count_a * count_b * (count_a - count_b) / count ** 2
+          + 3 * delta * (count_a * m2_b - count_b * m2_a) / count)
+    return count, mean, m2, m3
+
+def merge_summaries(a, b):
+    """Exact merge of two summaries."""
+    count, mean, m2, m3 = merge_moments((a["count"], a["mean"], a["m2"], a["m3"]),
+                                        (b["count"], b["mean"], b["m2"], b["m3"]))
+    return {
+        "n_matrices": a["n_matrices"] + b["n_matrices"],
+        "n_out_of_bounds": a["n_out_of_bounds"] + b["n_out_of_bounds"],
+        "histogram": a["histogram"] + b["histogram"],
+        "count": np.int64(count),
+        "mean": np.float64(mean),
+        "m2": np.float64(m2),
+        "m3": np.float64(m3),
+        "threshold_sums": a["threshold_sums"] + b["threshold_sums"],
+    }
+
+@njit(cache=True)
+def accumulate_threshold_sums(sorted_abs, suffix_squares, n_valid, n_parcels, grid, threshold_sums):
+    """Adds every matrix's mean w^2 over full-matrix entries with |w| >= t, for each t of the grid.
+
+    sorted_abs holds each matrix's sorted |upper-triangle| values (NaNs last) and suffix_squares the
+    suffix sums of the matching w^2; off-diagonal pairs count twice and the unit diagonal once.
+    """
+    for m in range(sorted_abs.shape[0]):
+        position = 0
+        for k in range(grid.shape[0]):
+            while position < n_valid[m] and sorted_abs[m, position] < grid[k]:
+                position += 1
+            diagonal_count = n_parcels if grid[k] <= 1.0 else 0
+            count = 2 * (n_valid[m] - position) + diagonal_count
+            if count > 0:
+                threshold_sums[k] += (2 * suffix_squares[m, position] + diagonal_count) / count
+
+def summarize_triangles(triangles):
+    """Summary of a stack of (N x n_pairs) correlation-matrix upper triangles."""
+    triangles = np.asarray(triangles, dtype=np.float64)
+    n_matrices, n_pairs = triangles.shape
+    n_parcels = int(round((1 + np.sqrt(1 + 8 * n_pairs)) / 2))
+    summary = empty_summary()
+    if n_matrices == 0:
+        return summary
+
+    weights = triangles[(triangles != 0) & ~np.isnan(triangles)]
+    weights = np.concatenate([weights, np.ones(n_matrices * n_parcels)])
+    summary["n_matrices"] = np.int64(n_matrices)
+    summary["n_out_of_bounds"] = np.int64(np.sum(np.any((triangles < -1) | (triangles > 1), axis=1)))
+    summary["histogram"] = np.histogram(np.clip(weights, -1, 1), bins=HISTOGRAM_BINS, range=(-1, 1))[0].astype(np.int64)
+    summary["count"] = np.int64(len(weights))
+    summary["mean"] = np.mean(weights)
+    centred = weights - summary["mean"]
+    summary["m2"] = np.sum(centred ** 2)
+    summary["m3"] = np.sum(centred ** 3)
+
+    sorted_order = np.argsort(np.abs(triangles), axis=1)
+    sorted_abs = np.take_along_axis(np.abs(triangles), sorted_order, axis=1)
+    sorted_squares = np.nan_to_num(np.take_along_axis(triangles, sorted_order, axis=1) ** 2)
+    suffix_squares = np.zeros((n_matrices, n_pairs + 1))
+    suffix_squares[:, :-1] = np.cumsum(sorted_squares[:, ::-1], axis=1)[:, ::-1]
+    n_valid = np.sum(~np.isnan(triangles), axis=1)
+    accumulate_threshold_sums(sorted_abs, suffix_squares, n_valid, n_parcels, THRESHOLD_GRID, summary["threshold_sums"])
+    return summary
+
+def summary_percentile(summary, percentile):
+    """Percentile of the summarized weights (np.percentile's linear definition), to within one histogram bin."""
+    bin_width = 2.0 / HISTOGRAM_BINS
+    # Rank (0-based, fractional) of the requested percentile among the sorted weights
+    rank = percentile / 100 * (summary["count"] - 1)
+    cumulative = np.cumsum(summary["histogram"])
+    bin_index = int(np.searchsorted(cumulative, rank, side="right"))
+    below = cumulative[bin_index - 1] if bin_index > 0 else 0
+    # Spread the bin's weights evenly across it
+    fraction = (rank - below + 0.5) / summary["histogram"][bin_index]
+    return -1.0 + (bin_index + min(max(fraction, 0.0), 1.0)) * bin_width
+
+def summary_bootstrap_median(summary, num_iterations=10000):
+    """Analytic bootstrap median (Bootstrapping.analytic_bootstrap_median) from the summarized moments."""
+    mean = summary["mean"]
+    variance = summary["m2"] / summary["count"]
+    if variance == 0:
+        return mean
+    skewness = (summary["m3"] / summary["count"]) / variance ** 1.5
+    return mean - skewness * np.sqrt(variance) / (6 * num_iterations)
+
+def summary_objective(summary, bootstrap_median, alpha):
+    """The alpha objective of Bootstrapping.threshold_objective, interpolated on the |w| threshold grid."""
+    threshold = abs(bootstrap_median) * np.sqrt(alpha) if alpha > 0 else 0.0
+    if threshold > THRESHOLD_GRID[-1]:
+        return 0.0
+    return np.interp(threshold, THRESHOLD_GRID, summary["threshold_sums"]) / (summary["n_matrices"] * bootstrap_median ** 2)
+
+def save_summary(summary_file, summary, fingerprint):
+    """Saves a summary with the fingerprint of its source files to an npz file."""
+    os.makedirs(os.path.dirname(summary_file), exist_ok=True)
+    # Write under a temporary name so concurrent readers never see a partial file
+    partial_file = summary_file[:-len(".npz")] + ".partial.npz"
+    np.savez(partial_file, fingerprint=np.array(fingerprint, dtype=np.int64), **summary)
+    os.replace(partial_file, summary_file)
+
+def load_summary(summary_file):
+    """Loads a summary saved by save_summary as (summary, fingerprint), or (None, None) if it is unreadable or
+    was computed on a different histogram / threshold grid."""
+    try:
+        with np.load(summary_file) as saved:
+            summary = {key: saved[key][()] for key in empty_summary()}
+            fingerprint = tuple(saved["fingerprint"].tolist())
+    except (OSError, KeyError, ValueError):
+        return None, None
+    if summary["histogram"].shape != (HISTOGRAM_BINS,) or summary["threshold_sums"].shape != THRESHOLD_GRID.shape:
+        return None, None
+    return summary, fingerprint
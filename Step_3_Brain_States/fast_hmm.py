@@ -0,0 +1,413 @@
+import time
+import numpy as np
+from scipy import linalg
+from sklearn import cluster
+from sklearn.utils import check_random_state
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# -------------------- Full-Covariance Gaussian HMM Engine --------------------
+
+# A drop-in replacement for hmmlearn's GaussianHMM(covariance_type='full') covering the calls made
+# in Step 3 (fit, score, predict, predict_proba, monitor_.iter). Emission log-likelihoods use one
+# Cholesky factor per state, computed once per parameter update and shared by every sequence, and
+# the forward-backward and Viterbi recursions are compiled with numba when it is installed
+# (vectorized NumPy over states otherwise). EM matches hmmlearn's updates and default priors, so
+# from the same initial parameters both engines reach the same model.
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _forward_scaled(startprob, transmat, frameprob):
+        n_samples, n_components = frameprob.shape
+        fwdlattice = np.empty((n_samples, n_components))
+        scaling = np.empty(n_samples)
+        for t in range(n_samples):
+            total = 0.0
+            for j in range(n_components):
+                if t == 0:
+                    value = startprob[j]
+                else:
+                    value = 0.0
+                    for i in range(n_components):
+                        value += fwdlattice[t - 1, i] * transmat[i, j]
+                value *= frameprob[t, j]
+                fwdlattice[t, j] = value
+                total += value
+            scaling[t] = total
+            for j in range(n_components):
+                fwdlattice[t, j] /= total
+        return fwdlattice, scaling
+
+    @njit(cache=True)
+    def _backward_scaled(transmat, frameprob, scaling):
+        n_samples, n_components = frameprob.shape
+        bwdlattice = np.ones((n_samples, n_components))
+        for t in range(n_samples - 2, -1, -1):
+            for i in range(n_components):
+                value = 0.0
+                for j in range(n_components):
+                    value += transmat[i, j] * frameprob[t + 1, j] * bwdlattice[t + 1, j]
+                bwdlattice[t, i] = value / scaling[t + 1]
+        return bwdlattice
+
+    @njit(cache=True)
+    def _xi_sum_scaled(fwdlattice, transmat, bwdlattice, frameprob, scaling):
+        n_samples, n_components = frameprob.shape
+        xi_sum = np.zeros((n_components, n_components))
+        for t in range(n_samples - 1):
+            for i in range(n_components):
+                for j in range(n_components):
+                    xi_sum[i, j] += (fwdlattice[t, i] * transmat[i, j] * frameprob[t + 1, j]
+                                     * bwdlattice[t + 1, j] / scaling[t + 1])
+        return xi_sum
+
+    @njit(cache=True)
+    def _viterbi(log_startprob, log_transmat, log_frameprob):
+        n_samples, n_components = log_frameprob.shape
+        viterbi_lattice = np.empty((n_samples, n_components))
+        backpointers = np.empty((n_samples, n_components), dtype=np.int64)
+        for j in range(n_components):
+            viterbi_lattice[0, j] = log_startprob[j] + log_frameprob[0, j]
+        for t in range(1, n_samples):
+            for j in range(n_components):
+                best = -np.inf
+                best_state = 0
+                for i in range(n_components):
+                    value = viterbi_lattice[t - 1, i] + log_transmat[i, j]
+                    if value > best:
+                        best = value
+                        best_state = i
+                viterbi_lattice[t, j] = best + log_frameprob[t, j]
+                backpointers[t, j] = best_state
+        state_sequence = np.empty(n_samples, dtype=np.int64)
+        state_sequence[-1] = np.argmax(viterbi_lattice[-1])
+        for t in range(n_samples - 1, 0, -1):
+            state_sequence[t - 1] = backpointers[t, state_sequence[t]]
+        return viterbi_lattice[-1, state_sequence[-1]], state_sequence
+else:
+    def _forward_scaled(startprob, transmat, frameprob):
+        n_samples, n_components = frameprob.shape
+        fwdlattice = np.empty((n_samples, n_components))
+        scaling = np.empty(n_samples)
+        value = startprob * frameprob[0]
+        for t in range(n_samples):
+            if t > 0:
+                value = (fwdlattice[t - 1] @ transmat) * frameprob[t]
+            scaling[t] = value.sum()
+            fwdlattice[t] = value / scaling[t]
+        return fwdlattice, scaling
+
+    def _backward_scaled(transmat, frameprob, scaling):
+        n_samples, n_components = frameprob.shape
+        bwdlattice = np.ones((n_samples, n_components))
+        for t in range(n_samples - 2, -1, -1):
+            bwdlattice[t] = transmat @ (frameprob[t + 1] * bwdlattice[t + 1]) / scaling[t + 1]
+        return bwdlattice
+
+    def _xi_sum_scaled(fwdlattice, transmat, bwdlattice, frameprob, scaling):
+        weighted_next = frameprob[1:] * bwdlattice[1:] / scaling[1:, None]
+        return transmat * (fwdlattice[:-1].T @ weighted_next)
+
+    def _viterbi(log_startprob, log_transmat, log_frameprob):
+        n_samples, n_components = log_frameprob.shape
+        backpointers = np.empty((n_samples, n_components), dtype=np.int64)
+        viterbi_row = log_startprob + log_frameprob[0]
+        for t in range(1, n_samples):
+            candidates = viterbi_row[:, None] + log_transmat
+            backpointers[t] = np.argmax(candidates, axis=0)
+            viterbi_row = candidates[backpointers[t], np.arange(n_components)] + log_frameprob[t]
+        state_sequence = np.empty(n_samples, dtype=np.int64)
+        state_sequence[-1] = np.argmax(viterbi_row)
+        for t in range(n_samples - 1, 0, -1):
+            state_sequence[t - 1] = backpointers[t, state_sequence[t]]
+        return viterbi_row[state_sequence[-1]], state_sequence
+
+def _normalize(a, axis=None):
+    """Normalizes a in place to sum to one along axis, leaving all-zero rows at zero (as hmmlearn does)."""
+    a_sum = a.sum(axis, keepdims=True)
+    a_sum[a_sum == 0] = 1
+    a /= a_sum
+
+def _split_lengths(X, lengths):
+    if lengths is None:
+        return [X]
+    bounds = np.cumsum(np.concatenate([[0], lengths]))
+    return [X[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+class ConvergenceMonitor:
+    """Tracks the EM log-likelihood; converged when n_iter is reached or the gain drops below tol."""
+
+    def __init__(self, tol, n_iter):
+        self.tol = tol
+        self.n_iter = n_iter
+        self.history = []
+        self.iter = 0
+
+    def report(self, log_prob):
+        self.history.append(log_prob)
+        self.iter += 1
+
+    @property
+    def converged(self):
+        return (self.iter == self.n_iter or
+                (len(self.history) >= 2 and self.history[-1] - self.history[-2] < self.tol))
+
+class FastGaussianHMM:
+    """Full-covariance Gaussian HMM with the fit/score/predict interface of hmmlearn's GaussianHMM."""
+
+    def __init__(self, n_components=1, covariance_type='full', min_covar=1e-3, covars_prior=1e-2,
+                 random_state=None, n_iter=10, tol=1e-2, verbose=False, params='stmc', init_params='stmc'):
+        if covariance_type != 'full':
+            raise ValueError("FastGaussianHMM only supports covariance_type='full'")
+        self.n_components = n_components
+        self.covariance_type = covariance_type
+        self.min_covar = min_covar
+        self.covars_prior = covars_prior
+        self.random_state = random_state
+        self.n_iter = n_iter
+        self.tol = tol
+        self.verbose = verbose
+        self.params = params
+        self.init_params = init_params
+        self.monitor_ = ConvergenceMonitor(tol, n_iter)
+        self._cholesky = None
+
+    @property
+    def covars_(self):
+        return self._covars
+
+    @covars_.setter
+    def covars_(self, covars):
+        self._covars = np.array(covars, dtype=np.float64, copy=True)
+        self._cholesky = None
+
+    @property
+    def n_features(self):
+        return self.means_.shape[1]
+
+    def _init(self, X):
+        random_state = check_random_state(self.random_state)
+        init = 1.0 / self.n_components
+        if 's' in self.init_params:
+            self.startprob_ = random_state.dirichlet(np.full(self.n_components, init))
+        if 't' in self.init_params:
+            self.transmat_ = random_state.dirichlet(np.full(self.n_components, init), size=self.n_components)
+        if 'm' in self.init_params:
+            kmeans = cluster.KMeans(n_clusters=self.n_components, random_state=self.random_state, n_init=10)
+            kmeans.fit(X)
+            self.means_ = kmeans.cluster_centers_
+        if 'c' in self.init_params:
+            covar = np.cov(X.T) + self.min_covar * np.eye(X.shape[1])
+            self.covars_ = np.tile(np.atleast_2d(covar), (self.n_components, 1, 1))
+
+    def _cholesky_factors(self):
+        """Lower Cholesky factor and log-determinant of every state covariance, cached until covars_ changes."""
+        if self._cholesky is None:
+            n_features = self.means_.shape[1]
+            factors = np.empty_like(self._covars)
+            log_dets = np.empty(self.n_components)
+            for c, covar in enumerate(self._covars):
+                try:
+                    factors[c] = linalg.cholesky(covar, lower=True)
+                except linalg.LinAlgError:
+                    # A state stuck on too few observations. hmmlearn's emission density
+                    # (stats._log_multivariate_normal_density_full) retries with its own fixed
+                    # 1e-7 jitter, not the model's min_covar (which only regularizes the initial
+                    # covariances), so the same jitter keeps both engines' likelihoods equal
+                    factors[c] = linalg.cholesky(covar + 1e-7 * np.eye(n_features), lower=True)
+                log_dets[c] = 2 * np.sum(np.log(np.diagonal(factors[c])))
+            self._cholesky = (factors, log_dets)
+        return self._cholesky
+
+    def _log_frameprob(self, X):
+        """Emission log-likelihood of every sample under every state, shape (n_samples, n_components)."""
+        factors, log_dets = self._cholesky_factors()
+        n_samples, n_features = X.shape
+        log_prob = np.empty((n_samples, self.n_components))
+        for c in range(self.n_components):
+            solved = linalg.solve_triangular(factors[c], (X - self.means_[c]).T, lower=True, check_finite=False)
+            log_prob[:, c] = -0.5 * (n_features * np.log(2 * np.pi) + np.einsum('ij,ij->j', solved, solved) + log_dets[c])
+        return log_prob
+
+    def _forward_backward(self, X):
+        log_frameprob = self._log_frameprob(X)
+        # Scale each frame by its largest emission so the recursions never underflow
+        frame_max = log_frameprob.max(axis=1)
+        frameprob = np.exp(log_frameprob - frame_max[:, None])
+        fwdlattice, scaling = _forward_scaled(self.startprob_, self.transmat_, frameprob)
+        log_prob = np.sum(np.log(scaling)) + np.sum(frame_max)
+        return log_prob, frameprob, fwdlattice, scaling
+
+    def _posteriors(self, fwdlattice, bwdlattice):
+        posteriors = fwdlattice * bwdlattice
+        _normalize(posteriors, axis=1)
+        return posteriors
+
+    def fit(self, X, lengths=None):
+        X = np.asarray(X, dtype=np.float64)
+        self._init(X)
+        self.monitor_ = ConvergenceMonitor(self.tol, self.n_iter)
+
+        for _ in range(self.n_iter):
+            start = np.zeros(self.n_components)
+            trans = np.zeros((self.n_components, self.n_components))
+            post = np.zeros(self.n_components)
+            obs = np.zeros((self.n_components, X.shape[1]))
+            obs_obs = np.zeros((self.n_components, X.shape[1], X.shape[1]))
+            curr_log_prob = 0
+
+            for sub_X in _split_lengths(X, lengths):
+                log_prob, frameprob, fwdlattice, scaling = self._forward_backward(sub_X)
+                bwdlattice = _backward_scaled(self.transmat_, frameprob, scaling)
+                posteriors = self._posteriors(fwdlattice, bwdlattice)
+                curr_log_prob += log_prob
+
+                start += posteriors[0]
+                if len(sub_X) > 1:
+                    trans += _xi_sum_scaled(fwdlattice, self.transmat_, bwdlattice, frameprob, scaling)
+                if 'm' in self.params or 'c' in self.params:
+                    post += posteriors.sum(axis=0)
+                    obs += posteriors.T @ sub_X
+                if 'c' in self.params:
+                    for c in range(self.n_components):
+                        obs_obs[c] += (sub_X * posteriors[:, [c]]).T @ sub_X
+
+            self._do_mstep(start, trans, post, obs, obs_obs)
+            self.monitor_.report(curr_log_prob)
+            if self.verbose:
+                print(f"{self.monitor_.iter:>10d} {curr_log_prob:>16.8f}")
+            if self.monitor_.converged:
+                break
+        return self
+
+    def _do_mstep(self, start, trans, post, obs, obs_obs):
+        if 's' in self.params:
+            startprob = np.where(self.startprob_ == 0, 0, np.maximum(start, 0))
+            _normalize(startprob)
+            self.startprob_ = startprob
+        if 't' in self.params:
+            transmat = np.where(self.transmat_ == 0, 0, np.maximum(trans, 0))
+            _normalize(transmat, axis=1)
+            self.transmat_ = transmat
+        if 'm' in self.params:
+            self.means_ = obs / post[:, None]
+        if 'c' in self.params:
+            obs_mean = obs[:, :, None] * self.means_[:, None, :]
+            outer_means = self.means_[:, :, None] * self.means_[:, None, :]
+            c_n = obs_obs - obs_mean - obs_mean.transpose(0, 2, 1) + outer_means * post[:, None, None]
+            self.covars_ = (self.covars_prior + c_n) / post[:, None, None]
+
+    def score(self, X, lengths=None):
+        X = np.asarray(X, dtype=np.float64)
+        return sum(self._forward_backward(sub_X)[0] for sub_X in _split_lengths(X, lengths))
+
+    def predict_proba(self, X, lengths=None):
+        X = np.asarray(X, dtype=np.float64)
+        posteriors = []
+        for sub_X in _split_lengths(X, lengths):
+            _, frameprob, fwdlattice, scaling = self._forward_backward(sub_X)
+            bwdlattice = _backward_scaled(self.transmat_, frameprob, scaling)
+            posteriors.append(self._posteriors(fwdlattice, bwdlattice))
+        return np.concatenate(posteriors)
+
+    def predict(self, X, lengths=None):
+        X = np.asarray(X, dtype=np.float64)
+        with np.errstate(divide="ignore"):
+            log_startprob = np.log(self.startprob_)
+            log_transmat = np.log(self.transmat_)
+        return np.concatenate([_viterbi(log_startprob, log_transmat, self._log_frameprob(sub_X))[1]
+                               for sub_X in _split_lengths(X, lengths)])
+
+def gaussian_hmm(engine="hmmlearn", **kwargs):
+    """Creates a full-covariance Gaussian HMM with hmmlearn or the compiled engine."""
+    if engine == "fast":
+        return FastGaussianHMM(**kwargs)
+    from hmmlearn import hmm
+    return hmm.GaussianHMM(**kwargs)
+
+# -------------------- Equivalence Check & Benchmark --------------------
+
+def _synthetic_data(n_samples, n_features, n_components, seed, lengths=None):
+    """Samples a sequence from a random sticky full-covariance Gaussian HMM."""
+    rng = np.random.default_rng(seed)
+    transmat = np.full((n_components, n_components), 0.1 / (n_components - 1))
+    np.fill_diagonal(transmat, 0.9)
+    means = rng.normal(0, 3, (n_components, n_features))
+    factors = rng.normal(0, 0.5, (n_components, n_features, n_features))
+    covars = factors @ factors.transpose(0, 2, 1) + np.eye(n_features)
+    states = np.empty(n_samples, dtype=int)
+    states[0] = rng.integers(n_components)
+    for t in range(1, n_samples):
+        states[t] = rng.choice(n_components, p=transmat[states[t - 1]])
+    X = np.array([rng.multivariate_normal(means[s], covars[s]) for s in states])
+    return X
+
+def _compare(reference, fast, X, lengths, label):
+    """Prints the largest differences between the hmmlearn and fast engine results."""
+    diffs = {
+        "score": abs(reference.score(X, lengths) - fast.score(X, lengths)) / abs(reference.score(X, lengths)),
+        "predict_proba": np.max(np.abs(reference.predict_proba(X, lengths) - fast.predict_proba(X, lengths))),
+        "predict mismatches": np.sum(reference.predict(X, lengths) != fast.predict(X, lengths)),
+        "startprob": np.max(np.abs(reference.startprob_ - fast.startprob_)),
+        "transmat": np.max(np.abs(reference.transmat_ - fast.transmat_)),
+        "means": np.max(np.abs(reference.means_ - fast.means_)),
+        "covars": np.max(np.abs(reference.covars_ - fast.covars_)),
+    }
+    print(f"[{label}] " + ", ".join(f"{name} {value:.3g}" for name, value in diffs.items()))
+    return diffs
+
+def check_equivalence(seed=0):
+    """Fits both engines from identical initial parameters on synthetic data and compares every output."""
+    from hmmlearn import hmm
+    X = _synthetic_data(3000, 5, 4, seed)
+    lengths = [1000, 1200, 800]
+    passed = True
+    for params in ['stmc', 'st']:
+        for seq_lengths in [None, lengths]:
+            init = hmm.GaussianHMM(n_components=4, covariance_type='full', random_state=seed, n_iter=1)
+            init.fit(X, seq_lengths)
+            models = []
+            for model in [hmm.GaussianHMM(n_components=4, covariance_type='full', n_iter=20, tol=1e-7,
+                                          params=params, init_params=''),
+                          FastGaussianHMM(n_components=4, n_iter=20, tol=1e-7, params=params, init_params='')]:
+                model.startprob_, model.transmat_ = init.startprob_.copy(), init.transmat_.copy()
+                model.means_, model.covars_ = init.means_.copy(), init.covars_.copy()
+                model.fit(X, seq_lengths)
+                models.append(model)
+            label = f"params={params}, lengths={'yes' if seq_lengths else 'no'}"
+            diffs = _compare(models[0], models[1], X, seq_lengths, label)
+            passed &= (diffs["score"] < 1e-8 and diffs["predict_proba"] < 1e-6 and diffs["predict mismatches"] == 0
+                       and max(diffs[p] for p in ["startprob", "transmat", "means", "covars"]) < 1e-6)
+            passed &= models[0].monitor_.iter == models[1].monitor_.iter
+    print(f"Equivalence with hmmlearn: {'passed' if passed else 'FAILED'}")
+    return passed
+
+def benchmark(n_samples=20000, n_features=10, n_components=8, n_iter=20, seed=0):
+    """Times fit, predict and predict_proba of both engines from identical initial parameters."""
+    from hmmlearn import hmm
+    X = _synthetic_data(n_samples, n_features, n_components, seed)
+    init = hmm.GaussianHMM(n_components=n_components, covariance_type='full', random_state=seed, n_iter=1).fit(X)
+    # Compile the numba kernels before timing
+    FastGaussianHMM(n_components=n_components, n_iter=1).fit(X[:100])
+
+    print(f"Benchmark: {n_samples} samples, {n_features} features, {n_components} states, {n_iter} EM iterations "
+          f"({'numba' if NUMBA_AVAILABLE else 'NumPy'} kernels)")
+    for name, model in [("hmmlearn", hmm.GaussianHMM(n_components=n_components, covariance_type='full', n_iter=n_iter,
+                                                    tol=-np.inf, init_params='')),
+                        ("fast", FastGaussianHMM(n_components=n_components, n_iter=n_iter, tol=-np.inf, init_params=''))]:
+        model.startprob_, model.transmat_ = init.startprob_.copy(), init.transmat_.copy()
+        model.means_, model.covars_ = init.means_.copy(), init.covars_.copy()
+        timings = []
+        for method in [lambda: model.fit(X), lambda: model.predict(X), lambda: model.predict_proba(X)]:
+            start_time = time.time()
+            method()
+            timings.append(time.time() - start_time)
+        print(f"{name}: fit {timings[0]:.2f} s, predict {timings[1]:.3f} s, predict_proba {timings[2]:.3f} s")
+
+if __name__ == "__main__":
+    check_equivalence()
+    benchmark()
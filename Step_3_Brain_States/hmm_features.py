@@ -0,0 +1,95 @@
+import numpy as np
+
+# -------------------- Temporal Features of HMM State Sequences --------------------
+
+# All per-state temporal features come from one run-length encoding of a batch of state
+# sequences (e.g. every participant and mode), with per-(sequence, state) statistics gathered
+# by np.bincount / np.minimum.at / np.maximum.at instead of a loop over states.
+
+def run_length_encode(state_sequences):
+    """Run-length encodes a batch of state sequences.
+
+    Returns the concatenated states, the sequence index of every sample, and for every run its
+    state, sequence index, and start / end (exclusive) positions within its own sequence.
+    """
+    lengths = np.array([len(sequence) for sequence in state_sequences])
+    states = np.concatenate([np.asarray(sequence, dtype=np.int64) for sequence in state_sequences])
+    sequence_ids = np.repeat(np.arange(len(state_sequences)), lengths)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+    # A run starts at every sample whose state or sequence differs from the previous sample
+    is_start = np.ones(len(states), dtype=bool)
+    is_start[1:] = (states[1:] != states[:-1]) | (sequence_ids[1:] != sequence_ids[:-1])
+    starts = np.flatnonzero(is_start)
+    ends = np.append(starts[1:], len(states))
+
+    run_sequences = sequence_ids[starts]
+    runs = {
+        "state": states[starts],
+        "sequence": run_sequences,
+        "start": starts - offsets[run_sequences],
+        "end": ends - offsets[run_sequences],
+    }
+    return states, sequence_ids, lengths, runs
+
+def temporal_features(state_sequences, n_states):
+    """Fractional occupancy, transition probabilities, mean lifetime and mean interval length for a batch.
+
+    Returns a dict of arrays stacked over the sequences: (n_sequences, n_states) for the per-state
+    features and (n_sequences, n_states, n_states) for the transition probabilities. The definitions
+    match the original per-state loops in HMM_fitting-new.py:
+
+    * mean_lifetime averages the differences between consecutive on/off change points of the state,
+      i.e. (last run end - first run start) / (2 * n_runs - 1) + 1, and 0 if the state never occurs;
+    * mean_interval_length is the mean gap between consecutive occurrences of the state, 0 if it occurs
+      at most once.
+
+    occurrence_spacing, the mean difference between consecutive occurrence times (0 if the state occurs
+    at most once), is also returned for Extra/HMM.py, which uses it for both its lifetime and interval.
+    """
+    states, sequence_ids, lengths, runs = run_length_encode(state_sequences)
+    n_sequences = len(lengths)
+    n_cells = n_sequences * n_states
+
+    # Occurrence counts per (sequence, state)
+    counts = np.bincount(sequence_ids * n_states + states, minlength=n_cells).reshape(n_sequences, n_states)
+    fractional_occupancy = counts / lengths[:, None]
+
+    # Transitions between consecutive samples of the same sequence
+    same_sequence = sequence_ids[1:] == sequence_ids[:-1]
+    transition_keys = (sequence_ids[1:] * n_states + states[:-1]) * n_states + states[1:]
+    transition_counts = np.bincount(transition_keys[same_sequence], minlength=n_cells * n_states)
+    transition_counts = transition_counts.reshape(n_sequences, n_states, n_states).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        transition_probabilities = transition_counts / np.sum(transition_counts, axis=2, keepdims=True)
+
+    # First start, last end and number of runs per (sequence, state)
+    run_keys = runs["sequence"] * n_states + runs["state"]
+    n_runs = np.bincount(run_keys, minlength=n_cells)
+    first_start = np.full(n_cells, np.iinfo(np.int64).max)
+    np.minimum.at(first_start, run_keys, runs["start"])
+    last_end = np.full(n_cells, -1)
+    np.maximum.at(last_end, run_keys, runs["end"])
+    n_runs = n_runs.reshape(n_sequences, n_states)
+    first_start = first_start.reshape(n_sequences, n_states)
+    last_end = last_end.reshape(n_sequences, n_states)
+
+    occurs = n_runs > 0
+    mean_lifetime = np.zeros((n_sequences, n_states))
+    mean_lifetime[occurs] = (last_end[occurs] - first_start[occurs]) / (2 * n_runs[occurs] - 1) + 1
+
+    # The first and last occurrence of a state are its first run start and last run end - 1
+    repeats = counts > 1
+    span = (last_end - 1 - first_start).astype(np.float64)
+    mean_interval_length = np.zeros((n_sequences, n_states))
+    mean_interval_length[repeats] = (span[repeats] - (counts[repeats] - 1)) / (counts[repeats] - 1)
+    occurrence_spacing = np.zeros((n_sequences, n_states))
+    occurrence_spacing[repeats] = span[repeats] / (counts[repeats] - 1)
+
+    return {
+        "fractional_occupancy": fractional_occupancy,
+        "transition_probabilities": transition_probabilities,
+        "mean_lifetime": mean_lifetime,
+        "mean_interval_length": mean_interval_length,
+        "occurrence_spacing": occurrence_spacing,
+    }
@@ -0,0 +1,44 @@
+import os
+import numpy as np
+from hmmlearn import hmm
+
+# -------------------- Fitted HMM Persistence --------------------
+
+# A fitted GaussianHMM is stored as its parameter arrays in a small npz, together with the
+# StandardScaler parameters its features were standardized with, so states can be re-decoded
+# (or new participants decoded) without refitting.
+
+def save_hmm_model(model_file, model, scaler=None):
+    """Saves a fitted full-covariance GaussianHMM (and optionally its feature scaler) to an npz file."""
+    arrays = {
+        "startprob": model.startprob_,
+        "transmat": model.transmat_,
+        "means": model.means_,
+        "covars": model.covars_,
+    }
+    if scaler is not None:
+        arrays["scaler_mean"] = scaler.mean_
+        arrays["scaler_scale"] = scaler.scale_
+
+    os.makedirs(os.path.dirname(model_file), exist_ok=True)
+    # Write under a temporary name so concurrent readers never see a partial file
+    partial_file = model_file[:-len(".npz")] + ".partial.npz"
+    np.savez(partial_file, **arrays)
+    os.replace(partial_file, model_file)
+
+def load_hmm_model(model_file):
+    """Loads a model saved by save_hmm_model, returning the GaussianHMM and the scaler (mean, scale) or None."""
+    with np.load(model_file) as saved:
+        model = hmm.GaussianHMM(n_components=saved["startprob"].shape[0], covariance_type='full')
+        model.n_features = saved["means"].shape[1]
+        model.startprob_ = saved["startprob"]
+        model.transmat_ = saved["transmat"]
+        model.means_ = saved["means"]
+        model.covars_ = saved["covars"]
+        scaler = (saved["scaler_mean"], saved["scaler_scale"]) if "scaler_mean" in saved else None
+    return model, scaler
+
+def standardize(features, scaler):
+    """Applies saved StandardScaler parameters (mean, scale) to raw features."""
+    mean, scale = scaler
+    return (features - mean) / scale
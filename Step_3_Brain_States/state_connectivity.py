@@ -0,0 +1,76 @@
+import numpy as np
+
+# -------------------- State-Block Functional Connectivity --------------------
+
+# Every contiguous block of an HMM state gets a parcel x parcel correlation matrix over all epochs
+# and the block's samples. Rather than slicing and correlating each block separately, the data are
+# cut once at every block boundary; per-segment sums and cross-products are accumulated into
+# cumulative sums, so any block's statistics are a difference of two prefix sums and all blocks'
+# correlation matrices come out as one (n_blocks x n_parcels x n_parcels) tensor.
+
+def state_blocks(state_sequence, n_states):
+    """Contiguous blocks of every state, ordered by state and then by time.
+
+    Returns (states, block_indices, starts, ends) arrays, with ends exclusive, matching the
+    (state, block) keys of the original per-state loop in HMM_fitting-new.py.
+    """
+    state_sequence = np.asarray(state_sequence)
+    is_start = np.ones(len(state_sequence), dtype=bool)
+    is_start[1:] = state_sequence[1:] != state_sequence[:-1]
+    starts = np.flatnonzero(is_start)
+    ends = np.append(starts[1:], len(state_sequence))
+    states = state_sequence[starts]
+
+    order = np.argsort(states, kind="stable")
+    states, starts, ends = states[order], starts[order], ends[order]
+    states_present = states < n_states
+    states, starts, ends = states[states_present], starts[states_present], ends[states_present]
+    # Block index counts up within each state
+    first_of_state = np.searchsorted(states, states, side="left")
+    block_indices = np.arange(len(states)) - first_of_state
+    return states, block_indices, starts, ends
+
+def correlation_from_moments(sums, cross_products, counts):
+    """Correlation matrices from per-block sums (B x L), cross-products (B x L x L) and sample counts (B)."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts[:, None]
+        covariances = cross_products / counts[:, None, None] - means[:, :, None] * means[:, None, :]
+        std = np.sqrt(np.clip(np.einsum('bii->bi', covariances), 0, None))
+        correlations = covariances / (std[:, :, None] * std[:, None, :])
+    return np.clip(correlations, -1, 1)
+
+def block_correlations(orthogonalized_data, starts, ends):
+    """Parcel x parcel correlation of every block [start, end) of the time axis, pooled over epochs.
+
+    orthogonalized_data is (epochs x parcels x times); the parcel count is taken from the data.
+    Block bounds are clipped to the number of time points; a block left empty falls back to the
+    correlation of the per-epoch time averages, as the original per-block code did.
+    """
+    n_epochs, n_parcels, n_times = orthogonalized_data.shape
+    starts = np.clip(np.asarray(starts), 0, n_times)
+    ends = np.clip(np.asarray(ends), 0, n_times)
+    # Centre on the global parcel means so the one-pass moments do not lose precision
+    global_mean = np.mean(orthogonalized_data, axis=(0, 2))
+
+    boundaries = np.unique(np.concatenate([starts, ends, [0, n_times]]))
+    segment_sums = np.zeros((len(boundaries), n_parcels))
+    segment_cross_products = np.zeros((len(boundaries), n_parcels, n_parcels))
+    for k, (start, end) in enumerate(zip(boundaries[:-1], boundaries[1:])):
+        segment = np.moveaxis(orthogonalized_data[:, :, start:end], 1, 0).reshape(n_parcels, -1) - global_mean[:, None]
+        segment_sums[k + 1] = segment.sum(axis=1)
+        segment_cross_products[k + 1] = segment @ segment.T
+    prefix_sums = np.cumsum(segment_sums, axis=0)
+    prefix_cross_products = np.cumsum(segment_cross_products, axis=0)
+
+    start_index = np.searchsorted(boundaries, starts)
+    end_index = np.searchsorted(boundaries, ends)
+    correlations = correlation_from_moments(prefix_sums[end_index] - prefix_sums[start_index],
+                                            prefix_cross_products[end_index] - prefix_cross_products[start_index],
+                                            n_epochs * (ends - starts).astype(np.float64))
+
+    empty = ends <= starts
+    if np.any(empty):
+        epoch_means = np.mean(orthogonalized_data, axis=2) - global_mean
+        correlations[empty] = correlation_from_moments(epoch_means.sum(axis=0)[None], (epoch_means.T @ epoch_means)[None],
+                                                       np.array([float(n_epochs)]))[0]
+    return correlations, empty
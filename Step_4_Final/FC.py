@@ -7,6 +7,10 @@ import json
 import pandas as pd
 from collections import defaultdict
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Step_3_Brain_States"))
+from connectivity_store import (has_block_correlations, load_correlation_matrices, has_thresholded_edges,
+                                load_thresholded_edges, block_edges)
+
 # -------------------- Configuration --------------------
 
 base_dir = "/projects/illinois/ahs/kch/nakhan2/ACE/HMM_Output/"
@@ -28,54 +32,37 @@ def process_participant(base_dir, participant_id):
         correlation_matrices = {}
         results[mode] = {}
 
-        filepath1 = os.path.join(base_dir, participant_id, "Correlation_matrices", f"{participant_id}_{mode}_correlation_matrices.npy.npz")
-        filepath2 = os.path.join(base_dir, participant_id, "Thresholded_matrices", mode, f"{participant_id}_{mode}_thresholded_matrices.npz")
+        participant_dir = os.path.join(base_dir, participant_id)
 
-        if not os.path.exists(filepath1) or not os.path.exists(filepath2):
-            print(filepath1)
-            print(filepath2)
+        if not has_block_correlations(participant_dir, participant_id, mode) or not has_thresholded_edges(participant_dir, participant_id, mode):
             print(f"Skipping {participant_id} - {mode}: Missing correlation or thresholded matrices.")
             continue
 
-        data = np.load(filepath1)
-        for key in data.files:
-            try:
-                tuple_key = tuple(map(int, key.split('_')))
-                correlation_matrices[tuple_key] = data[key]
-            except ValueError:
-                continue  # Skip invalid keys
+        correlation_matrices = load_correlation_matrices(participant_dir, participant_id, mode)
 
-        thresholded_matrices = np.load(filepath2)
+        thresholded_edges = load_thresholded_edges(participant_dir, participant_id, mode)
 
         results[mode]['correlation_matrices'] = correlation_matrices
-        results[mode]['thresholded_matrices'] = thresholded_matrices
+        results[mode]['thresholded_edges'] = thresholded_edges
 
     return results
 
-def load_thresholded_matrices(participants):
-    """Loads thresholded matrices for all participants."""
-    thresholded_correlation_matrices = {}
-
-    for participant in sorted(participants):
-        for mode in modes:
-            filepath = os.path.join(base_dir, participant, "Thresholded_matrices", mode, f"{participant}_{mode}_thresholded_matrices.npz")
-
-            if not os.path.exists(filepath):
-                print(f"File not found for {participant} in mode {mode}.")
-                continue
+def collect_thresholded_edges(participants_data):
+    """The sparse thresholded edges loaded by process_participant, keyed by (participant, mode)."""
+    thresholded_edges = {}
+    for participant in sorted(participants_data):
+        for mode, results in participants_data[participant].items():
+            if results.get('thresholded_edges') is not None:
+                thresholded_edges[(participant, mode)] = results['thresholded_edges']
+    return thresholded_edges
 
-            try:
-                data = np.load(filepath)
-                for key in data.files:
-                    try:
-                        tuple_key = tuple(map(int, key.split('_')))
-                        thresholded_correlation_matrices[(participant, mode, tuple_key)] = data[key]
-                    except ValueError:
-                        continue
-            except Exception as e:
-                print(f"Error loading {filepath}: {e}")
-
-    return thresholded_correlation_matrices
+def load_thresholded_blocks(thresholded_edges):
+    """Surviving (i, j, value) edges of every thresholded block, keyed by (participant, mode, (state, block))."""
+    thresholded_blocks = {}
+    for (participant, mode), edges in thresholded_edges.items():
+        for row, (state, block) in enumerate(edges["block_index"].tolist()):
+            thresholded_blocks[(participant, mode, (state, block))] = block_edges(edges, row)
+    return thresholded_blocks
 
 
 
@@ -88,7 +75,8 @@ for participant in participants:
     results = process_participant(base_dir, participant)
     participants_data[participant] = results
 
-thresholded_correlation_matrices = load_thresholded_matrices(participants_data.keys())
+thresholded_edges = collect_thresholded_edges(participants_data)
+thresholded_blocks = load_thresholded_blocks(thresholded_edges)
 
 # -------------------- Define Network Assignments --------------------
 
@@ -239,22 +227,55 @@ for i, label in enumerate(labels):
     if network_name:
         networks[network_name].append((i, label))
 
+# Network (index into networks) and position within that network of every parcel, -1 if unassigned
+network_names = list(networks.keys())
+parcel_network = np.full(len(labels), -1)
+parcel_position = np.full(len(labels), -1)
+for n, network_name in enumerate(network_names):
+    for position, (i, _) in enumerate(networks[network_name]):
+        parcel_network[i] = n
+        parcel_position[i] = position
+
+def network_edges(block):
+    """Buckets a block's surviving (i, j, value) edges by network.
+
+    Returns {(net1, net2): (positions1, positions2, values)} with net1 == net2 for within-network
+    edges (positions1 < positions2) and net1 before net2 in networks order otherwise, covering
+    every network pair; edges touching a parcel without a network (or beyond the labels) are dropped.
+    """
+    i, j, values = block
+    labelled = j < len(labels)  # i < j
+    i, j, values = i[labelled], j[labelled], values[labelled]
+    network1, network2 = parcel_network[i], parcel_network[j]
+    position1, position2 = parcel_position[i], parcel_position[j]
+    # Matrices are symmetric, so an edge from a later to an earlier network is stored the other way round
+    swap = network1 > network2
+    network1, network2 = np.where(swap, network2, network1), np.where(swap, network1, network2)
+    position1, position2 = np.where(swap, position2, position1), np.where(swap, position1, position2)
+
+    buckets = {}
+    for n1, n2 in itertools.combinations_with_replacement(range(len(network_names)), 2):
+        in_bucket = (network1 == n1) & (network2 == n2)
+        buckets[(network_names[n1], network_names[n2])] = (position1[in_bucket], position2[in_bucket], values[in_bucket])
+    return buckets
+
 # -------------------- Functional Connectivity Calculation --------------------
 
-def calculate_network_connectivity(thresholded_correlation_matrices, networks):
+def calculate_network_connectivity(thresholded_blocks, networks):
     """Calculates within and between network connectivity."""
     within_network_connectivity = {}
     between_network_connectivity = {}
 
-    networks_indices = {k: [r[0] for r in v] for k, v in networks.items()}
-
-    for (participant, mode, window), corr_matrix in sorted(thresholded_correlation_matrices.items()):
+    for (participant, mode, window), block in sorted(thresholded_blocks.items()):
         within_network_connectivity[(participant, mode, window)] = []
         between_network_connectivity[(participant, mode, window)] = []
-   
+        # Every region pair is listed, so only the surviving edges are scattered into zeroed network blocks
+        buckets = network_edges(block)
 
         for network_name, regions in networks.items():
-            network_corr_matrix = corr_matrix[np.ix_(networks_indices[network_name], networks_indices[network_name])]
+            network_corr_matrix = np.zeros((len(regions), len(regions)))
+            positions1, positions2, values = buckets[(network_name, network_name)]
+            network_corr_matrix[positions1, positions2] = values
             upper_tri_indices = np.triu_indices_from(network_corr_matrix, k=1)
 
             for i, j in zip(*upper_tri_indices):
@@ -263,7 +284,9 @@ def calculate_network_connectivity(thresholded_correlation_matrices, networks):
                 within_network_connectivity[(participant, mode, window)].append(f"[{network_name}]: {region1} - {corr_value:.2f} - {region2}")
 
         for net1, net2 in itertools.combinations(networks.keys(), 2):
-            between_corr_matrix = corr_matrix[np.ix_(networks_indices[net1], networks_indices[net2])]
+            between_corr_matrix = np.zeros((len(networks[net1]), len(networks[net2])))
+            positions1, positions2, values = buckets[(net1, net2)]
+            between_corr_matrix[positions1, positions2] = values
 
             for i, j in itertools.product(range(len(networks[net1])), range(len(networks[net2]))):
                 region1, region2 = networks[net1][i][1], networks[net2][j][1]
@@ -274,18 +297,18 @@ def calculate_network_connectivity(thresholded_correlation_matrices, networks):
     return within_network_connectivity, between_network_connectivity
 
 start_time = time.time()
-within_network_conn_values, between_network_conn_values = calculate_network_connectivity(thresholded_correlation_matrices, networks)
+within_network_conn_values, between_network_conn_values = calculate_network_connectivity(thresholded_blocks, networks)
 print(f"Total time taken for calculation: {(time.time() - start_time) / 60:.2f} minutes")
 
-def aggregate_network_connectivity(thresholded_correlation_matrices, networks, median_optimal_states):
+def aggregate_network_connectivity(thresholded_blocks, networks, median_optimal_states):
     """
     Aggregate network connectivity measures for each state by averaging across windows.
     NOTE: Add back error handling if need to troubleshoot
 
     Args:
-        thresholded_correlation_matrices (dict): Dictionary containing thresholded correlation matrices 
-            for each participant, mode, and state-window combination. Keys are tuples
-            in the form (participant, mode, (state, window_number)).
+        thresholded_blocks (dict): Dictionary containing the surviving (i, j, value) edges of the
+            thresholded correlation matrix for each participant, mode, and state-window combination.
+            Keys are tuples in the form (participant, mode, (state, window_number)).
         networks (dict): Dictionary mapping network names to lists of region indices and names.
         median_optimal_states (int): The optimal number of states identified.
 
@@ -298,7 +321,6 @@ def aggregate_network_connectivity(thresholded_correlation_matrices, networks, m
     print("Starting aggregation of network connectivity...")
     aggregated_within_network_connectivity = {}
     aggregated_between_network_connectivity = {}
-    networks_indices = {k: [r[0] for r in v] for k, v in networks.items()}
 
     participants_processed = set()
     participant_count = len(participants_data)
@@ -315,34 +337,34 @@ def aggregate_network_connectivity(thresholded_correlation_matrices, networks, m
         aggregated_between_network_connectivity[state] = {(net1, net2): [] for net1, net2 in itertools.combinations(networks.keys(), 2)}
 
     # Aggregate connectivity measures for each state
-    for (participant, mode, (state, window_number)), corr_matrix in sorted(thresholded_correlation_matrices.items()):
+    for (participant, mode, (state, window_number)), block in sorted(thresholded_blocks.items()):
         # Ensure the state key exists in the dictionaries
         if state not in aggregated_within_network_connectivity:
             aggregated_within_network_connectivity[state] = {network: [] for network in networks.keys()}
         if state not in aggregated_between_network_connectivity:
             aggregated_between_network_connectivity[state] = {(net1, net2): [] for net1, net2 in itertools.combinations(networks.keys(), 2)}
 
+        # Means over all region pairs, from the sums of the surviving edges (the others are zero)
+        buckets = network_edges(block)
+
         # Within-network connectivity
         for network_name, regions in networks.items():
-            network_corr_matrix = corr_matrix[np.ix_(networks_indices[network_name], networks_indices[network_name])]
-            upper_tri_indices = np.triu_indices_from(network_corr_matrix, k=1)
-            mean_corr = np.mean(network_corr_matrix[upper_tri_indices])
+            n_pairs = len(regions) * (len(regions) - 1) // 2
+            mean_corr = np.sum(buckets[(network_name, network_name)][2], dtype=np.float64) / n_pairs if n_pairs else np.nan
             if not np.isnan(mean_corr):  # Check if mean_corr is not NaN
                 aggregated_within_network_connectivity[state][network_name].append(mean_corr)
 
         # Between-network connectivity
         for net1, net2 in itertools.combinations(networks.keys(), 2):
-            regions1 = networks_indices[net1]
-            regions2 = networks_indices[net2]
-            between_corr_matrix = corr_matrix[np.ix_(regions1, regions2)]
-            mean_corr = np.mean(between_corr_matrix)
+            n_pairs = len(networks[net1]) * len(networks[net2])
+            mean_corr = np.sum(buckets[(net1, net2)][2], dtype=np.float64) / n_pairs if n_pairs else np.nan
             if not np.isnan(mean_corr):  # Check if mean_corr is not NaN
                 aggregated_between_network_connectivity[state][(net1, net2)].append(mean_corr)
                 
 
         if participant not in participants_processed:
-            ec_processed = any((participant, "congruent", (state, wn)) in thresholded_correlation_matrices for wn in range(window_number + 1))
-            eo_processed = any((participant, "incongruent", (state, wn)) in thresholded_correlation_matrices for wn in range(window_number + 1))
+            ec_processed = any((participant, "congruent", (state, wn)) in thresholded_blocks for wn in range(window_number + 1))
+            eo_processed = any((participant, "incongruent", (state, wn)) in thresholded_blocks for wn in range(window_number + 1))
 
             if ec_processed and eo_processed:
                 current_count += 1
@@ -377,7 +399,7 @@ def aggregate_network_connectivity(thresholded_correlation_matrices, networks, m
 
 # Call the function and measure execution time
 start_time = time.time()
-aggregated_within_conn, aggregated_between_conn = aggregate_network_connectivity(thresholded_correlation_matrices, networks, median_optimal_states)
+aggregated_within_conn, aggregated_between_conn = aggregate_network_connectivity(thresholded_blocks, networks, median_optimal_states)
 print(f"Total time taken for aggregation: {(time.time() - start_time) / 60:.2f} minutes")
 
 
@@ -2,6 +2,10 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Step_3_Brain_States"))
+from connectivity_store import load_block_matrix
 
 # -------------------- Configuration --------------------
 participant = "NU103"
@@ -10,18 +14,11 @@ state = 7
 block = 0
 
 base_dir = "/projects/illinois/ahs/kch/nakhan2/NURISH_Cohort1/HMM_Output/"
-correlation_path = os.path.join(base_dir, participant, "Correlation_matrices", 
-                               f"{participant}_{mode}_correlation_matrices.npy.npz")
 output_dir = os.path.join(base_dir, participant, "Plots")
 os.makedirs(output_dir, exist_ok=True)
 
 # -------------------- Load Correlation Matrix --------------------
-def load_matrix(npz_path, state, block):
-    key = f"{state}_{block}"
-    with np.load(npz_path) as data:
-        return data[key]
-
-corr_matrix = load_matrix(correlation_path, state, block)
+corr_matrix = load_block_matrix(os.path.join(base_dir, participant), participant, mode, state, block)
 
 # -------------------- Network Labels --------------------
 labels = [
@@ -1,6 +1,10 @@
 import os
 import numpy as np
 import matplotlib.pyplot as plt
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Step_3_Brain_States"))
+from connectivity_store import load_block_matrix
 
 # -------------------- Configuration --------------------
 base_dir = "/projects/illinois/ahs/kch/nakhan2/NURISH_Cohort1/HMM_Output/"
@@ -9,22 +13,8 @@ mode = "incongruent"
 state = 7
 block = 0
 
-# -------------------- File Paths --------------------
-original_path = os.path.join(
-    base_dir, participant_id, "Correlation_matrices", 
-    f"{participant_id}_{mode}_correlation_matrices.npy.npz"
-)
-
 # -------------------- Load Matrix --------------------
-def load_matrix(npz_path, state, block):
-    key = f"{state}_{block}"
-    with np.load(npz_path) as data:
-        if key not in data:
-            available_keys = list(data.keys())
-            raise KeyError(f"Key {key} not found. Available keys: {available_keys[:10]}{'...' if len(available_keys)>10 else ''}")
-        return data[key]
-
-original_matrix = load_matrix(original_path, state, block)
+original_matrix = load_block_matrix(os.path.join(base_dir, participant_id), participant_id, mode, state, block)
 
 # -------------------- Plot --------------------
 plt.figure(figsize=(10, 8))  # Adjusted for single plot